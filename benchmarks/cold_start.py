@@ -0,0 +1,94 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Measure the import (INIT) time of each lambda handler module.
+
+Every measurement runs in a fresh interpreter, so nothing is cached between runs,
+which is what a Lambda cold start sees. The layer directories under lambda/lambda_layer
+are added to PYTHONPATH the same way Lambda mounts them under /opt/python, so the
+dependencies installed in the layers must be importable locally (pip install -r requirements.txt).
+
+Usage:
+    python benchmarks/cold_start.py [--runs 5] [handler_dir ...]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT, "lambda")
+LAYER_DIR = os.path.join(LAMBDA_DIR, "lambda_layer")
+
+# handler directory -> handler module
+HANDLERS = {
+    "connect": "index",
+    "disconnect": "index",
+    "default": "index",
+    "jwt_auth": "index",
+    "course_outline_ws": "index",
+    "course_outline_llm": "index",
+    "course_content_ws": "index",
+    "course_content_llm": "index",
+    "course_build_ws": "index",
+    "qna_bot": "index",
+    "kb_sync": "index",
+}
+
+# placeholder values for environment variables read at import time
+IMPORT_ENV = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "API_REGION": "us-east-1",
+    "ACCOUNT_ID": "123456789012",
+    "COGNITO_USER_POOL_ID": "us-east-1_example",
+    "WEBSOCKET_API_ID": "example",
+}
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def layer_paths():
+    return [os.path.join(LAYER_DIR, layer) for layer in sorted(os.listdir(LAYER_DIR))
+            if os.path.isdir(os.path.join(LAYER_DIR, layer))]
+
+
+def measure_import(handler_dir, module):
+    """Import the handler module in a new interpreter and return the import time in seconds"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.join(LAMBDA_DIR, handler_dir)] + layer_paths())
+    for name, value in IMPORT_ENV.items():
+        env.setdefault(name, value)
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    result = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+                            cwd=os.path.join(LAMBDA_DIR, handler_dir), env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("handlers", nargs="*", default=list(HANDLERS), help="handler directories to measure")
+    parser.add_argument("--runs", type=int, default=5, help="number of cold imports per handler")
+    args = parser.parse_args()
+
+    print(f"{'handler':<22}{'median ms':>12}{'min ms':>12}{'max ms':>12}")
+    for handler_dir in args.handlers:
+        try:
+            timings = [measure_import(handler_dir, HANDLERS.get(handler_dir, "index")) * 1000
+                       for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{handler_dir:<22}failed: {e}")
+            continue
+        print(f"{handler_dir:<22}{statistics.median(timings):>12.1f}{min(timings):>12.1f}{max(timings):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -38,6 +38,12 @@ class CourseStack(Stack):
             variables = json.load(file)
 
         model_id = variables["model_id"]
+        # requires a model_id that supports Bedrock prompt caching
+        enable_prompt_caching = variables.get("enable_prompt_caching", False)
+        # cheaper model condensing oversized syllabi before course outline generation
+        condense_model_id = variables.get("condense_model_id", "anthropic.claude-3-haiku-20240307-v1:0")
+        # SSM parameter published by the QnA stack with the id of its knowledge base
+        knowledge_base_id_parameter = variables.get("knowledge_base_id_parameter", "/course-content-generator/qna/knowledge-base-id")
 
         # Create a VPC (if you don"t already have one)
         public_subnet = ec2.SubnetConfiguration(
@@ -200,6 +206,15 @@ class CourseStack(Stack):
                         point_in_time_recovery=True,
                         removal_policy=RemovalPolicy.DESTROY
         )
+        ######################### Course Build DDB Table  #########################
+        course_build_ddb_table = dynamodb.Table(self, "CourseBuildTable",
+                        partition_key=dynamodb.Attribute(name="buildId", type=dynamodb.AttributeType.STRING),
+                        time_to_live_attribute="ttl",
+                        billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                        encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                        point_in_time_recovery=True,
+                        removal_policy=RemovalPolicy.DESTROY
+        )
         ######################### Cognito User Pool & Application Client #########################
         user_pool = cognito.UserPool(
             self, "CourseUserPool",
@@ -227,8 +242,8 @@ class CourseStack(Stack):
         CfnOutput(self, "UserPoolClientId", export_name="UserPoolClientId", value=user_pool_client.user_pool_client_id)
 
         ######################### Lambda Layers  #########################
-        langchain_core_layer =_alambda.PythonLayerVersion(self, "langchain-core-layer",
-            entry="./lambda/lambda_layer/langchain_core_layer/",
+        pydantic_layer =_alambda.PythonLayerVersion(self, "pydantic-layer",
+            entry="./lambda/lambda_layer/pydantic_layer/",
             compatible_runtimes=[_lambda.Runtime.PYTHON_3_12],
             compatible_architectures=[_lambda.Architecture.ARM_64],
         )
@@ -250,8 +265,32 @@ class CourseStack(Stack):
             compatible_runtimes=[_lambda.Runtime.PYTHON_3_12],
             compatible_architectures=[_lambda.Architecture.ARM_64],
         )
+
+        numpy_layer = _alambda.PythonLayerVersion(self, "numpy-layer",
+            entry="./lambda/lambda_layer/numpy_layer/",
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12],
+            compatible_architectures=[_lambda.Architecture.ARM_64],
+        )
+
+        # shared, connection-reusing boto3 clients (pure python, so usable on both architectures)
+        aws_clients_layer = _alambda.PythonLayerVersion(self, "aws-clients-layer",
+            entry="./lambda/lambda_layer/aws_clients_layer/",
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12],
+            compatible_architectures=[_lambda.Architecture.ARM_64, _lambda.Architecture.X86_64],
+        )
+
+        # pure python modules shared by several lambdas (WebSocket sender, partial JSON parser,
+        # token budget, course outline store, text terms), usable on both architectures
+        common_layer = _alambda.PythonLayerVersion(self, "common-layer",
+            entry="./lambda/lambda_layer/common_layer/",
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12],
+            compatible_architectures=[_lambda.Architecture.ARM_64, _lambda.Architecture.X86_64],
+        )
         CfnOutput(self, "CryptographyLayerArn", export_name="CryptographyLayerArn", value=cryptography_layer.layer_version_arn)
         CfnOutput(self, "PyJWTLayerArn", export_name="PyJWTLayerArn", value=pyJWT_layer.layer_version_arn)
+        CfnOutput(self, "AwsClientsLayerArn", export_name="AwsClientsLayerArn", value=aws_clients_layer.layer_version_arn)
+        CfnOutput(self, "CommonLayerArn", export_name="CommonLayerArn", value=common_layer.layer_version_arn)
+        CfnOutput(self, "NumpyLayerArn", export_name="NumpyLayerArn", value=numpy_layer.layer_version_arn)
 
         ######################### Lambda Functions for WebSocket #########################
         course_ws_connect_lambda = _lambda.Function(
@@ -262,6 +301,7 @@ class CourseStack(Stack):
             memory_size=512,
             timeout=Duration.seconds(30),
             handler="index.lambda_handler",
+            layers=[aws_clients_layer],
             vpc=vpc,
             vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
             environment={
@@ -278,6 +318,7 @@ class CourseStack(Stack):
             memory_size=512,
             timeout=Duration.seconds(30),
             handler="index.lambda_handler",
+            layers=[aws_clients_layer],
             vpc=vpc,
             vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
             environment={
@@ -294,6 +335,7 @@ class CourseStack(Stack):
             memory_size=512,
             timeout=Duration.seconds(30),
             handler="index.lambda_handler",
+            layers=[aws_clients_layer],
             vpc=vpc,
             vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
             environment={
@@ -385,10 +427,12 @@ class CourseStack(Stack):
                                 memory_size=512,
                                 timeout=Duration.seconds(30),
                                 handler="index.lambda_handler",
+                                layers=[aws_clients_layer],
                                 vpc=vpc,
                                 vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
                                 environment={
                                     "OUTLINE_QUEUE_URL":outline_queue.queue_url,
+                                    "SQS_DELAY_SECONDS":"0", # Delay before the outline request becomes visible to the LLM lambda
                                 }
                             )
         outline_queue.grant_send_messages(course_outline_ws_lambda)
@@ -402,11 +446,12 @@ class CourseStack(Stack):
                                 memory_size=512,
                                 timeout=Duration.minutes(3),
                                 handler="index.lambda_handler",
-                                layers=[langchain_core_layer, pypdf2_layer],
+                                layers=[pydantic_layer, pypdf2_layer, aws_clients_layer, common_layer],
                                 vpc=vpc,
                                 vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
                                 environment={
                                     "MODEL_ID":model_id,
+                                    "CONDENSE_MODEL_ID":condense_model_id,
                                     "OUTPUT_BUCKET":output_bucket_s3.bucket_name,
                                 }
                             )
@@ -419,14 +464,16 @@ class CourseStack(Stack):
             actions=["bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream"],
             resources=[f"arn:aws:bedrock:{self.region}::foundation-model/anthropic.claude-3-5-haiku*:0",
                        f"arn:aws:bedrock:{self.region}::foundation-model/anthropic.claude-3-5-sonnet*:0",
+                       f"arn:aws:bedrock:{self.region}::foundation-model/{condense_model_id}",
                        ]
         )
         course_outline_llm_lambda.add_to_role_policy(haiku_sonnet_bedrock_policy_statement)
 
         # This event will be triggered by SQS when a new message is received
         invoke_event_outline = lambda_event_sources.SqsEventSource(outline_queue, 
-                                                                   batch_size=1, 
-                                                                   max_batching_window=Duration.seconds(0)
+                                                                   batch_size=5, 
+                                                                   max_batching_window=Duration.seconds(0),
+                                                                   report_batch_item_failures=True, # Only failed messages are redriven to the DLQ
                                                                    )
         course_outline_llm_lambda.add_event_source(invoke_event_outline)
 
@@ -440,10 +487,12 @@ class CourseStack(Stack):
                                 memory_size=512,
                                 timeout=Duration.minutes(1),
                                 handler="index.lambda_handler",
+                                layers=[aws_clients_layer],
                                 vpc=vpc,
                                 vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
                                 environment={
                                      "CONTENT_QUEUE_URL":content_queue.queue_url,
+                                     "SQS_DELAY_SECONDS":"0", # Delay before the content request becomes visible to the LLM lambda
                                 }
                             )
         content_queue.grant_send_messages(course_content_ws_lambda)
@@ -457,17 +506,21 @@ class CourseStack(Stack):
                                 memory_size=512,
                                 timeout=Duration.minutes(3),
                                 handler="index.lambda_handler",
-                                layers=[langchain_core_layer, pypdf2_layer],
+                                layers=[pydantic_layer, pypdf2_layer, aws_clients_layer, common_layer, numpy_layer],
                                 vpc=vpc,
                                 vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
                                 environment={
                                     "MODEL_ID":model_id,
                                     "OUTPUT_BUCKET":output_bucket_s3.bucket_name,
+                                    "BUILD_TABLE":course_build_ddb_table.table_name,
+                                    "ENABLE_PROMPT_CACHING":str(enable_prompt_caching).lower(),
+                                    "KB_ID_PARAMETER":knowledge_base_id_parameter,
                                 }
                             )
         input_bucket_s3.grant_read_write(course_content_llm_lambda)
         output_bucket_s3.grant_read_write(course_content_llm_lambda)
         course_connections_ddb_table.grant_read_write_data(course_content_llm_lambda)
+        course_build_ddb_table.grant_read_write_data(course_content_llm_lambda)
         content_queue.grant_consume_messages(course_content_llm_lambda)
         haiku_sonnet_bedrock_policy_statement = iam.PolicyStatement(
             effect=iam.Effect.ALLOW,
@@ -477,14 +530,89 @@ class CourseStack(Stack):
                        ]
         )
         course_content_llm_lambda.add_to_role_policy(haiku_sonnet_bedrock_policy_statement)
+        # context_source "knowledge_base": the knowledge base is created by the QnA stack, deployed after this one
+        kb_context_policy_statement = iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["ssm:GetParameter"],
+            resources=[f"arn:aws:ssm:{self.region}:{self.account}:parameter/{knowledge_base_id_parameter.lstrip('/')}"],
+        )
+        kb_retrieve_policy_statement = iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["bedrock:Retrieve"],
+            resources=[f"arn:aws:bedrock:{self.region}:{self.account}:knowledge-base/*"],
+        )
+        course_content_llm_lambda.add_to_role_policy(kb_context_policy_statement)
+        course_content_llm_lambda.add_to_role_policy(kb_retrieve_policy_statement)
 
         # This event will be triggered by SQS when a new message is received
         invoke_event_content = lambda_event_sources.SqsEventSource(content_queue, 
-                                                                   batch_size=1, 
-                                                                   max_batching_window=Duration.seconds(0)
+                                                                   batch_size=5, 
+                                                                   max_batching_window=Duration.seconds(0),
+                                                                   report_batch_item_failures=True, # Only failed messages are redriven to the DLQ
+                                                                   max_concurrency=10, # Bounds Bedrock calls when a whole course build is enqueued
                                                                    )
         course_content_llm_lambda.add_event_source(invoke_event_content)
 
+        ########################## Course Batch Inference Lambda #########################
+        # Role assumed by Bedrock to read batch input and write batch output
+        batch_inference_role = iam.Role(self, "BatchInferenceRole",
+                                        assumed_by=iam.ServicePrincipal("bedrock.amazonaws.com"),
+                                        )
+        output_bucket_s3.grant_read_write(batch_inference_role)
+        batch_inference_role.add_to_policy(haiku_sonnet_bedrock_policy_statement)
+
+        course_batch_llm_lambda = _lambda.Function(self, 
+                                "course_batch_llm_lambda",
+                                code=_lambda.Code.from_asset("./lambda/course_content_llm"),
+                                runtime=_lambda.Runtime.PYTHON_3_12,
+                                architecture=_lambda.Architecture.ARM_64,
+                                memory_size=512,
+                                timeout=Duration.minutes(15),
+                                handler="batch_inference.lambda_handler",
+                                layers=[pydantic_layer, pypdf2_layer, aws_clients_layer, common_layer, numpy_layer],
+                                vpc=vpc,
+                                vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
+                                environment={
+                                    "MODEL_ID":model_id,
+                                    "OUTPUT_BUCKET":output_bucket_s3.bucket_name,
+                                    "BATCH_ROLE_ARN":batch_inference_role.role_arn,
+                                }
+                            )
+        input_bucket_s3.grant_read(course_batch_llm_lambda)
+        output_bucket_s3.grant_read_write(course_batch_llm_lambda)
+        batch_inference_role.grant_pass_role(course_batch_llm_lambda)
+        course_batch_llm_lambda.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["bedrock:CreateModelInvocationJob", "bedrock:GetModelInvocationJob"],
+            resources=[f"arn:aws:bedrock:{self.region}::foundation-model/anthropic.claude-3-5-haiku*:0",
+                       f"arn:aws:bedrock:{self.region}::foundation-model/anthropic.claude-3-5-sonnet*:0",
+                       f"arn:aws:bedrock:{self.region}:{self.account}:model-invocation-job/*",
+                       ]
+        ))
+
+        ########################## Course Build Lambda #########################
+        course_build_ws_lambda = _lambda.Function(self, 
+                                "course_build_ws_lambda",
+                                code=_lambda.Code.from_asset("./lambda/course_build_ws"),
+                                runtime=_lambda.Runtime.PYTHON_3_12,
+                                architecture=_lambda.Architecture.ARM_64,
+                                memory_size=512,
+                                timeout=Duration.minutes(1),
+                                handler="index.lambda_handler",
+                                layers=[aws_clients_layer, common_layer],
+                                vpc=vpc,
+                                vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
+                                environment={
+                                     "CONTENT_QUEUE_URL":content_queue.queue_url,
+                                     "OUTPUT_BUCKET":output_bucket_s3.bucket_name,
+                                     "BUILD_TABLE":course_build_ddb_table.table_name,
+                                }
+                            )
+        content_queue.grant_send_messages(course_build_ws_lambda)
+        kms_key.grant_encrypt_decrypt(course_build_ws_lambda)
+        output_bucket_s3.grant_read(course_build_ws_lambda)
+        course_build_ddb_table.grant_read_write_data(course_build_ws_lambda)
+
         ######################### COURSE WEB SOCKET #########################
         course_ws_authorizer = authorizersv2.WebSocketLambdaAuthorizer("CourseWSAuthorizer", jwt_auth_course_lambda, identity_source=["route.request.header.Authorization",]) # "route.request.querystring.Authorization", 
         course_ws_connect_integration = integrationsv2.WebSocketLambdaIntegration("CourseWSConnectIntegration", course_ws_connect_lambda)
@@ -492,6 +620,7 @@ class CourseStack(Stack):
         course_ws_default_integration = integrationsv2.WebSocketLambdaIntegration("CourseWSDefaultIntegration", course_ws_default_lambda)
         course_outline_ws_integration = integrationsv2.WebSocketLambdaIntegration("CourseOutlineIntegration", course_outline_ws_lambda)
         course_content_ws_integration = integrationsv2.WebSocketLambdaIntegration("CourseContentIntegration", course_content_ws_lambda)
+        course_build_ws_integration = integrationsv2.WebSocketLambdaIntegration("CourseBuildIntegration", course_build_ws_lambda)
 
         course_ws_api=apigwv2.WebSocketApi(self, "CourseWSApi",
             api_name="CourseWSApi",
@@ -519,6 +648,11 @@ class CourseStack(Stack):
                                 integration=course_content_ws_integration,
                                 # return_response=True, # If true this will return lambda response in via websocket
                                 )
+
+        # Add a custom message route, to generate course content for every week of a saved outline
+        course_ws_api.add_route("courseBuild",
+                                integration=course_build_ws_integration,
+                                )
         
         # Create a WebSocket API stage (usually, "dev" or "prod")
         course_ws_stage = apigwv2.WebSocketStage(
@@ -536,6 +670,8 @@ class CourseStack(Stack):
         course_content_ws_lambda.add_environment("WEBSOCKET_ENDPOINT_URL", ws_endpoint_url)
         course_content_llm_lambda.add_environment("WEBSOCKET_ENDPOINT_URL", ws_endpoint_url)
 
+        course_build_ws_lambda.add_environment("WEBSOCKET_ENDPOINT_URL", ws_endpoint_url)
+
         jwt_auth_course_lambda.add_environment("WEBSOCKET_API_ID", course_ws_api.api_id)
 
         ######################### Permissions #########################
@@ -547,6 +683,7 @@ class CourseStack(Stack):
         course_ws_api.grant_manage_connections(course_outline_llm_lambda)
         course_ws_api.grant_manage_connections(course_content_ws_lambda)
         course_ws_api.grant_manage_connections(course_content_llm_lambda)
+        course_ws_api.grant_manage_connections(course_build_ws_lambda)
 
         ######################### Outputs #########################
         CfnOutput(self, "CourseWSApiId", export_name="CourseWSApiId",  value=course_ws_api.api_id)
@@ -594,6 +731,9 @@ class CourseStack(Stack):
                                                    course_outline_llm_lambda.role, 
                                                    course_content_ws_lambda.role, 
                                                    course_content_llm_lambda.role,
+                                                   course_build_ws_lambda.role,
+                                                   course_batch_llm_lambda.role,
+                                                   batch_inference_role,
                                                    jwt_auth_course_lambda.role],
                             suppressions=[{
                                                 "id": "AwsSolutions-IAM4",
@@ -21,6 +21,7 @@ from aws_cdk import (
     aws_opensearchserverless as aoss,
     aws_s3_deployment as s3_deployment,
     aws_s3_notifications as s3n,
+    aws_ssm as ssm,
     custom_resources,
     aws_cloudfront as cloudfront,
     aws_cloudfront_origins as origins,
@@ -38,6 +39,8 @@ class QnAStack(Stack):
             variables = json.load(file)
         
         qna_model_id = variables["qna_model_id"]
+        # read by the course content lambda, which is deployed before this stack
+        knowledge_base_id_parameter = variables.get("knowledge_base_id_parameter", "/course-content-generator/qna/knowledge-base-id")
 
         ######################### Imports  #########################
         # Import the existing user pool
@@ -66,6 +69,24 @@ class QnAStack(Stack):
         pyJWT_layer = _lambda.LayerVersion.from_layer_version_arn(
             self, "ImportedPyJWTLayer", pyJWT_layer_arn
         )
+
+        # Import the existing shared boto3 clients layer
+        aws_clients_layer_arn = Fn.import_value("AwsClientsLayerArn")
+        aws_clients_layer = _lambda.LayerVersion.from_layer_version_arn(
+            self, "ImportedAwsClientsLayer", aws_clients_layer_arn
+        )
+
+        # Import the existing layer of shared python modules
+        common_layer_arn = Fn.import_value("CommonLayerArn")
+        common_layer = _lambda.LayerVersion.from_layer_version_arn(
+            self, "ImportedCommonLayer", common_layer_arn
+        )
+
+        # Import the existing numpy layer
+        numpy_layer_arn = Fn.import_value("NumpyLayerArn")
+        numpy_layer = _lambda.LayerVersion.from_layer_version_arn(
+            self, "ImportedNumpyLayer", numpy_layer_arn
+        )
         
         ######################### QnA Connection DDB Table  #########################
         qna_connections_ddb_table = dynamodb.Table(self, "QnAConnectionsTable",
@@ -77,6 +98,29 @@ class QnAStack(Stack):
                         removal_policy= RemovalPolicy.DESTROY
         )
 
+        ######################### QnA Cache DDB Table  #########################
+        # cached answers, partitioned by namespace, knowledge base generation, course and week
+        qna_cache_ddb_table = dynamodb.Table(self, "QnACacheTable",
+                        partition_key=dynamodb.Attribute(name="scope", type=dynamodb.AttributeType.STRING),
+                        sort_key=dynamodb.Attribute(name="key_hash", type=dynamodb.AttributeType.STRING),
+                        time_to_live_attribute="ttl",
+                        billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                        encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                        point_in_time_recovery=True,
+                        removal_policy= RemovalPolicy.DESTROY
+        )
+
+        ######################### QnA Sessions DDB Table  #########################
+        # recent turns of two stage QnA sessions
+        qna_sessions_ddb_table = dynamodb.Table(self, "QnASessionsTable",
+                        partition_key=dynamodb.Attribute(name="sessionId", type=dynamodb.AttributeType.STRING),
+                        time_to_live_attribute="ttl",
+                        billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                        encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                        point_in_time_recovery=True,
+                        removal_policy= RemovalPolicy.DESTROY
+        )
+
         ######################### Lambda Functions for WebSocket #########################
         ######## Connect WebSocket Lambda
         qna_ws_connect_lambda = _lambda.Function(
@@ -85,6 +129,7 @@ class QnAStack(Stack):
             runtime=_lambda.Runtime.PYTHON_3_12,
             handler="index.lambda_handler",
             timeout=Duration.seconds(30),
+            layers=[aws_clients_layer],
             environment={
                 "CONNECTIONS_TABLE": qna_connections_ddb_table.table_name
             },
@@ -98,6 +143,7 @@ class QnAStack(Stack):
             runtime=_lambda.Runtime.PYTHON_3_12,
             handler="index.lambda_handler",
             timeout=Duration.seconds(30),
+            layers=[aws_clients_layer],
             environment={
                 "CONNECTIONS_TABLE": qna_connections_ddb_table.table_name
             },
@@ -111,6 +157,7 @@ class QnAStack(Stack):
             runtime=_lambda.Runtime.PYTHON_3_12,
             handler="index.lambda_handler",
             timeout=Duration.seconds(30),
+            layers=[aws_clients_layer],
             environment={
                 "CONNECTIONS_TABLE": qna_connections_ddb_table.table_name
             },
@@ -136,6 +183,13 @@ class QnAStack(Stack):
                             )
 
         ######## QnA Bot Lambda
+        # retrieve_and_generate_stream needs a newer boto3 than the one bundled with the runtime
+        boto3_layer =_alambda.PythonLayerVersion(self, "boto3-layer",
+            entry = "./lambda/lambda_layer/boto3_layer/",
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12],
+            compatible_architectures=[_lambda.Architecture.ARM_64],
+        )
+
         qna_bot_lambda = _lambda.Function(self, 
                         "qna_bot_lambda",
                         code=_lambda.Code.from_asset("./lambda/qna_bot"),
@@ -144,6 +198,7 @@ class QnAStack(Stack):
                         memory_size=512,
                         timeout=Duration.minutes(1),
                         handler="index.lambda_handler",
+                        layers=[boto3_layer, aws_clients_layer, common_layer, numpy_layer],
                     )
         
         ######################### QnA WEB SOCKET #########################
@@ -433,10 +488,13 @@ class QnAStack(Stack):
                         memory_size=512,
                         timeout=Duration.minutes(1),
                         handler="index.lambda_handler",
+                        layers=[aws_clients_layer],
                         environment={"KNOWLEDGE_BASE_ID": knowledge_base.attr_knowledge_base_id,
-                                     "DATA_SOURCE_ID" :kb_data_source.attr_data_source_id
+                                     "DATA_SOURCE_ID" :kb_data_source.attr_data_source_id,
+                                     "QNA_CACHE_TABLE": qna_cache_ddb_table.table_name,
                                      }
                     )
+        qna_cache_ddb_table.grant_write_data(kb_sync_lambda)
         kb_synch_policy_statement = iam.PolicyStatement(
             effect=iam.Effect.ALLOW,
             actions=["bedrock:StartIngestionJob"],
@@ -582,11 +640,22 @@ class QnAStack(Stack):
             description="QnA Bot guardrail version",
         )
 
+        # Publish the knowledge base id so course content generation can ground itself on it
+        ssm.StringParameter(self, "KnowledgeBaseIdParameter",
+                            parameter_name=knowledge_base_id_parameter,
+                            string_value=knowledge_base.attr_knowledge_base_id,
+                            description="Id of the QnA knowledge base used for course content generation")
+
         ######################### QnA Bot Lambda KB configuration #########################
         qna_bot_lambda.add_environment("KB_ID", knowledge_base.attr_knowledge_base_id)
         qna_bot_lambda.add_environment("QnA_MODEL_ID", qna_model_id)
         qna_bot_lambda.add_environment("GUARDRAIL_ID", qna_bot_guardrail.attr_guardrail_id)
         qna_bot_lambda.add_environment("GUARDRAIL_VERSION", qna_bot_guardrail_version.attr_version)
+        qna_bot_lambda.add_environment("QNA_CACHE_TABLE", qna_cache_ddb_table.table_name)
+        qna_bot_lambda.add_environment("ANSWER_CACHE_EMBEDDING_MODEL_ID", embeddings_model_id)
+        qna_cache_ddb_table.grant_read_write_data(qna_bot_lambda)
+        qna_bot_lambda.add_environment("QNA_SESSIONS_TABLE", qna_sessions_ddb_table.table_name)
+        qna_sessions_ddb_table.grant_read_write_data(qna_bot_lambda)
 
         haiku_sonnet_bedrock_policy_statement = iam.PolicyStatement(
             effect=iam.Effect.ALLOW,
@@ -598,7 +667,8 @@ class QnAStack(Stack):
         )
         kb_retrive_generate_policy_statement = iam.PolicyStatement(
             effect=iam.Effect.ALLOW,
-            actions=["bedrock:Retrieve", "bedrock:RetrieveAndGenerate"],
+            # GetIngestionJob lets the QnA caches notice when a knowledge base sync has finished
+            actions=["bedrock:Retrieve", "bedrock:RetrieveAndGenerate", "bedrock:GetIngestionJob"],
             resources=[knowledge_base.attr_knowledge_base_arn],
         )
         guardrail_policy_statement = iam.PolicyStatement(
@@ -607,7 +677,14 @@ class QnAStack(Stack):
         )
         qna_bot_lambda.add_to_role_policy(haiku_sonnet_bedrock_policy_statement)
         qna_bot_lambda.add_to_role_policy(kb_retrive_generate_policy_statement)
+        # embeddings for the similarity tier of the answer cache
+        qna_bot_embeddings_policy_statement = iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["bedrock:InvokeModel"],
+            resources=[embeddings_model_arn],
+        )
         qna_bot_lambda.add_to_role_policy(guardrail_policy_statement)
+        qna_bot_lambda.add_to_role_policy(qna_bot_embeddings_policy_statement)
 
 
         ######################### CDK Nag Suppression #########################
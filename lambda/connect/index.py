@@ -3,10 +3,10 @@
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
 import os
 import json
-import boto3
+from aws_clients import get_client
 from datetime import datetime, timedelta, timezone
 
-dynamodb = boto3.client('dynamodb')
+dynamodb = get_client('dynamodb')
 
 
 def lambda_handler(event, context):
@@ -0,0 +1,82 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+import json
+from aws_clients import get_client
+from course_outline_store import load_course_outline
+from datetime import datetime, timedelta, timezone
+
+sqs_client = get_client("sqs")
+dynamodb = get_client("dynamodb")
+
+# maximum number of entries accepted by a single SendMessageBatch call
+SQS_MAX_BATCH_ENTRIES = 10
+
+def send_message_to_client(apigatewaymanagementapi_client, connection_id, response):
+        apigatewaymanagementapi_client.post_to_connection(ConnectionId=connection_id, 
+                                                          Data=json.dumps(response).encode('utf-8'))
+
+def get_course_content_jobs(course_title, course_outline, body):
+    """Build one courseContent request body per (week, main learning outcome) of the outline.
+    Jobs never stream: their content is generated concurrently on one connection, where the
+    client could not tell which week a fragment belongs to."""
+    jobs = []
+    for weekly_outline in course_outline["weekly_outline"]:
+        for main_outcome in weekly_outline["main_outcomes"]:
+            jobs.append({
+                "s3_input_uri_list": body.get("s3_input_uri_list", []),
+                "user_prompt": body["user_prompt"],
+                "week_number": weekly_outline["week"],
+                "course_title": course_title,
+                "main_learning_outcome": main_outcome["outcome"],
+                "sub_learning_outcome_list": main_outcome["sub_outcomes"],
+                "is_streaming": "no",
+                "generation_mode": body.get("generation_mode", "single"),
+                "context_source": body.get("context_source", "pdf"),
+                "course_id": body.get("course_id", ""),
+            })
+    return jobs
+
+def create_build(table_name, build_id, connection_id, course_title, total_jobs):
+    ttl = int((datetime.now(timezone.utc) + timedelta(days=1)).timestamp())
+    dynamodb.put_item(
+        TableName=table_name,
+        Item={
+            'buildId': {'S': build_id},
+            'connectionId': {'S': connection_id},
+            'courseTitle': {'S': course_title},
+            'total': {'N': str(total_jobs)},
+            'completed': {'N': '0'},
+            'failed': {'N': '0'},
+            'ttl': {'N': str(ttl)}
+        }
+    )
+
+def add_build_failures(table_name, build_id, failed_jobs):
+    dynamodb.update_item(
+        TableName=table_name,
+        Key={'buildId': {'S': build_id}},
+        UpdateExpression="ADD failed :failed",
+        ExpressionAttributeValues={':failed': {'N': str(failed_jobs)}}
+    )
+
+def send_jobs_to_sqs(queue_url, connection_id, build_id, jobs):
+    """Enqueue every job in batches, shaped like the courseContent WebSocket event.
+    Returns the entries SQS failed to accept."""
+    entries = []
+    for index, job in enumerate(jobs):
+        event = {
+            "requestContext": {"connectionId": connection_id},
+            "body": json.dumps({**job, "build_id": build_id}),
+        }
+        entries.append({"Id": str(index), "MessageBody": json.dumps(event)})
+
+    failed = []
+    for start in range(0, len(entries), SQS_MAX_BATCH_ENTRIES):
+        response = sqs_client.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=entries[start:start + SQS_MAX_BATCH_ENTRIES]
+        )
+        failed.extend(response.get('Failed', []))
+    print(f"Enqueued {len(entries) - len(failed)} of {len(entries)} course content jobs for build {build_id}")
+    return failed
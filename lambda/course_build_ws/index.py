@@ -0,0 +1,79 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+import json
+import uuid
+from botocore.exceptions import ClientError
+from helper import * 
+import os
+
+def lambda_handler(event, context):
+    print(event)
+    try:
+        connection_id = event['requestContext']['connectionId']
+        body = json.loads(event["body"])
+        course_title = body["course_title"]
+        websocket_endpoint_url = os.getenv("WEBSOCKET_ENDPOINT_URL", "")
+        content_queue_url = os.environ["CONTENT_QUEUE_URL"]
+        output_bucket = os.environ["OUTPUT_BUCKET"]
+        build_table = os.environ["BUILD_TABLE"]
+
+    except:
+        print("dev mode activated")
+        connection_id = ""
+        body = {"user_prompt": ""}
+        course_title = ""
+        websocket_endpoint_url = ""
+        content_queue_url = ""
+        output_bucket = ""
+        build_table = ""
+
+    apigatewaymanagementapi_client = get_client('apigatewaymanagementapi', endpoint_url=websocket_endpoint_url)
+
+    if not body.get("user_prompt"):
+        response = {'message': "user_prompt is required to build a course"}
+        send_message_to_client(apigatewaymanagementapi_client, connection_id, response=response)
+        return {"statusCode": 400,
+                "body": json.dumps({'course_build': response})
+            }
+
+    try:
+        course_outline = load_course_outline(output_bucket, course_title)
+    except ClientError as e:
+        print(f"Unable to load course outline: {e}")
+        response = {'message': f"No saved course outline found for {course_title}"}
+        send_message_to_client(apigatewaymanagementapi_client, connection_id, response=response)
+        return {"statusCode": 404,
+                "body": json.dumps({'course_build': response})
+            }
+
+    if not course_outline.get("weekly_outline"):
+        response = {'message': f"The saved course outline for {course_title} has no weekly outline, generate it again"}
+        send_message_to_client(apigatewaymanagementapi_client, connection_id, response=response)
+        return {"statusCode": 422,
+                "body": json.dumps({'course_build': response})
+            }
+
+    build_id = str(uuid.uuid4())
+    jobs = get_course_content_jobs(course_title, course_outline, body)
+    create_build(build_table, build_id, connection_id, course_title, len(jobs))
+    failed = send_jobs_to_sqs(content_queue_url, connection_id, build_id, jobs)
+    if failed:
+        add_build_failures(build_table, build_id, len(failed))
+
+    response = {"connection_id": connection_id,
+                "build_id": build_id,
+                "course_title": course_title,
+                "total_jobs": len(jobs),
+                "failed_to_enqueue": len(failed),
+                "message": "Course build received and is in processing"}
+    send_message_to_client(apigatewaymanagementapi_client, connection_id, response=response)
+
+    return {"statusCode": 200,
+            "body": json.dumps({'course_build': response})
+        }
+
+
+if __name__ == "__main__":
+    event = None
+    lambda_handler(event, None)
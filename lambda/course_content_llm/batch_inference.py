@@ -0,0 +1,167 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Offline course content generation with Amazon Bedrock Batch Inference.
+
+The same system prompt, user message and tool configuration used by the on-demand
+converse path are rendered into a JSONL file of InvokeModel requests, submitted as a
+model invocation job, and the job output is parsed with parse_bedrock_tool_response
+into the usual course_content/{title}/{week}/{outcome}/ layout.
+
+Invoke the lambda directly (CLI, console or a schedule) with either
+    {"operation": "submit", "user_prompt": "...", "courses": [{"course_title": "...", "s3_input_uri_list": []}]}
+or
+    {"operation": "collect", "job_arn": "arn:aws:bedrock:..."}
+"""
+import json
+import os
+import time
+from helper import *
+from CourseContentPydantic import CourseContent
+from context_selection import select_relevant_context
+from course_outline_store import load_course_outline
+
+ANTHROPIC_VERSION = "bedrock-2023-05-31"
+BATCH_PREFIX = "batch_inference"
+
+
+def to_anthropic_tools(tool_config):
+    """Convert a converse toolConfig into the tools list of the Anthropic messages API"""
+    return [{"name": tool["toolSpec"]["name"],
+             "description": tool["toolSpec"]["description"],
+             "input_schema": tool["toolSpec"]["inputSchema"]["json"]}
+            for tool in tool_config["tools"]]
+
+
+def build_batch_record(record_id, model_id, course_title, week_number, main_learning_outcome,
+                       sub_learning_outcome_list, additional_context, user_prompt, pydantic_classes):
+    """Render one course content request as a batch inference JSONL record,
+    with max_tokens sized like the on-demand request and capped at what model_id can generate"""
+    user_msg = format_user_message(user_prompt, course_title, week_number, main_learning_outcome,
+                                   sub_learning_outcome_list, additional_context)
+    return {
+        "recordId": record_id,
+        "modelInput": {
+            "anthropic_version": ANTHROPIC_VERSION,
+            "max_tokens": get_content_max_tokens(model_id, pydantic_classes, sub_learning_outcome_list),
+            "system": SYSTEM_PROMPT,
+            "messages": [{"role": "user",
+                          "content": [{"type": "text", "text": user_msg}]}],
+            "tools": to_anthropic_tools(get_tool_config(pydantic_classes)),
+        }
+    }
+
+
+def to_converse_response(model_output):
+    """Reshape an Anthropic messages API response into the converse response shape"""
+    content = []
+    for block in model_output.get("content", []):
+        if block["type"] == "tool_use":
+            content.append({"toolUse": {"toolUseId": block["id"],
+                                        "name": block["name"],
+                                        "input": block["input"]}})
+        elif block["type"] == "text":
+            content.append({"text": block["text"]})
+    return {"stopReason": model_output.get("stop_reason", ""),
+            "output": {"message": {"role": model_output.get("role", "assistant"),
+                                   "content": content}}}
+
+
+def parse_batch_output_line(line):
+    """Parse one line of a batch job's .jsonl.out file.
+    Returns the record id and the parsed tool output, empty when the record failed."""
+    record = json.loads(line)
+    if "modelOutput" not in record:
+        print(f"Record {record.get('recordId')} failed: {record.get('error')}")
+        return record.get("recordId"), {}
+    return record["recordId"], parse_bedrock_tool_response(to_converse_response(record["modelOutput"]))
+
+
+def submit_batch_job(model_id, output_bucket, role_arn, courses, user_prompt):
+    pydantic_classes = [CourseContent]
+    job_name = f"course-content-{int(time.time())}"
+    job_prefix = f"{BATCH_PREFIX}/{job_name}"
+
+    records = []
+    manifest = {}
+    for course in courses:
+        course_title = course["course_title"]
+        course_outline = load_course_outline(output_bucket, course_title)
+        additional_context = extract_text_from_pdfs(course.get("s3_input_uri_list", []), cache_bucket=output_bucket)
+        for weekly_outline in course_outline["weekly_outline"]:
+            for main_outcome in weekly_outline["main_outcomes"]:
+                record_id = f"{len(records):011d}"
+                outcome_context = select_relevant_context(additional_context, main_outcome["outcome"],
+                                                          main_outcome["sub_outcomes"])
+                records.append(build_batch_record(record_id, model_id, course_title, weekly_outline["week"],
+                                                  main_outcome["outcome"], main_outcome["sub_outcomes"],
+                                                  outcome_context, user_prompt, pydantic_classes))
+                manifest[record_id] = {"course_title": course_title,
+                                       "week_number": weekly_outline["week"],
+                                       "main_learning_outcome": main_outcome["outcome"]}
+
+    input_key = f"{job_prefix}/input/records.jsonl"
+    s3_client.put_object(Bucket=output_bucket, Key=input_key,
+                         Body="\n".join(json.dumps(record) for record in records).encode('utf-8'))
+    save_json_to_s3(output_bucket, f"{job_prefix}/manifest.json", manifest)
+
+    response = bedrock_client.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=model_id,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{output_bucket}/{input_key}"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{output_bucket}/{job_prefix}/output/"}},
+    )
+    print(f"Submitted batch job {response['jobArn']} with {len(records)} records")
+    return {"job_arn": response["jobArn"], "job_name": job_name, "records": len(records)}
+
+
+def collect_batch_job(job_arn):
+    job = bedrock_client.get_model_invocation_job(jobIdentifier=job_arn)
+    status = job["status"]
+    if status not in ("Completed", "PartiallyCompleted"):
+        return {"job_arn": job_arn, "status": status}
+
+    output_bucket, output_prefix = get_s3_bucket_and_key(job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"])
+    manifest_key = f"{BATCH_PREFIX}/{job['jobName']}/manifest.json"
+    manifest = json.loads(s3_client.get_object(Bucket=output_bucket, Key=manifest_key)['Body'].read())
+
+    saved, failed = 0, 0
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=output_bucket, Prefix=output_prefix):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith(".jsonl.out"):
+                continue
+            body = s3_client.get_object(Bucket=output_bucket, Key=obj["Key"])['Body']
+            for line in body.iter_lines():
+                if not line:
+                    continue
+                record_id, course_content = parse_batch_output_line(line)
+                if not course_content or record_id not in manifest:
+                    failed += 1
+                    continue
+                item = manifest[record_id]
+                output_key = f"course_content/{item['course_title']}/{item['week_number']}/{item['main_learning_outcome']}/course_content.json"
+                save_json_to_s3(output_bucket, output_key, course_content)
+                saved += 1
+
+    print(f"Batch job {job_arn}: saved {saved} course content items, {failed} failed")
+    return {"job_arn": job_arn, "status": status, "saved": saved, "failed": failed}
+
+
+def lambda_handler(event, context):
+    print(event)
+    model_id = os.getenv("MODEL_ID", "")
+    output_bucket = os.getenv("OUTPUT_BUCKET", "")
+    role_arn = os.getenv("BATCH_ROLE_ARN", "")
+
+    if event["operation"] == "submit":
+        result = submit_batch_job(model_id, output_bucket, role_arn, event["courses"], event["user_prompt"])
+    elif event["operation"] == "collect":
+        result = collect_batch_job(event["job_arn"])
+    else:
+        return {'statusCode': 400, 'body': f"Unrecognized operation {event['operation']}"}
+
+    return {'statusCode': 200,
+            'body': json.dumps(result)
+        }
@@ -0,0 +1,146 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Selection of the additional context passages relevant to one week's learning outcomes.
+
+The extracted PDF text of a course is split into passages and indexed with BM25 once per
+document set. Each content request then keeps only the best scoring passages for its main
+and sub-learning outcomes, within a token budget. NumPy is only imported once a document
+set actually needs to be reduced, so it does not add to every cold start.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from token_budget import estimate_tokens, CHARS_PER_TOKEN
+from text_terms import tokenize
+
+# additional context above this estimated size is reduced to the relevant passages
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 8000))
+CONTEXT_PASSAGE_TOKENS = int(os.getenv("CONTEXT_PASSAGE_TOKENS", 300))
+CONTEXT_TOP_K = int(os.getenv("CONTEXT_TOP_K", 30))
+# number of document sets whose index is kept by a lambda environment
+INDEX_CACHE_SIZE = 4
+
+# shared by the threads processing an SQS batch
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def split_passages(text, max_tokens):
+    """Split text into passages of whole paragraphs (or lines) of at most max_tokens each"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    passages, current, current_chars = [], [], 0
+    for paragraph in re.split(r"\n\s*\n|\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and current_chars + len(paragraph) > max_chars:
+            passages.append("\n".join(current))
+            current, current_chars = [], 0
+        current.append(paragraph)
+        current_chars += len(paragraph)
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+class BM25Index:
+    """Okapi BM25 over passages, stored as flat (passage, term, count) arrays so a query only
+    touches the postings of its own terms."""
+
+    def __init__(self, passages, k1=1.5, b=0.75):
+        import numpy as np
+        self.passages = passages
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        passage_ids, term_ids, counts = [], [], []
+        lengths = np.zeros(len(passages), dtype=np.float32)
+        for passage_id, passage in enumerate(passages):
+            tokens = tokenize(passage)
+            lengths[passage_id] = len(tokens)
+            for term, count in Counter(tokens).items():
+                passage_ids.append(passage_id)
+                term_ids.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                counts.append(count)
+        self.passage_ids = np.asarray(passage_ids, dtype=np.int32)
+        self.term_ids = np.asarray(term_ids, dtype=np.int32)
+        self.counts = np.asarray(counts, dtype=np.float32)
+        self.length_norm = 1 - b + b * lengths / max(float(lengths.mean()) if len(lengths) else 0.0, 1.0)
+        document_frequency = np.bincount(self.term_ids, minlength=len(self.vocabulary)).astype(np.float32)
+        self.idf = np.log(1 + (len(passages) - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def scores(self, query):
+        import numpy as np
+        query_terms = np.asarray(sorted({self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary}),
+                                 dtype=np.int32)
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        if not len(query_terms):
+            return scores
+        postings = np.isin(self.term_ids, query_terms)
+        passage_ids, term_ids, counts = self.passage_ids[postings], self.term_ids[postings], self.counts[postings]
+        weights = self.idf[term_ids] * counts * (self.k1 + 1) / (counts + self.k1 * self.length_norm[passage_ids])
+        np.add.at(scores, passage_ids, weights)
+        return scores
+
+
+def get_index(text):
+    """BM25 index of the text, built once per document set and lambda environment"""
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+    # built outside the lock, two threads missing the same text at once both build it
+    index = BM25Index(split_passages(text, CONTEXT_PASSAGE_TOKENS))
+    with _indexes_lock:
+        _indexes[key] = index
+        if len(_indexes) > INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
+
+
+def leading_passages(passages, token_budget):
+    """Indexes of the passages from the start of the document that fit in token_budget"""
+    selected, used_tokens = [], 0
+    for passage_id, passage in enumerate(passages):
+        tokens = estimate_tokens(passage)
+        if used_tokens + tokens > token_budget:
+            break
+        selected.append(passage_id)
+        used_tokens += tokens
+    return selected, used_tokens
+
+
+def select_relevant_context(additional_context, main_learning_outcome, sub_learning_outcome_list,
+                            token_budget=CONTEXT_TOKEN_BUDGET, top_k=CONTEXT_TOP_K):
+    """Return additional_context unchanged when it fits in token_budget, otherwise the passages most
+    relevant to the learning outcomes, in document order, within token_budget. When no passage
+    shares a term with the outcomes, the leading passages are kept instead."""
+    if estimate_tokens(additional_context) <= token_budget:
+        return additional_context
+
+    import numpy as np
+    index = get_index(additional_context)
+    if isinstance(sub_learning_outcome_list, str):
+        sub_learning_outcome_list = [sub_learning_outcome_list]
+    scores = index.scores(" ".join([main_learning_outcome] + list(sub_learning_outcome_list)))
+
+    selected, used_tokens = [], 0
+    for passage_id in np.argsort(-scores, kind="stable")[:top_k]:
+        if scores[passage_id] <= 0:
+            break
+        tokens = estimate_tokens(index.passages[passage_id])
+        if used_tokens + tokens > token_budget:
+            continue
+        selected.append(int(passage_id))
+        used_tokens += tokens
+
+    if not selected:
+        print("No context passage matches the learning outcomes, keeping the leading passages")
+        selected, used_tokens = leading_passages(index.passages, token_budget)
+
+    print(f"Selected {len(selected)} of {len(index.passages)} context passages, about {used_tokens} tokens")
+    return "\n...\n".join(index.passages[passage_id] for passage_id in sorted(selected))
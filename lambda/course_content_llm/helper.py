@@ -1,24 +1,98 @@
 ## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
-import boto3
-from botocore.config import Config
+from aws_clients import get_client
+from ws_sender import BufferedWSSender, send_message_to_ws_client
+from botocore.exceptions import ClientError
 import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-import PyPDF2
 from urllib.parse import urlparse, unquote_plus
-from langchain_core.prompts import PromptTemplate
+from pydantic import ValidationError
 from pydantic_utils import convert_pydantic_to_bedrock_converse_function
+from partial_json import IncrementalObjectParser
+from token_budget import (TokenBudgetExceeded, estimate_tokens, estimate_request_tokens, get_max_output_tokens,
+                          get_input_token_budget, get_retry_max_tokens, get_max_output_bytes, check_request_budget,
+                          CHARS_PER_TOKEN)
+from context_selection import select_relevant_context
+from CourseContentPydantic import CourseContent, ReadingMaterial, SubLearningOutcomeContent
+
+# number of S3 objects downloaded and parsed concurrently
+PDF_INGESTION_MAX_WORKERS = int(os.getenv("PDF_INGESTION_MAX_WORKERS", 8))
+# extracted PDF text is stored under this prefix, keyed by the source object's ETag
+PDF_TEXT_CACHE_PREFIX = "pdf_text_cache"
+# Bedrock requests of fan-out parts run on one pool shared by every record of the invocation,
+# so concurrent records do not multiply the request rate
+FAN_OUT_MAX_WORKERS = int(os.getenv("FAN_OUT_MAX_WORKERS", 8))
+# base delay in seconds of the exponential backoff before a part that failed with a Bedrock error is retried
+FAN_OUT_RETRY_BASE_DELAY = float(os.getenv("FAN_OUT_RETRY_BASE_DELAY", 1))
+# SSM parameter holding the id of the QnA knowledge base, published by the QnA stack
+KB_ID_PARAMETER = os.getenv("KB_ID_PARAMETER", "")
+# number of knowledge base chunks retrieved as additional context when context_source is "knowledge_base"
+KB_CONTEXT_NUM_OF_RESULTS = int(os.getenv("KB_CONTEXT_NUM_OF_RESULTS", 10))
+# cache the tools, system prompt and additional context shared by every request of a course,
+# only enable with a model that supports Bedrock prompt caching
+ENABLE_PROMPT_CACHING = os.getenv("ENABLE_PROMPT_CACHING", "false").lower() == "true"
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+# with prompt caching the additional context is sent once, ahead of the per-week request
+ADDITIONAL_CONTEXT_REFERENCE = "(provided in the <additional_context> tags at the start of this message)"
+
+LOGGER = logging.getLogger()
+
+# user prompts for the "fan_out" generation mode, one request per part of CourseContent
+READING_MATERIAL_PROMPT = '''For the course {course_title}, 
+generate the Week {week_number} reading material for the main learning outcome:
+{main_learning_outcome}
+
+The reading material should be at least one page long and cover the following sub-learning outcomes:
+{sub_learning_outcome_list}
+
+If provided, refer to the information within the <additional_context> tags for any supplementary details or guidelines.
+
+<additional_context>
+{additional_context}
+</additional_context>
+
+Ensure the content is academically sound and engaging for students.
+Generate the content without any introductory text or explanations.'''
+
+SUB_LEARNING_OUTCOME_PROMPT = '''For the course {course_title}, 
+generate Week {week_number} content for the sub-learning outcome:
+{sub_learning_outcome_list}
+
+This sub-learning outcome supports the main learning outcome:
+{main_learning_outcome}
+
+Provide:
+- 1 video script, 3 minutes long
+- 1 multiple-choice question about the video with correct answer
+
+If provided, refer to the information within the <additional_context> tags for any supplementary details or guidelines.
+
+<additional_context>
+{additional_context}
+</additional_context>
+
+Ensure the content is academically sound and engaging for students.
+Generate the content without any introductory text or explanations.'''
 
 #increase the standard time out limits in boto3, because Bedrock may take a while to respond to large requests.
-my_config = Config(
-    connect_timeout=60*5,
-    read_timeout=60*5,
-)
+BEDROCK_TIMEOUTS = {"connect_timeout": 60*5, "read_timeout": 60*5}
+
+s3_client = get_client("s3")
+bedrock_runtime_client = get_client("bedrock-runtime", **BEDROCK_TIMEOUTS)
+bedrock_client = get_client("bedrock", **BEDROCK_TIMEOUTS)
+# clients of the optional code paths (course builds, knowledge base context) are created
+# through get_client on first use, so requests that do not need them skip their construction
 
-s3_client=boto3.client("s3")
-bedrock_runtime_client = boto3.client(service_name='bedrock-runtime',config=my_config)
-bedrock_client = boto3.client(service_name='bedrock',config=my_config) 
+_kb_id = {"value": None}
+_fan_out_executor = {"value": None}
+_fan_out_executor_lock = threading.Lock()
 
 ## write a function to write json file into s3 bucket
 def write_json_to_s3(value_dict_, s3_bucket, result_json_folder):
@@ -29,6 +103,24 @@ def write_json_to_s3(value_dict_, s3_bucket, result_json_folder):
         s3_client.put_object(Body=json.dumps(json_data), Bucket=s3_bucket, Key=s3_key)
     return True
 
+def configure_logger():
+    """Configure python logger for lambda function"""
+    default_log_args = {
+        "level": logging.DEBUG if os.environ.get("VERBOSE", False) else logging.INFO,
+        "format": "%(asctime)s [%(levelname)s] %(name)s - %(message)s",
+        "datefmt": "%d-%b-%y %H:%M",
+        "force": True,
+    }
+    logging.basicConfig(**default_log_args)
+
+
+def silence_noisy_loggers():
+    """Silence chatty libraries for better logging"""
+    for logger in ['boto3', 'botocore',
+                   'botocore.vendored.requests.packages.urllib3']:
+        logging.getLogger(logger).setLevel(logging.WARNING)
+
+
 def get_s3_bucket_and_key(s3_input_uri):
     parsed_uri = urlparse(s3_input_uri)
     
@@ -49,18 +141,118 @@ def get_s3_bucket_and_key(s3_input_uri):
     return bucket, key
 
 
-def extract_text_from_pdf(bucket, key):
+def format_prompt(template, **variables):
+    """Render a prompt template with {placeholder} variables, literal braces are written as {{ and }}"""
+    return template.format_map(variables)
+
+
+def parse_pdf_from_s3(bucket, key):
     response = s3_client.get_object(Bucket=bucket, Key=key)
     pdf_content = response['Body'].read()
 
+    # PyPDF2 is only needed when PDFs are provided, keep it off the cold start path
+    import PyPDF2
+
     pdf_file = BytesIO(pdf_content)
     pdf_reader = PyPDF2.PdfReader(pdf_file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() + "\n"  # Add newline after each page's text
+    # Add newline after each page's text
+    return "".join(page.extract_text() + "\n" for page in pdf_reader.pages)
+
+
+def get_cached_pdf_text(cache_bucket, cache_key):
+    try:
+        response = s3_client.get_object(Bucket=cache_bucket, Key=cache_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return response['Body'].read().decode('utf-8')
+
+
+def extract_text_from_pdf(bucket, key, cache_bucket=None):
+    """Return the text of a PDF stored in S3.
+    When cache_bucket is given, the text is looked up in (and written back to) a
+    sidecar object keyed by the source ETag, so an unchanged PDF is parsed only once."""
+    if not cache_bucket:
+        return parse_pdf_from_s3(bucket, key)
+
+    etag = s3_client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+    cache_key = f"{PDF_TEXT_CACHE_PREFIX}/{etag}.txt"
+    text = get_cached_pdf_text(cache_bucket, cache_key)
+    if text is not None:
+        print(f"Using cached text for s3://{bucket}/{key}")
+        return text
+
+    text = parse_pdf_from_s3(bucket, key)
+    try:
+        s3_client.put_object(Bucket=cache_bucket, Key=cache_key, Body=text.encode('utf-8'))
+    except ClientError as e:
+        print(f"Unable to cache text for s3://{bucket}/{key}: {e}")
     return text
 
 
+def extract_text_from_pdfs(s3_input_uri_list, cache_bucket=None, max_workers=PDF_INGESTION_MAX_WORKERS):
+    """Download and parse every PDF in s3_input_uri_list on a thread pool.
+    The extracted text is joined in the same order as the input list."""
+    pdf_locations = []
+    for s3_input_uri in s3_input_uri_list:
+        bucket, key = get_s3_bucket_and_key(s3_input_uri)
+        if key.endswith('.pdf'):
+            pdf_locations.append((bucket, key))
+
+    if not pdf_locations:
+        return ""
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(pdf_locations))) as executor:
+        pdf_texts = executor.map(lambda location: extract_text_from_pdf(*location, cache_bucket=cache_bucket),
+                                 pdf_locations)
+        return "".join(pdf_texts)
+
+
+def get_kb_id():
+    """Knowledge base id read from the KB_ID_PARAMETER SSM parameter once per lambda environment"""
+    if _kb_id["value"] is None:
+        response = get_client("ssm").get_parameter(Name=KB_ID_PARAMETER)
+        _kb_id["value"] = response["Parameter"]["Value"]
+    return _kb_id["value"]
+
+
+def get_kb_filter(course_title, course_id, week_number):
+    """Retrieval filter on the metadata keys written next to every knowledge base document.
+    Unlike the QnA bot, which answers from every week up to the current one, content
+    generation only uses the material of its own week."""
+    conditions = []
+    if course_id:
+        conditions.append({'equals': {'key': 'course_id', 'value': course_id}})
+    else:
+        conditions.append({'equals': {'key': 'course_name', 'value': course_title}})
+    conditions.append({'equals': {'key': 'week', 'value': int(week_number)}})
+    # andAll requires at least two conditions
+    return {'andAll': conditions} if len(conditions) > 1 else conditions[0]
+
+
+def retrieve_kb_context(course_title, course_id, week_number, main_learning_outcome, sub_learning_outcome_list,
+                        num_of_results=KB_CONTEXT_NUM_OF_RESULTS):
+    """Additional context made of the knowledge base chunks of the course week most relevant to
+    the learning outcomes, best first"""
+    if isinstance(sub_learning_outcome_list, str):
+        sub_learning_outcome_list = [sub_learning_outcome_list]
+    query = "\n".join([main_learning_outcome] + list(sub_learning_outcome_list))
+    response = get_client("bedrock-agent-runtime").retrieve(
+        knowledgeBaseId=get_kb_id(),
+        retrievalQuery={'text': query},
+        retrievalConfiguration={
+            'vectorSearchConfiguration': {
+                'numberOfResults': num_of_results,
+                'filter': get_kb_filter(course_title, course_id, week_number),
+            }
+        }
+    )
+    chunks = [result['content']['text'] for result in response.get('retrievalResults', [])]
+    print(f"Retrieved {len(chunks)} knowledge base chunks for week {week_number}")
+    return "\n...\n".join(chunks)
+
+
 def save_json_to_s3(bucket, key, llm_json_response):
     # Convert the dictionary to a JSON string
     json_content = json.dumps(llm_json_response)
@@ -68,59 +260,143 @@ def save_json_to_s3(bucket, key, llm_json_response):
     s3_client.put_object(Bucket=bucket, Key=key, Body=json_content.encode('utf-8'))
 
 
-def invoke_bedrock_converse_api(model_id, course_title, week_number, main_learning_outcome, 
-                                   sub_learning_outcome_list, additional_context, 
-                                   user_prompt, pydantic_classes, is_streaming):
-    # model_id = "anthropic.claude-3-haiku-20240307-v1:0"
-    # model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+# expected words of the CourseContent string fields (and list items), used to size maxTokens
+CONTENT_FIELD_WORDS = {
+    "main_learning_outcome": 25,
+    "title": 10,
+    "content": 800,
+    "sub_learning_outcome": 20,
+    # a 3 minute video script
+    "script": 450,
+    "question": 40,
+    "options": 15,
+    "correct_answer": 15,
+}
+CONTENT_LIST_LENGTHS = {"options": 4}
+
 
-    system_prompt =f"""You are an AI assistant specialized in educational content creation.
+SYSTEM_PROMPT = """You are an AI assistant specialized in educational content creation.
 Your task is to generate course materials based on given learning outcomes.
 Produce concise, accurate, and engaging content suitable for college-level courses.
 You may refer to additional context provided within <additional_context> tags if present.
 Format your response in valid JSON for easy parsing and integration.
 Respond only with the requested content, without any preamble or explanation."""
 
-    user_msg_prompt = PromptTemplate.from_template(user_prompt)
-    
-    user_msg = user_msg_prompt.format(course_title=course_title, 
-                                      week_number=week_number,
-                                      main_learning_outcome=main_learning_outcome,
-                                      sub_learning_outcome_list=sub_learning_outcome_list,
-                                      additional_context=additional_context)
 
-    messages = [{"role": "user", 
-                 "content": [{
-                     "text": user_msg}
-                     ]}
-                ]
-    
-    # inference_config = {
-    #         "temperature": 0.7,
-    #         "topP": 0.7
-    #     }
+def format_user_message(user_prompt, course_title, week_number, main_learning_outcome,
+                        sub_learning_outcome_list, additional_context):
+    return format_prompt(user_prompt,
+                         course_title=course_title,
+                         week_number=week_number,
+                         main_learning_outcome=main_learning_outcome,
+                         sub_learning_outcome_list=sub_learning_outcome_list,
+                         additional_context=additional_context)
+
 
+def get_tool_config(pydantic_classes, prompt_caching=False):
     tools = []
     for class_ in pydantic_classes:
         tools.append(convert_pydantic_to_bedrock_converse_function(class_))
-    tool_config = { "tools": tools }
+    if prompt_caching:
+        tools.append(CACHE_POINT)
+    return { "tools": tools }
+
+
+def get_system_prompt(prompt_caching=False):
+    return [{"text": SYSTEM_PROMPT}, CACHE_POINT] if prompt_caching else [{"text": SYSTEM_PROMPT}]
+
+
+def get_user_message_content(user_prompt, course_title, week_number, main_learning_outcome,
+                             sub_learning_outcome_list, additional_context, prompt_caching=False):
+    """Content blocks of the user message. With prompt caching the additional context comes
+    first, followed by a cache point, so every week and outcome of a course shares the prefix."""
+    if not prompt_caching or not additional_context:
+        return [{"text": format_user_message(user_prompt, course_title, week_number, main_learning_outcome,
+                                             sub_learning_outcome_list, additional_context)}]
+
+    return [{"text": f"<additional_context>\n{additional_context}\n</additional_context>"},
+            CACHE_POINT,
+            {"text": format_user_message(user_prompt, course_title, week_number, main_learning_outcome,
+                                         sub_learning_outcome_list, ADDITIONAL_CONTEXT_REFERENCE)}]
+
+
+def get_content_max_tokens(model_id, pydantic_classes, sub_learning_outcome_list):
+    """inferenceConfig.maxTokens sized for one entry per sub-learning outcome"""
+    if isinstance(sub_learning_outcome_list, str):
+        sub_learning_outcome_list = [sub_learning_outcome_list]
+    list_lengths = dict(CONTENT_LIST_LENGTHS, sub_learning_outcomes_content=len(sub_learning_outcome_list))
+    return get_max_output_tokens(model_id, pydantic_classes, CONTENT_FIELD_WORDS, list_lengths)
+
+
+def get_context_token_budget(model_id, course_title, week_number, main_learning_outcome,
+                             sub_learning_outcome_list, user_prompt, pydantic_classes):
+    """Tokens left for the additional context once the prompt, tools and output are accounted for.
+    Raises TokenBudgetExceeded when the request does not fit even without additional context,
+    so it fails before any PDF is read."""
+    max_tokens = get_content_max_tokens(model_id, pydantic_classes, sub_learning_outcome_list)
+    fixed_tokens = estimate_request_tokens(
+        get_system_prompt(),
+        [{"role": "user", "content": get_user_message_content(user_prompt, course_title, week_number, main_learning_outcome,
+                                                              sub_learning_outcome_list, "")}],
+        get_tool_config(pydantic_classes))
+    context_token_budget = get_input_token_budget(model_id, max_tokens) - fixed_tokens
+    if context_token_budget <= 0:
+        raise TokenBudgetExceeded(f"Prompt of about {fixed_tokens} tokens leaves no room for additional context in {model_id}")
+    return context_token_budget
+
+
+def fit_additional_context(additional_context, context_token_budget, main_learning_outcome, sub_learning_outcome_list):
+    """Trim additional_context to context_token_budget, keeping the passages most relevant to the learning outcomes"""
+    if estimate_tokens(additional_context) <= context_token_budget:
+        return additional_context
+    print(f"Trimming additional context of about {estimate_tokens(additional_context)} tokens to {context_token_budget}")
+    additional_context = select_relevant_context(additional_context, main_learning_outcome, sub_learning_outcome_list,
+                                                 token_budget=context_token_budget)
+    # passages are estimated one by one, cut what their separators add
+    return additional_context[:context_token_budget * CHARS_PER_TOKEN]
+
+
+def invoke_bedrock_converse_api(model_id, course_title, week_number, main_learning_outcome, 
+                                   sub_learning_outcome_list, additional_context, 
+                                   user_prompt, pydantic_classes, is_streaming, max_tokens=None):
+    # model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+    # model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+    system_prompt = get_system_prompt(ENABLE_PROMPT_CACHING)
+
+    messages = [{"role": "user", 
+                 "content": get_user_message_content(user_prompt, course_title, week_number, main_learning_outcome,
+                                                     sub_learning_outcome_list, additional_context,
+                                                     ENABLE_PROMPT_CACHING)}
+                ]
+    
+    tool_config = get_tool_config(pydantic_classes, ENABLE_PROMPT_CACHING)
+
+    # the output is capped at the size the schema calls for, and oversized requests fail before the call
+    inference_config = {
+            "maxTokens": max_tokens or get_content_max_tokens(model_id, pydantic_classes, sub_learning_outcome_list),
+            # "temperature": 0.7,
+            # "topP": 0.7
+        }
+    check_request_budget(model_id, system_prompt, messages, tool_config, inference_config["maxTokens"])
     
     if is_streaming=="yes":
         response = bedrock_runtime_client.converse_stream(
                 modelId=model_id,
                 messages=messages,
-                system=[{ "text": system_prompt}],
-                # inferenceConfig=inference_config,
+                system=system_prompt,
+                inferenceConfig=inference_config,
                 toolConfig=tool_config,
             )
     else:
          response = bedrock_runtime_client.converse(
-            system=[{ "text": system_prompt}],
+            system=system_prompt,
             modelId=model_id,
             messages=messages,
-            # inferenceConfig=inference_config,
+            inferenceConfig=inference_config,
             toolConfig=tool_config,
         )
+         LOGGER.info(f"Token usage: {response.get('usage')}")
     return response
 
 
@@ -152,9 +428,98 @@ def parse_bedrock_tool_response(response):
             print("Claude didn't use any tools")
     return value_dict_
 
-def send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response):
-        apigatewaymanagementapi_client.post_to_connection(ConnectionId=connection_id, 
-                                                          Data=json.dumps(response).encode('utf-8'))
+def generate_course_content_part(model_id, pydantic_class, user_prompt, course_title, week_number,
+                                 main_learning_outcome, sub_learning_outcome_list, additional_context, max_retries):
+    """Generate a single part of CourseContent and validate it against pydantic_class.
+    Bedrock errors, e.g. throttling, are retried with exponential backoff.
+    Raises ValueError when no valid output was produced after max_retries attempts."""
+    max_tokens = get_content_max_tokens(model_id, [pydantic_class], sub_learning_outcome_list)
+    for count in range(max_retries):
+        try:
+            converse_response = invoke_bedrock_converse_api(model_id, course_title, week_number, main_learning_outcome,
+                                                            sub_learning_outcome_list, additional_context, user_prompt,
+                                                            [pydantic_class], is_streaming="no", max_tokens=max_tokens)
+        except ClientError as e:
+            print(f"{pydantic_class.__name__} failed on attempt {count + 1}: {e}")
+            if count + 1 < max_retries:
+                # full jitter, so parts throttled together do not retry together
+                time.sleep(random.uniform(0, FAN_OUT_RETRY_BASE_DELAY * 2 ** count))
+            continue
+        if converse_response['stopReason'] == 'max_tokens':
+            # retry once at the model maximum, the same cap would cut the output off again
+            max_tokens = get_retry_max_tokens(model_id, max_tokens)
+            print(f"{pydantic_class.__name__} exceeded maxTokens on attempt {count + 1}")
+            if max_tokens is None:
+                break
+            continue
+        tool_input = parse_bedrock_tool_response(converse_response).get(pydantic_class.__name__)
+        if not tool_input:
+            continue
+        try:
+            return pydantic_class.model_validate(tool_input)
+        except ValidationError as e:
+            print(f"Invalid {pydantic_class.__name__} on attempt {count + 1}: {e}")
+
+    raise ValueError(f"Unable to generate {pydantic_class.__name__} after {max_retries} attempts.")
+
+
+def get_fan_out_executor():
+    """Thread pool of the fan-out parts, shared by every record processed by this execution environment"""
+    with _fan_out_executor_lock:
+        if _fan_out_executor["value"] is None:
+            _fan_out_executor["value"] = ThreadPoolExecutor(max_workers=FAN_OUT_MAX_WORKERS)
+        return _fan_out_executor["value"]
+
+
+def generate_course_content_fan_out(model_id, course_title, week_number, main_learning_outcome,
+                                    sub_learning_outcome_list, additional_context, max_retries):
+    """Generate CourseContent with one concurrent Bedrock request for the reading material
+    and one per sub-learning outcome, so a failed part is retried on its own.
+    Every part uses its own fixed prompt, READING_MATERIAL_PROMPT or SUB_LEARNING_OUTCOME_PROMPT.
+    Parts of all records run on the shared get_fan_out_executor pool, at most FAN_OUT_MAX_WORKERS at a time."""
+    if isinstance(sub_learning_outcome_list, str):
+        sub_learning_outcome_list = [sub_learning_outcome_list]
+    executor = get_fan_out_executor()
+    reading_material_future = executor.submit(generate_course_content_part, model_id, ReadingMaterial,
+                                              READING_MATERIAL_PROMPT, course_title, week_number,
+                                              main_learning_outcome, sub_learning_outcome_list,
+                                              additional_context, max_retries)
+    sub_learning_outcome_futures = [
+        executor.submit(generate_course_content_part, model_id, SubLearningOutcomeContent,
+                        SUB_LEARNING_OUTCOME_PROMPT, course_title, week_number,
+                        main_learning_outcome, sub_learning_outcome, additional_context, max_retries)
+        for sub_learning_outcome in sub_learning_outcome_list
+    ]
+
+    sub_learning_outcomes_content = []
+    for sub_learning_outcome, future in zip(sub_learning_outcome_list, sub_learning_outcome_futures):
+        sub_learning_outcome_content = future.result()
+        # keep the outcome exactly as requested rather than the model's paraphrase
+        sub_learning_outcome_content.sub_learning_outcome = sub_learning_outcome
+        sub_learning_outcomes_content.append(sub_learning_outcome_content)
+
+    course_content = CourseContent(week_number=week_number,
+                                   main_learning_outcome=main_learning_outcome,
+                                   reading_material=reading_material_future.result(),
+                                   sub_learning_outcomes_content=sub_learning_outcomes_content)
+
+    return {"CourseContent": course_content.model_dump()}
+
+def update_build_progress(table_name, build_id, succeeded):
+    """Count a finished job against its course build and return the updated progress"""
+    counter = "completed" if succeeded else "failed"
+    response = get_client("dynamodb").update_item(
+        TableName=table_name,
+        Key={'buildId': {'S': build_id}},
+        UpdateExpression=f"ADD {counter} :one",
+        ExpressionAttributeValues={':one': {'N': '1'}},
+        ReturnValues="ALL_NEW"
+    )
+    attributes = response['Attributes']
+    return {"build_id": build_id,
+            "completed": int(attributes.get('completed', {}).get('N', 0)),
+            "failed": int(attributes.get('failed', {}).get('N', 0)),
+            "total": int(attributes.get('total', {}).get('N', 0))}
 
 def process_stream_obj_old(response, apigatewaymanagementapi_client, connection_id):
         final_response=""
@@ -189,44 +554,76 @@ def process_stream_obj_old(response, apigatewaymanagementapi_client, connection_
 
         return final_response
 
-def process_stream_obj(response, apigatewaymanagementapi_client, connection_id):
+def process_stream_obj(response, apigatewaymanagementapi_client, connection_id, max_output_bytes,
+                       stream_object_keys=()):
+        """Stream a converse_stream response to the WebSocket client and rebuild the message.
+        Sub-objects of the tool input stored under stream_object_keys are also sent as
+        structured "partial_object" events as soon as they are complete.
+        The stream is aborted with stop reason "max_output_bytes" once more than
+        max_output_bytes of output have been received, see token_budget.get_max_output_bytes."""
         stop_reason = ""
         message = {}
         content = []
         message['content'] = content
-        text = ''
+        text_chunks = []
         tool_use = {}
+        tool_input_chunks = []
+        output_bytes = 0
+        ws_sender = BufferedWSSender(apigatewaymanagementapi_client, connection_id)
+        object_parser = IncrementalObjectParser(stream_object_keys)
 
         #stream the response into a message.
-        for chunk in response['stream']:
-            if 'messageStart' in chunk:
-                message['role'] = chunk['messageStart']['role']
-            elif 'contentBlockStart' in chunk:
-                tool = chunk['contentBlockStart']['start']['toolUse']
-                tool_use['toolUseId'] = tool['toolUseId']
-                tool_use['name'] = tool['name']
-            elif 'contentBlockDelta' in chunk:
-                delta = chunk['contentBlockDelta']['delta']
-                if 'toolUse' in delta:
-                    if 'input' not in tool_use:
-                        tool_use['input'] = ''
-                    tool_use['input'] += delta['toolUse']['input']
-                    print(delta['toolUse']['input'])
-                    send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, delta['toolUse']['input'])
-                elif 'text' in delta:
-                    text += delta['text']
-                    print(delta['text'], end='')
-                    # send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, delta['text'])
-            elif 'contentBlockStop' in chunk:
-                if 'input' in tool_use:
-                    tool_use['input'] = json.loads(tool_use['input'])
-                    content.append({'toolUse': tool_use})
-                    tool_use = {}
-                else:
-                    content.append({'text': text})
-                    text = ''
-
-            elif 'messageStop' in chunk:
-                stop_reason = chunk['messageStop']['stopReason']
+        try:
+            for chunk in response['stream']:
+                if 'messageStart' in chunk:
+                    message['role'] = chunk['messageStart']['role']
+                elif 'contentBlockStart' in chunk:
+                    tool = chunk['contentBlockStart']['start']['toolUse']
+                    tool_use['toolUseId'] = tool['toolUseId']
+                    tool_use['name'] = tool['name']
+                    object_parser = IncrementalObjectParser(stream_object_keys)
+                elif 'contentBlockDelta' in chunk:
+                    delta = chunk['contentBlockDelta']['delta']
+                    delta_text = delta['toolUse']['input'] if 'toolUse' in delta else delta.get('text', '')
+                    output_bytes += len(delta_text.encode('utf-8'))
+                    if output_bytes > max_output_bytes:
+                        LOGGER.error(f"Aborting generation after {output_bytes} bytes of output")
+                        stop_reason = "max_output_bytes"
+                        response['stream'].close()
+                        break
+
+                    if 'toolUse' in delta:
+                        tool_input_chunks.append(delta_text)
+                        LOGGER.debug(delta_text)
+                        ws_sender.send(delta_text)
+                        for key, index, obj in object_parser.feed(delta_text):
+                            ws_sender.send_event({"event": "partial_object", "key": key, "index": index, "data": obj})
+                    elif 'text' in delta:
+                        text_chunks.append(delta_text)
+                        LOGGER.debug(delta_text)
+                        # ws_sender.send(delta_text)
+                elif 'contentBlockStop' in chunk:
+                    ws_sender.flush()
+                    if tool_input_chunks:
+                        try:
+                            tool_use['input'] = json.loads("".join(tool_input_chunks))
+                            content.append({'toolUse': tool_use})
+                        except json.JSONDecodeError:
+                            # cut off by maxTokens, the messageStop that follows reports "max_tokens"
+                            LOGGER.error("Tool input is incomplete, dropping it")
+                        tool_use = {}
+                        tool_input_chunks = []
+                    else:
+                        content.append({'text': "".join(text_chunks)})
+                        text_chunks = []
+
+                elif 'messageStop' in chunk:
+                    ws_sender.flush()
+                    stop_reason = chunk['messageStop']['stopReason']
+                elif 'metadata' in chunk:
+                    LOGGER.info(f"Token usage: {chunk['metadata'].get('usage')}")
+        finally:
+            ws_sender.close()
+            LOGGER.info(f"Received {output_bytes} bytes of output, sent {ws_sender.frames_sent} frames to client")
 
         return stop_reason, message
\ No newline at end of file
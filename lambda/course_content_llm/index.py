@@ -2,13 +2,14 @@
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from helper import * 
 from CourseContentPydantic import CourseContent
+from context_selection import select_relevant_context
 import os
 
-def lambda_handler(event, context):
-    print(event)
-    event = json.loads(event['Records'][0]['body'])
+def generate_course_content(record):
+    event = json.loads(record['body'])
     try:
         connection_id = event['requestContext']['connectionId']
         body = json.loads(event["body"])
@@ -19,9 +20,15 @@ def lambda_handler(event, context):
         main_learning_outcome = body["main_learning_outcome"]
         sub_learning_outcome_list = body["sub_learning_outcome_list"]
         is_streaming = body["is_streaming"]
+        generation_mode = body.get("generation_mode", "single")
+        # "pdf" extracts the uploaded PDFs, "knowledge_base" retrieves the course week from the QnA knowledge base
+        context_source = body.get("context_source", "pdf")
+        course_id = body.get("course_id", "")
+        build_id = body.get("build_id", "")
         model_id = os.getenv("MODEL_ID", "")
         websocket_endpoint_url = os.environ["WEBSOCKET_ENDPOINT_URL"]
         output_bucket = os.environ["OUTPUT_BUCKET"]
+        build_table = os.getenv("BUILD_TABLE", "")
 
     except:
         print("dev mode activated")
@@ -34,6 +41,11 @@ def lambda_handler(event, context):
         main_learning_outcome = ""
         sub_learning_outcome_list = []
         is_streaming = "no"
+        generation_mode = "single"
+        context_source = "pdf"
+        course_id = ""
+        build_id = ""
+        build_table = ""
         output_bucket = ""
         user_prompt='''For the course {course_title}, 
 generate Week {week_number} content for the main learning outcome:
@@ -56,26 +68,64 @@ If provided, refer to the information within the <additional_context> tags for a
 Format the response in JSON, with clear structure for each component. Ensure the content is academically sound and engaging for students.
 Generate the content without any introductory text or explanations.'''
 
+    if generation_mode == "fan_out":
+        if is_streaming == "yes":
+            print("generation_mode fan_out is not supported with streaming, generating with a single request")
+        else:
+            print("generation_mode fan_out generates each part with its own prompt, user_prompt is not used")
+
     ## send message to api that message received
-    apigatewaymanagementapi_client = boto3.client('apigatewaymanagementapi', endpoint_url=websocket_endpoint_url)
+    apigatewaymanagementapi_client = get_client('apigatewaymanagementapi', endpoint_url=websocket_endpoint_url)
     # send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response={'message':'Debugging... inside another lambda', "connection_id":connection_id})
 
-    additional_context = ""
-    for s3_input_uri in s3_input_uri_list:
-        bucket, key = get_s3_bucket_and_key(s3_input_uri)
-        if key.endswith('.pdf'):
-            pdf_text = extract_text_from_pdf(bucket, key)
-            additional_context = additional_context + pdf_text
-    
     # Initialize the Pydantic model
     pydantic_classes = [CourseContent]
 
+    # requests that cannot fit the model are rejected before any context is fetched
+    try:
+        context_token_budget = get_context_token_budget(model_id, course_title, week_number, main_learning_outcome,
+                                                        sub_learning_outcome_list, user_prompt, pydantic_classes)
+    except TokenBudgetExceeded as e:
+        print(e)
+        send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response=f"Unable to generate course content: {e}")
+        if build_id:
+            update_build_progress(build_table, build_id, succeeded=False)
+        return {'statusCode': 400,
+                'body': json.dumps({'error': str(e)})}
+
+    if ENABLE_PROMPT_CACHING:
+        # the cached prefix only hits when every week and outcome of the course sends the same context,
+        # so oversized context is reduced once per course, against the course title
+        selection_outcome, selection_sub_outcomes = course_title, []
+    else:
+        selection_outcome, selection_sub_outcomes = main_learning_outcome, sub_learning_outcome_list
+
+    if context_source == "knowledge_base":
+        # a single bounded retrieval replaces downloading and parsing the PDFs
+        additional_context = retrieve_kb_context(course_title, course_id, week_number, main_learning_outcome,
+                                                 sub_learning_outcome_list)
+    else:
+        additional_context = extract_text_from_pdfs(s3_input_uri_list, cache_bucket=output_bucket)
+        # large document sets are reduced to the passages relevant to this week's learning outcomes (or course)
+        additional_context = select_relevant_context(additional_context, selection_outcome, selection_sub_outcomes)
+    additional_context = fit_additional_context(additional_context, context_token_budget, selection_outcome,
+                                                selection_sub_outcomes)
+
     course_content={}    
+    # message for the client once the content is saved, streamed content has already been sent
+    client_response = None
+    max_tokens = get_content_max_tokens(model_id, pydantic_classes, sub_learning_outcome_list)
     if is_streaming == "yes":
         converse_response = invoke_bedrock_converse_api(model_id, course_title, week_number, main_learning_outcome, 
                                                     sub_learning_outcome_list, additional_context, user_prompt, 
-                                                    pydantic_classes, is_streaming=is_streaming)
-        stop_reason, message = process_stream_obj(converse_response, apigatewaymanagementapi_client, connection_id)
+                                                    pydantic_classes, is_streaming=is_streaming, max_tokens=max_tokens)
+        stop_reason, message = process_stream_obj(converse_response, apigatewaymanagementapi_client, connection_id,
+                                                  get_max_output_bytes(max_tokens),
+                                                  stream_object_keys=("reading_material", "sub_learning_outcomes_content"))
+        if stop_reason in ("max_tokens", "max_output_bytes"):
+            # the client already received part of the content, fail fast instead of streaming it again
+            client_response = (f"Course content exceeded the limit of {max_tokens} output tokens. "
+                               "Request fewer sub-learning outcomes or use generation_mode fan_out.")
         if stop_reason == "tool_use":
             for content in message['content']:
                 if 'toolUse' in content:
@@ -84,24 +134,55 @@ Generate the content without any introductory text or explanations.'''
                         course_content = tool['input']
     else:
         MAX_RETRIES = 2
-        count = 0
-        while len(course_content) == 0 and count < MAX_RETRIES:
-            converse_response = invoke_bedrock_converse_api(model_id, course_title, week_number, main_learning_outcome, 
-                                                    sub_learning_outcome_list, additional_context, user_prompt, 
-                                                    pydantic_classes, is_streaming=is_streaming)
-            course_content = parse_bedrock_tool_response(converse_response)
-            count += 1
+        if generation_mode == "fan_out":
+            # one request per sub-learning outcome plus one for the reading material
+            try:
+                course_content = generate_course_content_fan_out(model_id, course_title, week_number, main_learning_outcome,
+                                                                 sub_learning_outcome_list, additional_context, MAX_RETRIES)
+            except ValueError as e:
+                print(e)
+        else:
+            count = 0
+            while len(course_content) == 0 and count < MAX_RETRIES:
+                converse_response = invoke_bedrock_converse_api(model_id, course_title, week_number, main_learning_outcome, 
+                                                        sub_learning_outcome_list, additional_context, user_prompt, 
+                                                        pydantic_classes, is_streaming=is_streaming, max_tokens=max_tokens)
+                course_content = parse_bedrock_tool_response(converse_response)
+                count += 1
+                if converse_response['stopReason'] == 'max_tokens':
+                    # retry once at the model maximum, the same cap would cut the output off again
+                    max_tokens = get_retry_max_tokens(model_id, max_tokens)
+                    print(f"Course content exceeded maxTokens on attempt {count}")
+                    if max_tokens is None:
+                        break
 
         if len(course_content) != 0:
-            send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response=course_content)
+            client_response = course_content
         else:
-            send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response=f"Unable to generate course content after {MAX_RETRIES} attempts.")
+            client_response = f"Unable to generate course content after {MAX_RETRIES} attempts."
 
     print(course_content)
     
-    # Save the course content to S3
-    output_key = f"course_content/{course_title}/{week_number}/{main_learning_outcome}/course_content.json"
-    save_json_to_s3(output_bucket, output_key, course_content)
+    # Save the course content to S3 before sending it, so content is kept when the client
+    # of a course build has disconnected. Failed generations are not saved.
+    if len(course_content) != 0:
+        output_key = f"course_content/{course_title}/{week_number}/{main_learning_outcome}/course_content.json"
+        save_json_to_s3(output_bucket, output_key, course_content)
+
+    if client_response is not None:
+        try:
+            send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response=client_response)
+        except Exception as e:
+            print(f"Unable to send course content to client: {e}")
+
+    # Report progress when this request is part of a whole-course build
+    if build_id:
+        build_progress = update_build_progress(build_table, build_id, succeeded=len(course_content) != 0)
+        print(build_progress)
+        try:
+            send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response=build_progress)
+        except Exception as e:
+            print(f"Unable to send build progress to client: {e}")
     
         
     return {'statusCode': 200,
@@ -111,6 +192,44 @@ Generate the content without any introductory text or explanations.'''
         }
 
 
+def record_build_failure(record):
+    """Count a job that raised against its course build, so the build still reaches its total.
+    The queue's max_receive_count is 1, so a failed message goes to the DLQ and is counted once."""
+    try:
+        body = json.loads(json.loads(record['body'])["body"])
+        build_id = body.get("build_id", "")
+        if build_id:
+            print(update_build_progress(os.getenv("BUILD_TABLE", ""), build_id, succeeded=False))
+    except Exception as e:
+        print(f"Unable to record build failure: {e}")
+
+
+def lambda_handler(event, context):
+    print(event)
+
+    # configure python logger for Lambda, set VERBOSE to log every streamed delta
+    configure_logger()
+    # silence chatty libraries for better logging
+    silence_noisy_loggers()
+    records = event['Records']
+
+    # Process every message of the batch concurrently and report only the failed
+    # ones, so the rest of the batch is not redriven to the DLQ
+    batch_item_failures = []
+    records_by_id = {record['messageId']: record for record in records}
+    with ThreadPoolExecutor(max_workers=len(records)) as executor:
+        futures = {executor.submit(generate_course_content, record): record['messageId'] for record in records}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to process message {futures[future]}: {e}")
+                batch_item_failures.append({"itemIdentifier": futures[future]})
+                record_build_failure(records_by_id[futures[future]])
+
+    return {"batchItemFailures": batch_item_failures}
+
+
 if __name__ == "__main__":
     event = None
     lambda_handler(event, None)
\ No newline at end of file
@@ -2,19 +2,19 @@
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
 import json
-import boto3
+from aws_clients import get_client
 
-sqs_client = boto3.client("sqs")
+sqs_client = get_client("sqs")
 
 def send_message_to_client(apigatewaymanagementapi_client, connection_id, response):
         apigatewaymanagementapi_client.post_to_connection(ConnectionId=connection_id, 
                                                           Data=json.dumps(response).encode('utf-8'))
 
-def send_message_to_sqs(queue_url, event):
+def send_message_to_sqs(queue_url, event, delay_seconds=0):
     message_body = json.dumps(event)
     response = sqs_client.send_message(
         QueueUrl=queue_url,
-        DelaySeconds=10,
+        DelaySeconds=delay_seconds,
         MessageBody=(message_body)
     )
     print(f"Message body sent to SQS:: {message_body}")
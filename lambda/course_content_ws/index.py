@@ -2,7 +2,6 @@
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
 import json
-import boto3
 from helper import * 
 import os
 
@@ -12,18 +11,23 @@ def lambda_handler(event, context):
         connection_id = event['requestContext']['connectionId']
         websocket_endpoint_url = os.getenv("WEBSOCKET_ENDPOINT_URL", "")
         content_queue_url = os.environ["CONTENT_QUEUE_URL"]
+        sqs_delay_seconds = int(os.getenv("SQS_DELAY_SECONDS", 0))
 
     except:
         connection_id = ""
         websocket_endpoint_url = ""
         content_queue_url = ""
+        sqs_delay_seconds = 0
 
-    response = {"connection_id":connection_id, 'message':'Message received and is in processing '}
-    
-    # apigatewaymanagementapi_client = boto3.client('apigatewaymanagementapi', endpoint_url=websocket_endpoint_url)
-    # send_message_to_client(apigatewaymanagementapi_client, connection_id, response=output_json)
+    response = send_message_to_sqs(content_queue_url, event, delay_seconds=sqs_delay_seconds)
 
-    response = send_message_to_sqs(content_queue_url, event)
+    # Acknowledge the request right away, the LLM lambda streams the result once it starts
+    acknowledgement = {"connection_id":connection_id, 'message':'Message received and is in processing '}
+    try:
+        apigatewaymanagementapi_client = get_client('apigatewaymanagementapi', endpoint_url=websocket_endpoint_url)
+        send_message_to_client(apigatewaymanagementapi_client, connection_id, response=acknowledgement)
+    except Exception as e:
+        print(f"Unable to acknowledge message to client: {e}")
 
     return {"statusCode": 200,
             "body": json.dumps({'course_content': response})
@@ -1,25 +1,67 @@
 ## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
-import boto3
-from botocore.config import Config
+from aws_clients import get_client
+from ws_sender import BufferedWSSender, send_message_to_ws_client
+from botocore.exceptions import ClientError
+import hashlib
 import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-import PyPDF2
 from urllib.parse import urlparse, unquote_plus
-from langchain_core.prompts import PromptTemplate
 from pydantic_utils import convert_pydantic_to_bedrock_converse_function
+from token_budget import (TokenBudgetExceeded, estimate_tokens, estimate_request_tokens, get_max_output_tokens,
+                          get_input_token_budget, get_retry_max_tokens, get_max_output_bytes, get_token_limits,
+                          check_request_budget, CHARS_PER_TOKEN)
+from partial_json import IncrementalObjectParser
 
 
+# number of S3 objects downloaded and parsed concurrently
+PDF_INGESTION_MAX_WORKERS = int(os.getenv("PDF_INGESTION_MAX_WORKERS", 8))
+# extracted PDF text is stored under this prefix, keyed by the source object's ETag
+PDF_TEXT_CACHE_PREFIX = "pdf_text_cache"
+# syllabus text above this estimated size is condensed into a digest before generation
+SYLLABUS_MAX_TOKENS = int(os.getenv("SYLLABUS_MAX_TOKENS", 20000))
+# cheaper model summarizing syllabus chunks, and the size of each chunk
+CONDENSE_MODEL_ID = os.getenv("CONDENSE_MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0")
+CONDENSE_CHUNK_TOKENS = int(os.getenv("CONDENSE_CHUNK_TOKENS", 8000))
+CONDENSE_SUMMARY_MAX_TOKENS = int(os.getenv("CONDENSE_SUMMARY_MAX_TOKENS", 1000))
+CONDENSE_MAX_WORKERS = int(os.getenv("CONDENSE_MAX_WORKERS", 8))
+# condensed syllabi are stored under this prefix, keyed by the hash of the syllabus text
+SYLLABUS_DIGEST_PREFIX = "syllabus_digest"
+# expected words of the CourseOutline string fields (and list items), and list sizes, used to size maxTokens
+OUTLINE_FIELD_WORDS = {"course_title": 10, "course_duration": 2, "outcome": 20, "sub_outcomes": 20}
+OUTLINE_LIST_LENGTHS = {"main_outcomes": 3, "sub_outcomes": 3}
+
+LOGGER = logging.getLogger()
+
 #increase the standard time out limits in boto3, because Bedrock may take a while to respond to large requests.
-my_config = Config(
-    connect_timeout=60*5,
-    read_timeout=60*5,
-)
+BEDROCK_TIMEOUTS = {"connect_timeout": 60*5, "read_timeout": 60*5}
+
+s3_client = get_client("s3")
+bedrock_runtime_client = get_client("bedrock-runtime", **BEDROCK_TIMEOUTS)
+bedrock_client = get_client("bedrock", **BEDROCK_TIMEOUTS)
+
+
+def configure_logger():
+    """Configure python logger for lambda function"""
+    default_log_args = {
+        "level": logging.DEBUG if os.environ.get("VERBOSE", False) else logging.INFO,
+        "format": "%(asctime)s [%(levelname)s] %(name)s - %(message)s",
+        "datefmt": "%d-%b-%y %H:%M",
+        "force": True,
+    }
+    logging.basicConfig(**default_log_args)
 
-s3_client=boto3.client("s3")
-bedrock_runtime_client = boto3.client(service_name='bedrock-runtime',config=my_config,)
-bedrock_client = boto3.client(service_name='bedrock',config=my_config,)
+
+def silence_noisy_loggers():
+    """Silence chatty libraries for better logging"""
+    for logger in ['boto3', 'botocore',
+                   'botocore.vendored.requests.packages.urllib3']:
+        logging.getLogger(logger).setLevel(logging.WARNING)
 
 
 def get_s3_bucket_and_key(s3_input_uri):
@@ -42,18 +84,168 @@ def get_s3_bucket_and_key(s3_input_uri):
     return bucket, key
 
 
-def extract_text_from_pdf(bucket, key):
+def format_prompt(template, **variables):
+    """Render a prompt template with {placeholder} variables, literal braces are written as {{ and }}"""
+    return template.format_map(variables)
+
+
+def parse_pdf_from_s3(bucket, key):
     response = s3_client.get_object(Bucket=bucket, Key=key)
     pdf_content = response['Body'].read()
 
+    # PyPDF2 is only needed when PDFs are provided, keep it off the cold start path
+    import PyPDF2
+
     pdf_file = BytesIO(pdf_content)
     pdf_reader = PyPDF2.PdfReader(pdf_file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() + "\n"  # Add newline after each page's text
+    # Add newline after each page's text
+    return "".join(page.extract_text() + "\n" for page in pdf_reader.pages)
+
+
+def get_cached_pdf_text(cache_bucket, cache_key):
+    try:
+        response = s3_client.get_object(Bucket=cache_bucket, Key=cache_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return response['Body'].read().decode('utf-8')
+
+
+def extract_text_from_pdf(bucket, key, cache_bucket=None):
+    """Return the text of a PDF stored in S3.
+    When cache_bucket is given, the text is looked up in (and written back to) a
+    sidecar object keyed by the source ETag, so an unchanged PDF is parsed only once."""
+    if not cache_bucket:
+        return parse_pdf_from_s3(bucket, key)
+
+    etag = s3_client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+    cache_key = f"{PDF_TEXT_CACHE_PREFIX}/{etag}.txt"
+    text = get_cached_pdf_text(cache_bucket, cache_key)
+    if text is not None:
+        print(f"Using cached text for s3://{bucket}/{key}")
+        return text
+
+    text = parse_pdf_from_s3(bucket, key)
+    try:
+        s3_client.put_object(Bucket=cache_bucket, Key=cache_key, Body=text.encode('utf-8'))
+    except ClientError as e:
+        print(f"Unable to cache text for s3://{bucket}/{key}: {e}")
     return text
 
 
+def extract_text_from_pdfs(s3_input_uri_list, cache_bucket=None, max_workers=PDF_INGESTION_MAX_WORKERS):
+    """Download and parse every PDF in s3_input_uri_list on a thread pool.
+    The extracted text is joined in the same order as the input list."""
+    pdf_locations = []
+    for s3_input_uri in s3_input_uri_list:
+        bucket, key = get_s3_bucket_and_key(s3_input_uri)
+        if key.endswith('.pdf'):
+            pdf_locations.append((bucket, key))
+
+    if not pdf_locations:
+        return ""
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(pdf_locations))) as executor:
+        pdf_texts = executor.map(lambda location: extract_text_from_pdf(*location, cache_bucket=cache_bucket),
+                                 pdf_locations)
+        return "".join(pdf_texts)
+
+
+def split_text(text, max_tokens):
+    """Split text into chunks of at most max_tokens, on paragraph or line boundaries where possible"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks, current, current_chars = [], [], 0
+    for line in text.splitlines(keepends=True):
+        # a single line longer than a chunk is cut into pieces
+        pieces = [line[i:i + max_chars] for i in range(0, len(line), max_chars)] or [line]
+        for piece in pieces:
+            if current and current_chars + len(piece) > max_chars:
+                chunks.append("".join(current))
+                current, current_chars = [], 0
+            current.append(piece)
+            current_chars += len(piece)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+CONDENSE_SYSTEM_PROMPT = """You condense course syllabi and textbooks for curriculum designers.
+Keep the learning outcomes, topics, key concepts, their order and any week or chapter structure.
+Drop examples, exercises, references and boilerplate. Respond only with the condensed text."""
+
+
+def summarize_text(model_id, text, instruction):
+    response = bedrock_runtime_client.converse(
+        modelId=model_id,
+        system=[{"text": CONDENSE_SYSTEM_PROMPT}],
+        messages=[{"role": "user", "content": [{"text": f"{instruction}\n\n<text>\n{text}\n</text>"}]}],
+        inferenceConfig={"maxTokens": CONDENSE_SUMMARY_MAX_TOKENS, "temperature": 0},
+    )
+    return "".join(block.get("text", "") for block in response["output"]["message"]["content"])
+
+
+def condense_text(text, model_id=CONDENSE_MODEL_ID, max_tokens=SYLLABUS_MAX_TOKENS):
+    """Map-reduce condensation: summarize chunks concurrently and join the summaries, repeating
+    until the text fits in max_tokens. Every round shrinks the text by roughly
+    CONDENSE_CHUNK_TOKENS / CONDENSE_SUMMARY_MAX_TOKENS, so few rounds are needed for any input size."""
+    while estimate_tokens(text) > max_tokens:
+        chunks = split_text(text, CONDENSE_CHUNK_TOKENS)
+        print(f"Condensing {estimate_tokens(text)} tokens of syllabus text in {len(chunks)} chunks")
+        with ThreadPoolExecutor(max_workers=min(CONDENSE_MAX_WORKERS, len(chunks))) as executor:
+            summaries = list(executor.map(
+                lambda chunk: summarize_text(model_id, chunk, "Condense the following part of a course syllabus."),
+                chunks))
+        text = "\n\n".join(summaries)
+        if len(chunks) == 1:
+            # a single summary is not condensed further, cut it to the budget instead
+            return text[:max_tokens * CHARS_PER_TOKEN]
+    return text
+
+
+def get_syllabus_digest_key(syllabus_text, model_id, max_tokens):
+    """S3 key of the digest of syllabus_text condensed by model_id to max_tokens"""
+    digest_hash = hashlib.sha256(f"{model_id}\n{max_tokens}\n{syllabus_text}".encode("utf-8")).hexdigest()
+    return f"{SYLLABUS_DIGEST_PREFIX}/{digest_hash}.txt"
+
+
+def get_cached_syllabus_digest(cache_bucket, digest_key):
+    try:
+        response = s3_client.get_object(Bucket=cache_bucket, Key=digest_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return response['Body'].read().decode('utf-8')
+
+
+def cache_syllabus_digest(cache_bucket, digest_key, digest):
+    try:
+        s3_client.put_object(Bucket=cache_bucket, Key=digest_key, Body=digest.encode("utf-8"))
+    except ClientError as e:
+        print(f"Unable to cache syllabus digest: {e}")
+
+
+def get_syllabus_digest(syllabus_text, cache_bucket=None, model_id=CONDENSE_MODEL_ID, max_tokens=SYLLABUS_MAX_TOKENS):
+    """Return syllabus_text unchanged when it fits in max_tokens, otherwise its condensed digest.
+    With cache_bucket the digest is stored by content hash under SYLLABUS_DIGEST_PREFIX, apart from
+    the extracted PDF text, and reused when the outline is regenerated."""
+    if estimate_tokens(syllabus_text) <= max_tokens:
+        return syllabus_text
+
+    digest_key = get_syllabus_digest_key(syllabus_text, model_id, max_tokens)
+    if cache_bucket:
+        digest = get_cached_syllabus_digest(cache_bucket, digest_key)
+        if digest is not None:
+            print(f"Using cached syllabus digest {digest_key}")
+            return digest
+
+    digest = condense_text(syllabus_text, model_id, max_tokens)
+    if cache_bucket:
+        cache_syllabus_digest(cache_bucket, digest_key, digest)
+    return digest
+
+
 def save_json_to_s3(bucket, key, llm_json_response):
     # Convert the dictionary to a JSON string
     json_content = json.dumps(llm_json_response)
@@ -61,19 +253,54 @@ def save_json_to_s3(bucket, key, llm_json_response):
     s3_client.put_object(Bucket=bucket, Key=key, Body=json_content.encode('utf-8'))
 
 
-def invoke_bedrock_converse_api(model_id, course_title, course_duration, syllabus_text, user_prompt, pydantic_classes, is_streaming):
-    # model_id = "anthropic.claude-3-haiku-20240307-v1:0"
-    # model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
-
-    system_prompt =f"""You are an AI assistant tasked with helping an instructor develop a course outline for a {course_title} course.
+def get_system_prompt(course_title, course_duration):
+    return f"""You are an AI assistant tasked with helping an instructor develop a course outline for a {course_title} course.
 You have expertise in curriculum design. Your role is to analyze the provided syllabus, extract learning outcomes, 
 and structure a {course_duration}-week course with specific learning objectives for each week. 
 Format your response in valid JSON for easy parsing and integration.
 Respond only with the requested content, without any preamble or explanation."""
 
-    user_msg_prompt = PromptTemplate.from_template(user_prompt)
-    
-    user_msg = user_msg_prompt.format(course_title=course_title, course_duration=course_duration, syllabus_text=syllabus_text)
+
+def get_tool_config(pydantic_classes):
+    tools = []
+    for class_ in pydantic_classes:
+        tools.append(convert_pydantic_to_bedrock_converse_function(class_))
+    return { "tools": tools }
+
+
+def get_outline_max_tokens(model_id, pydantic_classes, course_duration):
+    """inferenceConfig.maxTokens sized for course_duration weeks, e.g. 12 or "12 weeks".
+    Without a number of weeks the output is only capped at the model's maximum."""
+    match = re.match(r"\s*(\d+)", str(course_duration))
+    if not match:
+        return get_token_limits(model_id)[1]
+    list_lengths = dict(OUTLINE_LIST_LENGTHS, weekly_outline=int(match.group(1)))
+    return get_max_output_tokens(model_id, pydantic_classes, OUTLINE_FIELD_WORDS, list_lengths)
+
+
+def get_syllabus_token_budget(model_id, course_title, course_duration, user_prompt, pydantic_classes):
+    """Tokens left for the syllabus once the prompt, tools and output are accounted for.
+    Raises TokenBudgetExceeded when the request does not fit even without a syllabus,
+    so it fails before any PDF is read."""
+    max_tokens = get_outline_max_tokens(model_id, pydantic_classes, course_duration)
+    user_msg = format_prompt(user_prompt, course_title=course_title, course_duration=course_duration, syllabus_text="")
+    fixed_tokens = estimate_request_tokens([{"text": get_system_prompt(course_title, course_duration)}],
+                                           [{"role": "user", "content": [{"text": user_msg}]}],
+                                           get_tool_config(pydantic_classes))
+    syllabus_token_budget = get_input_token_budget(model_id, max_tokens) - fixed_tokens
+    if syllabus_token_budget <= 0:
+        raise TokenBudgetExceeded(f"Prompt of about {fixed_tokens} tokens leaves no room for the syllabus in {model_id}")
+    return syllabus_token_budget
+
+
+def invoke_bedrock_converse_api(model_id, course_title, course_duration, syllabus_text, user_prompt, pydantic_classes, is_streaming,
+                                max_tokens=None):
+    # model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+    # model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+    system_prompt = get_system_prompt(course_title, course_duration)
+
+    user_msg = format_prompt(user_prompt, course_title=course_title, course_duration=course_duration, syllabus_text=syllabus_text)
 
     messages = [{"role": "user", 
                  "content": [{
@@ -81,15 +308,15 @@ Respond only with the requested content, without any preamble or explanation."""
                      ]}
                 ]
 
-    tools = []
-    for class_ in pydantic_classes:
-        tools.append(convert_pydantic_to_bedrock_converse_function(class_))
-    tool_config = { "tools": tools }
+    tool_config = get_tool_config(pydantic_classes)
 
+    # the output is capped at the size the schema calls for, and oversized requests fail before the call
     inference_config = {
+            "maxTokens": max_tokens or get_outline_max_tokens(model_id, pydantic_classes, course_duration),
             "temperature": 0.5,
             # "topP": 0.7
         }
+    check_request_budget(model_id, [{"text": system_prompt}], messages, tool_config, inference_config["maxTokens"])
 
     if is_streaming=="yes":
         response = bedrock_runtime_client.converse_stream(
@@ -141,48 +368,76 @@ def parse_bedrock_tool_response(response):
             value_dict_["stop_reason"] = stop_reason
     return value_dict_
 
-def send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response):
-        apigatewaymanagementapi_client.post_to_connection(ConnectionId=connection_id, 
-                                                          Data=json.dumps(response).encode('utf-8'))
-        
-def process_stream_obj(response, apigatewaymanagementapi_client, connection_id):
+def process_stream_obj(response, apigatewaymanagementapi_client, connection_id, max_output_bytes,
+                       stream_object_keys=()):
+        """Stream a converse_stream response to the WebSocket client and rebuild the message.
+        Sub-objects of the tool input stored under stream_object_keys are also sent as
+        structured "partial_object" events as soon as they are complete.
+        The stream is aborted with stop reason "max_output_bytes" once more than
+        max_output_bytes of output have been received, see token_budget.get_max_output_bytes."""
         stop_reason = ""
         message = {}
         content = []
         message['content'] = content
-        text = ''
+        text_chunks = []
         tool_use = {}
+        tool_input_chunks = []
+        output_bytes = 0
+        ws_sender = BufferedWSSender(apigatewaymanagementapi_client, connection_id)
+        object_parser = IncrementalObjectParser(stream_object_keys)
 
         #stream the response into a message.
-        for chunk in response['stream']:
-            if 'messageStart' in chunk:
-                message['role'] = chunk['messageStart']['role']
-            elif 'contentBlockStart' in chunk:
-                tool = chunk['contentBlockStart']['start']['toolUse']
-                tool_use['toolUseId'] = tool['toolUseId']
-                tool_use['name'] = tool['name']
-            elif 'contentBlockDelta' in chunk:
-                delta = chunk['contentBlockDelta']['delta']
-                if 'toolUse' in delta:
-                    if 'input' not in tool_use:
-                        tool_use['input'] = ''
-                    tool_use['input'] += delta['toolUse']['input']
-                    print(delta['toolUse']['input'])
-                    send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, delta['toolUse']['input'])
-                elif 'text' in delta:
-                    text += delta['text']
-                    print(delta['text'], end='')
-                    # send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, delta['text'])
-            elif 'contentBlockStop' in chunk:
-                if 'input' in tool_use:
-                    tool_use['input'] = json.loads(tool_use['input'])
-                    content.append({'toolUse': tool_use})
-                    tool_use = {}
-                else:
-                    content.append({'text': text})
-                    text = ''
-
-            elif 'messageStop' in chunk:
-                stop_reason = chunk['messageStop']['stopReason']
+        try:
+            for chunk in response['stream']:
+                if 'messageStart' in chunk:
+                    message['role'] = chunk['messageStart']['role']
+                elif 'contentBlockStart' in chunk:
+                    tool = chunk['contentBlockStart']['start']['toolUse']
+                    tool_use['toolUseId'] = tool['toolUseId']
+                    tool_use['name'] = tool['name']
+                    object_parser = IncrementalObjectParser(stream_object_keys)
+                elif 'contentBlockDelta' in chunk:
+                    delta = chunk['contentBlockDelta']['delta']
+                    delta_text = delta['toolUse']['input'] if 'toolUse' in delta else delta.get('text', '')
+                    output_bytes += len(delta_text.encode('utf-8'))
+                    if output_bytes > max_output_bytes:
+                        LOGGER.error(f"Aborting generation after {output_bytes} bytes of output")
+                        stop_reason = "max_output_bytes"
+                        response['stream'].close()
+                        break
+
+                    if 'toolUse' in delta:
+                        tool_input_chunks.append(delta_text)
+                        LOGGER.debug(delta_text)
+                        ws_sender.send(delta_text)
+                        for key, index, obj in object_parser.feed(delta_text):
+                            ws_sender.send_event({"event": "partial_object", "key": key, "index": index, "data": obj})
+                    elif 'text' in delta:
+                        text_chunks.append(delta_text)
+                        LOGGER.debug(delta_text)
+                        # ws_sender.send(delta_text)
+                elif 'contentBlockStop' in chunk:
+                    ws_sender.flush()
+                    if tool_input_chunks:
+                        try:
+                            tool_use['input'] = json.loads("".join(tool_input_chunks))
+                            content.append({'toolUse': tool_use})
+                        except json.JSONDecodeError:
+                            # cut off by maxTokens, the messageStop that follows reports "max_tokens"
+                            LOGGER.error("Tool input is incomplete, dropping it")
+                        tool_use = {}
+                        tool_input_chunks = []
+                    else:
+                        content.append({'text': "".join(text_chunks)})
+                        text_chunks = []
+
+                elif 'messageStop' in chunk:
+                    ws_sender.flush()
+                    stop_reason = chunk['messageStop']['stopReason']
+                elif 'metadata' in chunk:
+                    LOGGER.info(f"Token usage: {chunk['metadata'].get('usage')}")
+        finally:
+            ws_sender.close()
+            LOGGER.info(f"Received {output_bytes} bytes of output, sent {ws_sender.frames_sent} frames to client")
 
         return stop_reason, message
\ No newline at end of file
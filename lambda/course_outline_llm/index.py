@@ -2,13 +2,14 @@
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from helper import * 
 from CourseOutlinePydantic import CourseOutline
+from course_outline_store import get_course_outline_key
 import os
 
-def lambda_handler(event, context):
-    print(event)
-    event = json.loads(event['Records'][0]['body'])
+def generate_course_outline(record):
+    event = json.loads(record['body'])
     try:
         connection_id = event['requestContext']['connectionId']
         body = json.loads(event["body"])
@@ -45,24 +46,37 @@ def lambda_handler(event, context):
 Ensure that each week has 3 main learning outcomes and each of those has 3 supporting sub-learning outcomes.'''
     
     ## send message to api that message received
-    apigatewaymanagementapi_client = boto3.client('apigatewaymanagementapi', endpoint_url=websocket_endpoint_url)
+    apigatewaymanagementapi_client = get_client('apigatewaymanagementapi', endpoint_url=websocket_endpoint_url)
     # send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response={'message':'Debugging... inside another lambda', "connection_id":connection_id})
 
-    syllabus_text = ""
-    for s3_input_uri in s3_input_uri_list:
-        bucket, key = get_s3_bucket_and_key(s3_input_uri)
-        if key.endswith('.pdf'):
-            pdf_text = extract_text_from_pdf(bucket, key)
-            syllabus_text = syllabus_text + pdf_text
-
-
     # Initialize the Pydantic model
     pydantic_classes = [CourseOutline]
 
+    # requests that cannot fit the model are rejected before any PDF is read
+    try:
+        syllabus_token_budget = get_syllabus_token_budget(model_id, course_title, course_duration, user_prompt, pydantic_classes)
+    except TokenBudgetExceeded as e:
+        print(e)
+        send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response=f"Unable to generate course outline: {e}")
+        return {'statusCode': 400,
+                'body': json.dumps({'error': str(e)})}
+
+    syllabus_text = extract_text_from_pdfs(s3_input_uri_list, cache_bucket=output_bucket)
+    # oversized syllabi are condensed so generation time does not grow with the document size
+    syllabus_text = get_syllabus_digest(syllabus_text, cache_bucket=output_bucket,
+                                        max_tokens=min(SYLLABUS_MAX_TOKENS, syllabus_token_budget))
+
     course_outline = {}
+    max_tokens = get_outline_max_tokens(model_id, pydantic_classes, course_duration)
     if is_streaming == "yes":
-        converse_response = invoke_bedrock_converse_api(model_id, course_title, course_duration, syllabus_text, user_prompt, pydantic_classes, is_streaming=is_streaming)
-        stop_reason, message = process_stream_obj(converse_response, apigatewaymanagementapi_client, connection_id)
+        converse_response = invoke_bedrock_converse_api(model_id, course_title, course_duration, syllabus_text, user_prompt, pydantic_classes, is_streaming=is_streaming,
+                                                        max_tokens=max_tokens)
+        stop_reason, message = process_stream_obj(converse_response, apigatewaymanagementapi_client, connection_id,
+                                                  get_max_output_bytes(max_tokens), stream_object_keys=("weekly_outline",))
+        if stop_reason in ("max_tokens", "max_output_bytes"):
+            # the client already received part of the outline, fail fast instead of streaming it again
+            send_message_to_ws_client(apigatewaymanagementapi_client, connection_id,
+                                      response=f"Course outline exceeded the limit of {max_tokens} output tokens.")
         if stop_reason == "tool_use":
             for content in message['content']:
                 if 'toolUse' in content:
@@ -74,9 +88,17 @@ Ensure that each week has 3 main learning outcomes and each of those has 3 suppo
         MAX_RETRIES = 2
         count = 0
         while len(course_outline) == 0 and count < MAX_RETRIES:
-            converse_response = invoke_bedrock_converse_api(model_id, course_title, course_duration, syllabus_text, user_prompt, pydantic_classes, is_streaming=is_streaming)
+            converse_response = invoke_bedrock_converse_api(model_id, course_title, course_duration, syllabus_text, user_prompt, pydantic_classes, is_streaming=is_streaming,
+                                                            max_tokens=max_tokens)
             course_outline = parse_bedrock_tool_response(converse_response)
             count += 1
+            if converse_response['stopReason'] == 'max_tokens':
+                # a truncated outline is not kept, retry once at the model maximum
+                course_outline = {}
+                max_tokens = get_retry_max_tokens(model_id, max_tokens)
+                print(f"Course outline exceeded maxTokens on attempt {count}")
+                if max_tokens is None:
+                    break
             
         if len(course_outline) != 0:
             send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response=course_outline)
@@ -86,9 +108,10 @@ Ensure that each week has 3 main learning outcomes and each of those has 3 suppo
     print(course_outline)
     
 
-    # Save the course content to S3
-    output_key = f"course_outline/{course_title}/course_outline.json"
-    save_json_to_s3(output_bucket, output_key, course_outline)
+    # Save the course outline to S3, a failed generation does not replace a saved outline
+    if len(course_outline) != 0:
+        output_key = get_course_outline_key(course_title)
+        save_json_to_s3(output_bucket, output_key, course_outline)
         
     return {'statusCode': 200,
             'body': json.dumps({
@@ -97,6 +120,30 @@ Ensure that each week has 3 main learning outcomes and each of those has 3 suppo
         }
 
 
+def lambda_handler(event, context):
+    print(event)
+
+    # configure python logger for Lambda, set VERBOSE to log every streamed delta
+    configure_logger()
+    # silence chatty libraries for better logging
+    silence_noisy_loggers()
+    records = event['Records']
+
+    # Process every message of the batch concurrently and report only the failed
+    # ones, so the rest of the batch is not redriven to the DLQ
+    batch_item_failures = []
+    with ThreadPoolExecutor(max_workers=len(records)) as executor:
+        futures = {executor.submit(generate_course_outline, record): record['messageId'] for record in records}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to process message {futures[future]}: {e}")
+                batch_item_failures.append({"itemIdentifier": futures[future]})
+
+    return {"batchItemFailures": batch_item_failures}
+
+
 if __name__ == "__main__":
     event = None
     lambda_handler(event, None)
\ No newline at end of file
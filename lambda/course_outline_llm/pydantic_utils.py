@@ -5,6 +5,7 @@ from typing_extensions import TypedDict
 from typing import Any, Dict, List, Optional, Type, Sequence, Set
 from pydantic import BaseModel
 from copy import deepcopy
+from functools import lru_cache
 
 class FunctionDescription(TypedDict):
     """Representation of a callable function to send to an LLM."""
@@ -128,7 +129,8 @@ def _rm_titles(kv: dict, prev_key: str = "") -> dict:
             new_kv[k] = v
     return new_kv
 
-    
+
+@lru_cache(maxsize=None)
 def convert_pydantic_to_bedrock_converse_function(
     model: Type[BaseModel],
     *,
@@ -136,7 +138,11 @@ def convert_pydantic_to_bedrock_converse_function(
     description: Optional[str] = None,
     rm_titles: bool = True,
 ) -> FunctionDescription:
-    """Converts a Pydantic model to a function description for the Bedrock Anthropic API."""
+    """Converts a Pydantic model to a function description for the Bedrock Anthropic API.
+
+    The result is computed once per model class and arguments, then reused across
+    warm invocations and retries; callers must treat the returned dict as read-only.
+    """
     schema = dereference_refs(model.model_json_schema())
     schema.pop("definitions", None)
     title = schema.pop("title", "")
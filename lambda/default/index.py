@@ -2,15 +2,14 @@
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
 import time
-import boto3
+from aws_clients import get_client
 import json
 
 # Create a client to interact with API Gateway Management API
 def get_api_client(event):
     domain_name = event['requestContext']['domainName']
     stage = event['requestContext']['stage']
-    return boto3.client('apigatewaymanagementapi',
-                        endpoint_url=f'https://{domain_name}/{stage}')
+    return get_client('apigatewaymanagementapi', endpoint_url=f'https://{domain_name}/{stage}')
 
 
 def lambda_handler(event, context):
@@ -27,6 +26,7 @@ def lambda_handler(event, context):
 
         message = '''if you want to invoke courseOutline route please pass dictonary in following format {"action":"courseOutline", "user_prompt":"As a user..."} 
         If you want to invoke courseContent route please pass dictonary in following format {"action":"courseContent", "user_prompt":"As a user..."} 
+        If you want to invoke courseBuild route please pass dictonary in following format {"action":"courseBuild", "course_title":"Fundamentals of...", "user_prompt":"As a user..."} 
         If you want to invoke qnaBot route please pass dictonary in following format {"action":"qnaBot", "user_question":"What is Machine..."}'''
 
         response_message = {
@@ -3,10 +3,10 @@
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
 import os
 import json
-import boto3
+from aws_clients import get_client
 from datetime import datetime, timedelta
 
-dynamodb = boto3.client('dynamodb')
+dynamodb = get_client('dynamodb')
 CONNECTIONS_TABLE = os.environ.get('CONNECTIONS_TABLE')
 
 def lambda_handler(event, context):
@@ -1,9 +1,13 @@
 ## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+import hashlib
 import logging
 import os
+import threading
 import time
+from collections import OrderedDict
+import jwt
 
 LOGGER = logging.getLogger()
 BASE_ISSUER_URL = f"https://cognito-idp.{os.environ['API_REGION']}.amazonaws.com/{os.environ['COGNITO_USER_POOL_ID']}"
@@ -11,6 +15,14 @@ BASE_ISSUER_URL = f"https://cognito-idp.{os.environ['API_REGION']}.amazonaws.com
 JWKS_URL = f"{BASE_ISSUER_URL}/.well-known/jwks.json"
 VALID_TOKEN_USE = ["id"] 
 
+# Signing keys are reused across warm invocations, refreshed after the TTL
+# or when a token references a kid we have not seen yet
+JWKS_CACHE_TTL_SECONDS = int(os.environ.get("JWKS_CACHE_TTL_SECONDS", 3600))
+JWKS_MIN_REFRESH_SECONDS = int(os.environ.get("JWKS_MIN_REFRESH_SECONDS", 30))
+
+# Upper bound on the number of already-verified tokens remembered per process
+VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get("VERIFIED_TOKEN_CACHE_SIZE", 1024))
+
 AUTHORIZED_RESPONSE = {
     "policyDocument": {
         "Version": "2012-10-17",
@@ -99,3 +111,136 @@ def valid_token(token, audience):
     
     LOGGER.info("Decoded token is verified to be valid")
     return True
+
+
+def fetch_jwks(jwks_url):
+    """Download the JSON Web Key Set published at jwks_url
+
+    :param jwks_url: String
+
+    :rtype: Dictionary
+    """
+    return jwt.PyJWKClient(jwks_url, cache_jwk_set=False).fetch_data()
+
+
+class SigningKeyCache:
+    """Process-wide cache of JWKS signing keys keyed by kid.
+
+    Keys are refetched once the TTL has elapsed, and once more when a token
+    carries an unknown kid (Cognito key rotation). Refetches are single-flight:
+    concurrent callers wait for the request already in progress instead of
+    issuing their own.
+    """
+
+    def __init__(self, jwks_url, ttl_seconds=JWKS_CACHE_TTL_SECONDS,
+                 min_refresh_seconds=JWKS_MIN_REFRESH_SECONDS, fetcher=fetch_jwks):
+        self.jwks_url = jwks_url
+        self.ttl_seconds = ttl_seconds
+        self.min_refresh_seconds = min_refresh_seconds
+        self.fetcher = fetcher
+        self._keys = {}
+        self._fetched_at = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _age(self):
+        if self._fetched_at is None:
+            return None
+        return time.monotonic() - self._fetched_at
+
+    def _refresh(self, seen_generation):
+        """Refetch the key set unless another caller already did so after seen_generation"""
+        with self._lock:
+            if self._generation != seen_generation:
+                return
+            LOGGER.info(f"Fetching signing keys from: {self.jwks_url}")
+            jwk_set = jwt.PyJWKSet.from_dict(self.fetcher(self.jwks_url))
+            self._keys = {jwk.key_id: jwk for jwk in jwk_set.keys if jwk.key_id}
+            self._fetched_at = time.monotonic()
+            self._generation += 1
+
+    def get_signing_key(self, kid):
+        """Return the PyJWK matching kid, fetching the key set if required
+
+        :param kid: String
+
+        :rtype: jwt.PyJWK
+        """
+        generation = self._generation
+        age = self._age()
+        if age is None or age > self.ttl_seconds:
+            self._refresh(generation)
+        elif kid not in self._keys and age > self.min_refresh_seconds:
+            LOGGER.info(f"Unknown kid {kid}, refreshing signing keys")
+            self._refresh(generation)
+
+        signing_key = self._keys.get(kid)
+        if signing_key is None:
+            raise jwt.exceptions.PyJWKClientError(
+                f'Unable to find a signing key that matches: "{kid}"')
+        return signing_key
+
+
+SIGNING_KEY_CACHE = SigningKeyCache(JWKS_URL)
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of already-verified tokens.
+
+    Entries are keyed by the SHA-256 digest of the raw token string and hold
+    the token's exp claim, so a reconnect with the same token is accepted
+    without decoding it again until it expires.
+    """
+
+    def __init__(self, max_size=VERIFIED_TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token_string):
+        return hashlib.sha256(token_string.encode("utf-8")).hexdigest()
+
+    def is_verified(self, token_string):
+        """Check whether token_string was verified before and has not expired
+
+        :param token_string: String
+
+        :rtype: Boolean
+        """
+        digest = self._digest(token_string)
+        with self._lock:
+            expiry_time = self._entries.get(digest)
+            if expiry_time is not None and int(time.time()) > expiry_time:
+                del self._entries[digest]
+                expiry_time = None
+
+            if expiry_time is None:
+                self.misses += 1
+                return False
+
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return True
+
+    def add(self, token_string, expiry_time):
+        """Remember token_string as verified until expiry_time
+
+        :param token_string: String
+        :param expiry_time: Integer, the token's exp claim
+        """
+        digest = self._digest(token_string)
+        with self._lock:
+            self._entries[digest] = int(expiry_time)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def log_stats(self):
+        LOGGER.info(f"Verified token cache: {self.hits} hits, {self.misses} misses, "
+                    f"{len(self._entries)} entries")
+
+
+VERIFIED_TOKEN_CACHE = VerifiedTokenCache()
@@ -29,6 +29,12 @@ def lambda_handler(event, context):
         if not token_string:
             LOGGER.error("empty token provided")
             return UNAUTHORIZED_RESPONSE
+
+        already_verified = VERIFIED_TOKEN_CACHE.is_verified(token_string)
+        VERIFIED_TOKEN_CACHE.log_stats()
+        if already_verified:
+            LOGGER.info("Token was already verified and has not expired")
+            return AUTHORIZED_RESPONSE
         
         LOGGER.info("Attempting to extract headers from the token string")
         try:
@@ -38,12 +44,9 @@ def lambda_handler(event, context):
                 f"Unable to extract headers from the token string: {err}")
             return UNAUTHORIZED_RESPONSE
 
-        LOGGER.info(f"Initializing jwks client for: {JWKS_URL}")
-        jwks_client = jwt.PyJWKClient(JWKS_URL)
-
         LOGGER.info("Trying to get the signing key from the token header")
         try:
-            key = jwks_client.get_signing_key(token_header["kid"]).key
+            key = SIGNING_KEY_CACHE.get_signing_key(token_header["kid"]).key
         except jwt.exceptions.PyJWKSetError as err:
             LOGGER.error(f"Unable to fetch keys: {err}")
             return UNAUTHORIZED_RESPONSE
@@ -77,6 +80,8 @@ def lambda_handler(event, context):
         
         if not valid_token(decoded_token, audience_client):
             return UNAUTHORIZED_RESPONSE
+
+        VERIFIED_TOKEN_CACHE.add(token_string, decoded_token["exp"])
         
         return AUTHORIZED_RESPONSE
 
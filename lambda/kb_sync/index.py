@@ -1,9 +1,29 @@
 import os
 import json
-import boto3
+from aws_clients import get_client
 import hashlib
 
-bedrock_agent_client = boto3.client('bedrock-agent')
+bedrock_agent_client = get_client('bedrock-agent')
+dynamodb = get_client('dynamodb')
+
+
+def set_kb_generation(table_name, ingestion_job, knowledge_base_id, data_source_id):
+    """Record the new ingestion job as the knowledge base generation used in QnA cache keys,
+    which makes every entry cached before this sync unreachable. The QnA bot polls the job
+    status and starts another generation once the job has finished."""
+    dynamodb.put_item(
+        TableName=table_name,
+        Item={
+            'scope': {'S': 'kb_generation'},
+            'key_hash': {'S': 'current'},
+            'generation': {'S': ingestion_job['ingestionJobId']},
+            'status': {'S': ingestion_job['status']},
+            'knowledge_base_id': {'S': knowledge_base_id},
+            'data_source_id': {'S': data_source_id},
+        }
+    )
+
+
 def lambda_handler(event, context):
     print(event)
     data_source_id = os.environ['DATA_SOURCE_ID']
@@ -19,6 +39,10 @@ def lambda_handler(event, context):
                                                         )
     print(response)
 
+    qna_cache_table = os.environ.get('QNA_CACHE_TABLE')
+    if qna_cache_table:
+        set_kb_generation(qna_cache_table, response['ingestionJob'], knowledge_base_id, data_source_id)
+
     return {
         'statusCode': 200, 
         'body': json.dumps(response)
@@ -0,0 +1,47 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Shared boto3 clients for the lambda functions.
+
+Clients are created once per execution environment and reused across invocations,
+so warm invocations skip client construction and keep their pooled connections alive.
+"""
+import json
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# sized for the thread pools used when processing SQS batches and streaming to clients
+MAX_POOL_CONNECTIONS = int(os.getenv("AWS_CLIENT_MAX_POOL_CONNECTIONS", 50))
+MAX_RETRY_ATTEMPTS = int(os.getenv("AWS_CLIENT_MAX_RETRY_ATTEMPTS", 5))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name, endpoint_url=None, **config):
+    """Return a cached boto3 client for the service, endpoint and botocore config.
+
+    :param service_name: String, e.g. "s3" or "bedrock-runtime"
+    :param endpoint_url: String, e.g. the WebSocket API callback url for "apigatewaymanagementapi"
+    :param config: botocore Config options overriding the defaults, e.g. read_timeout=300
+
+    :rtype: boto3 client
+    """
+    key = (service_name, endpoint_url, json.dumps(config, sort_keys=True))
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client_config = Config(
+                max_pool_connections=MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True,
+                retries={"max_attempts": MAX_RETRY_ATTEMPTS, "mode": "adaptive"},
+            ).merge(Config(**config))
+            client = boto3.client(service_name, endpoint_url=endpoint_url, config=client_config)
+            _clients[key] = client
+    return client
@@ -0,0 +1,18 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Location of the course outlines saved in the output bucket by course_outline_llm."""
+import json
+from aws_clients import get_client
+
+
+def get_course_outline_key(course_title):
+    return f"course_outline/{course_title}/course_outline.json"
+
+
+def load_course_outline(bucket, course_title):
+    """Read the saved outline of the course, raises botocore ClientError when there is none"""
+    response = get_client("s3").get_object(Bucket=bucket, Key=get_course_outline_key(course_title))
+    course_outline = json.loads(response['Body'].read())
+    # non-streaming outlines are saved under the name of the tool that produced them
+    return course_outline.get("CourseOutline", course_outline)
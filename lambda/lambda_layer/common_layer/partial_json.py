@@ -0,0 +1,91 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+import json
+
+
+class IncrementalObjectParser:
+    """Incrementally scans streamed JSON text and returns sub-objects as soon as they close.
+
+    Only objects stored under one of the given keys are returned, either directly
+    ({"reading_material": {...}}) or as elements of an array under that key
+    ({"sub_learning_outcomes_content": [{...}, {...}]}). Nested matches inside an
+    object that is already being captured are returned as part of that object.
+    """
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._is_key = False
+        self._key_chars = []
+        self._capture = None
+        self._capture_depth = 0
+        self._capture_key = None
+        self._capture_index = None
+
+    def _start_container(self, char):
+        parent = self._stack[-1] if self._stack else None
+        key, index = None, None
+        if parent is not None and parent["type"] == "{":
+            key = parent["current_key"]
+        elif parent is not None:
+            key, index = parent["key"], parent["count"]
+
+        if char == "{" and self._capture is None and key in self.keys:
+            self._capture = [char]
+            self._capture_depth = len(self._stack)
+            self._capture_key = key
+            self._capture_index = index
+
+        self._stack.append({"type": char, "key": key, "current_key": None, "expect_key": True, "count": 0})
+
+    def feed(self, fragment):
+        """Consume the next fragment of JSON text.
+
+        :param fragment: String
+
+        :rtype: List of (key, index, object) tuples, index is None for non-array values
+        """
+        completed = []
+        for char in fragment:
+            if self._capture is not None:
+                self._capture.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._is_key:
+                        self._stack[-1]["current_key"] = "".join(self._key_chars)
+                    continue
+                if self._is_key:
+                    self._key_chars.append(char)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                top = self._stack[-1] if self._stack else None
+                self._is_key = top is not None and top["type"] == "{" and top["expect_key"]
+                self._key_chars = []
+            elif char in "{[":
+                self._start_container(char)
+            elif char in "}]":
+                if not self._stack:
+                    continue
+                self._stack.pop()
+                if self._capture is not None and len(self._stack) == self._capture_depth:
+                    completed.append((self._capture_key, self._capture_index, json.loads("".join(self._capture))))
+                    self._capture = None
+            elif char == ":" and self._stack:
+                self._stack[-1]["expect_key"] = False
+            elif char == "," and self._stack:
+                if self._stack[-1]["type"] == "{":
+                    self._stack[-1]["expect_key"] = True
+                else:
+                    self._stack[-1]["count"] += 1
+        return completed
@@ -0,0 +1,13 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Terms of English text for the lexical scoring of passages and retrieval results."""
+import re
+
+STOP_WORDS = frozenset("""a an and are as at be but by can do does for from how i in is it its
+of on or that the this to was what when where which who why will with you your""".split())
+
+
+def tokenize(text):
+    """Lowercase words of the text without stop words, in order"""
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOP_WORDS]
@@ -0,0 +1,162 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Local token estimates and limits for Bedrock converse requests.
+
+Token counts are estimated from the text length, which is fast and close enough to size a
+request before it is sent: context that cannot fit the model's context window is trimmed
+by the caller or the request is rejected without invoking the model, and the output is
+capped with inferenceConfig.maxTokens at the size of the tool input the Pydantic schema
+describes.
+"""
+import json
+import os
+import typing
+
+# rough number of characters per token, and tokens per word, of English text
+CHARS_PER_TOKEN = 4
+TOKENS_PER_WORD = 1.35
+# share of the context window kept free for the error of the estimate
+CONTEXT_WINDOW_MARGIN = 0.1
+# headroom over the estimated size of the generated tool input
+OUTPUT_TOKEN_MARGIN = 1.25
+# streamed output allowed per token of maxTokens, several times the bytes of a typical token,
+# so only runaway output (e.g. long runs of whitespace) is cut off before maxTokens is reached
+MAX_OUTPUT_BYTES_PER_TOKEN = 16
+# tokens of a JSON key with its quotes and separators
+JSON_FIELD_TOKENS = 4
+# size assumed for string fields and lists the caller gives no size for
+DEFAULT_STRING_WORDS = 20
+DEFAULT_LIST_LENGTH = 3
+
+# (context window, maximum output tokens) by model id prefix, the longest matching prefix wins
+MODEL_TOKEN_LIMITS = {
+    "anthropic.claude-3": (200000, 4096),
+    "anthropic.claude-3-5-haiku": (200000, 8192),
+    "anthropic.claude-3-5-sonnet-20241022": (200000, 8192),
+    "amazon.nova": (300000, 5000),
+    "amazon.nova-micro": (128000, 5000),
+}
+DEFAULT_TOKEN_LIMITS = (200000, 4096)
+# prefixes of cross-region inference profile ids
+INFERENCE_PROFILE_REGIONS = ("us", "eu", "apac", "us-gov")
+
+
+class TokenBudgetExceeded(ValueError):
+    """Raised when a request cannot fit the context window of its model"""
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def get_token_limits(model_id):
+    """Return (context window, maximum output tokens) of the model.
+    MODEL_CONTEXT_TOKENS and MODEL_MAX_OUTPUT_TOKENS override the table for models it does not know."""
+    base_model_id = model_id.split("/")[-1]
+    region, _, rest = base_model_id.partition(".")
+    if region in INFERENCE_PROFILE_REGIONS:
+        base_model_id = rest
+
+    context_tokens, max_output_tokens = DEFAULT_TOKEN_LIMITS
+    matches = [prefix for prefix in MODEL_TOKEN_LIMITS if base_model_id.startswith(prefix)]
+    if matches:
+        context_tokens, max_output_tokens = MODEL_TOKEN_LIMITS[max(matches, key=len)]
+    return (int(os.getenv("MODEL_CONTEXT_TOKENS", context_tokens)),
+            int(os.getenv("MODEL_MAX_OUTPUT_TOKENS", max_output_tokens)))
+
+
+def estimate_content_tokens(content_blocks):
+    """Estimated tokens of converse content blocks, cache points excluded"""
+    tokens = 0
+    for block in content_blocks:
+        if "text" in block:
+            tokens += estimate_tokens(block["text"])
+        elif "cachePoint" not in block:
+            tokens += estimate_tokens(json.dumps(block, default=str))
+    return tokens
+
+
+def estimate_request_tokens(system, messages, tool_config=None):
+    """Estimated input tokens of a converse request"""
+    tokens = estimate_content_tokens(system)
+    for message in messages:
+        tokens += estimate_content_tokens(message["content"])
+    if tool_config:
+        tokens += estimate_tokens(json.dumps(tool_config))
+    return tokens
+
+
+def _annotation_tokens(name, annotation, field_words, list_lengths):
+    origin = typing.get_origin(annotation)
+    args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+    if origin is list:
+        item = args[0] if args else str
+        return list_lengths.get(name, DEFAULT_LIST_LENGTH) * (_annotation_tokens(name, item, field_words, list_lengths) + 1)
+    if origin is typing.Union and args:
+        return _annotation_tokens(name, args[0], field_words, list_lengths)
+    # nested Pydantic models, checked without importing pydantic so lambdas without it can use this module
+    if isinstance(annotation, type) and hasattr(annotation, "model_fields"):
+        return schema_output_tokens(annotation, field_words, list_lengths)
+    if annotation is str:
+        return int(field_words.get(name, DEFAULT_STRING_WORDS) * TOKENS_PER_WORD) + 2
+    # numbers and booleans
+    return 2
+
+
+def schema_output_tokens(pydantic_class, field_words=None, list_lengths=None):
+    """Estimated tokens of a JSON instance of pydantic_class.
+
+    :param pydantic_class: Pydantic model of the tool input
+    :param field_words: expected number of words of the string fields (or list items) by field name
+    :param list_lengths: expected number of items of the list fields by field name
+
+    :rtype: int
+    """
+    field_words = field_words or {}
+    list_lengths = list_lengths or {}
+    tokens = 2
+    for name, field in pydantic_class.model_fields.items():
+        tokens += JSON_FIELD_TOKENS + _annotation_tokens(name, field.annotation, field_words, list_lengths)
+    return tokens
+
+
+def get_max_output_tokens(model_id, pydantic_classes, field_words=None, list_lengths=None):
+    """inferenceConfig.maxTokens for a request answered with one of the pydantic_classes tools:
+    the estimated size of the largest tool input with some headroom, capped at what the model can generate"""
+    max_output_tokens = get_token_limits(model_id)[1]
+    estimate = int(max(schema_output_tokens(class_, field_words, list_lengths) for class_ in pydantic_classes)
+                   * OUTPUT_TOKEN_MARGIN)
+    if estimate > max_output_tokens:
+        print(f"Estimated output of {estimate} tokens exceeds the {max_output_tokens} tokens {model_id} can generate")
+    return min(estimate, max_output_tokens)
+
+
+def get_retry_max_tokens(model_id, max_tokens):
+    """maxTokens for another attempt after a response stopped at max_tokens: the model's maximum,
+    or None when the request already had it, since the same cap would cut the output off again"""
+    max_output_tokens = get_token_limits(model_id)[1]
+    return max_output_tokens if max_tokens < max_output_tokens else None
+
+
+def get_max_output_bytes(max_tokens):
+    """Bytes of streamed output after which a generation capped at max_tokens is aborted"""
+    return max_tokens * MAX_OUTPUT_BYTES_PER_TOKEN
+
+
+def get_input_token_budget(model_id, max_output_tokens):
+    """Input tokens a request can use next to max_output_tokens of output"""
+    context_tokens = get_token_limits(model_id)[0]
+    return int(context_tokens * (1 - CONTEXT_WINDOW_MARGIN)) - max_output_tokens
+
+
+def check_request_budget(model_id, system, messages, tool_config, max_output_tokens):
+    """Pre-flight check of a converse request, raises TokenBudgetExceeded when it cannot fit
+    the context window of the model. Returns the estimated input tokens."""
+    input_tokens = estimate_request_tokens(system, messages, tool_config)
+    input_token_budget = get_input_token_budget(model_id, max_output_tokens)
+    if input_tokens > input_token_budget:
+        raise TokenBudgetExceeded(f"Request of about {input_tokens} input tokens exceeds the budget of "
+                                  f"{input_token_budget} tokens of {model_id} with {max_output_tokens} output tokens")
+    print(f"Request of about {input_tokens} input tokens, maxTokens {max_output_tokens}")
+    return input_tokens
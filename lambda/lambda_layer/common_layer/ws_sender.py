@@ -0,0 +1,90 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Posting messages to WebSocket API connections from the lambda functions."""
+import json
+import os
+import queue
+import threading
+import time
+
+# streamed text is coalesced into WebSocket frames of up to this size or age
+WS_FRAME_MAX_BYTES = int(os.getenv("WS_FRAME_MAX_BYTES", 2048))
+WS_FRAME_MAX_DELAY = float(os.getenv("WS_FRAME_MAX_DELAY", 0.1))
+
+
+def send_message_to_ws_client(apigatewaymanagementapi_client, connection_id, response):
+    apigatewaymanagementapi_client.post_to_connection(ConnectionId=connection_id,
+                                                      Data=json.dumps(response).encode('utf-8'))
+
+
+class BufferedWSSender:
+    """Coalesces small WebSocket frames and posts them from a background thread.
+
+    Text sent through send() is buffered until it reaches max_bytes or max_delay
+    seconds have passed since the last flush, then posted as a single frame, so
+    reading the Bedrock stream never waits on API Gateway. The background thread
+    also flushes text older than max_delay, so a stalled stream does not hold it back.
+    Call close() to flush what is left and wait for every frame to be delivered.
+    """
+
+    def __init__(self, apigatewaymanagementapi_client, connection_id,
+                 max_bytes=WS_FRAME_MAX_BYTES, max_delay=WS_FRAME_MAX_DELAY):
+        self.apigatewaymanagementapi_client = apigatewaymanagementapi_client
+        self.connection_id = connection_id
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.frames_sent = 0
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+        self._buffer_lock = threading.Lock()
+        self._frames = queue.Queue()
+        self._worker = threading.Thread(target=self._send_frames, daemon=True)
+        self._worker.start()
+
+    def _send_frames(self):
+        while True:
+            try:
+                frame = self._frames.get(timeout=self.max_delay)
+            except queue.Empty:
+                with self._buffer_lock:
+                    if time.monotonic() - self._last_flush >= self.max_delay:
+                        self._flush()
+                continue
+            if frame is None:
+                break
+            try:
+                send_message_to_ws_client(self.apigatewaymanagementapi_client, self.connection_id, frame)
+                self.frames_sent += 1
+            except Exception as e:
+                print(f"Unable to send message to client: {e}")
+
+    def send(self, text):
+        with self._buffer_lock:
+            self._buffer.append(text)
+            self._buffered_bytes += len(text.encode('utf-8'))
+            if self._buffered_bytes >= self.max_bytes or time.monotonic() - self._last_flush >= self.max_delay:
+                self._flush()
+
+    def send_event(self, event):
+        """Send a structured event as its own frame, after any buffered text"""
+        with self._buffer_lock:
+            self._flush()
+            self._frames.put(event)
+
+    def flush(self):
+        with self._buffer_lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._frames.put("".join(self._buffer))
+            self._buffer = []
+            self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._frames.put(None)
+        self._worker.join()
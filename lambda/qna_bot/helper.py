@@ -1,10 +1,132 @@
 ## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 ## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
 ## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
-import boto3
+import hashlib
+import json
+import os
+import time
+import uuid
+from aws_clients import get_client
+from botocore.exceptions import ClientError
+from ws_sender import BufferedWSSender, send_message_to_ws_client
+from semantic_cache import SemanticCache
+from rerank import rerank_results
 
 
-bedrock_agent_runtime_client = boto3.client("bedrock-agent-runtime")
+bedrock_agent_runtime_client = get_client("bedrock-agent-runtime")
+bedrock_runtime_client = get_client("bedrock-runtime")
+dynamodb = get_client("dynamodb")
+
+# answers are cached per retrieval filter (course and week), and invalidated by every knowledge base sync
+QNA_CACHE_TABLE = os.getenv("QNA_CACHE_TABLE", "")
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+# an exact miss compares the question with at most this many questions cached within the window
+CACHE_SIMILARITY_MAX_CANDIDATES = int(os.getenv("CACHE_SIMILARITY_MAX_CANDIDATES", 200))
+CACHE_SIMILARITY_WINDOW_SECONDS = int(os.getenv("CACHE_SIMILARITY_WINDOW_SECONDS", 24 * 3600))
+answer_cache = SemanticCache(QNA_CACHE_TABLE, "answer", ANSWER_CACHE_TTL_SECONDS,
+                             embedding_model_id=os.getenv("ANSWER_CACHE_EMBEDDING_MODEL_ID") or None,
+                             similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.95)),
+                             max_candidates=CACHE_SIMILARITY_MAX_CANDIDATES,
+                             window_seconds=CACHE_SIMILARITY_WINDOW_SECONDS
+                             ) if QNA_CACHE_TABLE else None
+# the two stage pipeline keeps a sliding window of compacted turns per session
+QNA_SESSIONS_TABLE = os.getenv("QNA_SESSIONS_TABLE", "")
+SESSION_MAX_TURNS = int(os.getenv("QNA_SESSION_MAX_TURNS", 5))
+SESSION_ANSWER_MAX_CHARS = int(os.getenv("QNA_SESSION_ANSWER_MAX_CHARS", 1000))
+SESSION_TTL_SECONDS = int(os.getenv("QNA_SESSION_TTL_SECONDS", 24 * 3600))
+# two stage session ids are told apart from the Bedrock knowledge base session ids of the default pipeline
+TWO_STAGE_SESSION_PREFIX = "two-stage-"
+# errors of retrieve_and_generate for a session id Bedrock does not know, e.g. an expired session
+INVALID_SESSION_ERROR_CODES = ("ValidationException", "ResourceNotFoundException")
+
+# retrieved chunks of the two stage pipeline are cached per filter, independently of the answers
+RETRIEVAL_CACHE_TTL_SECONDS = int(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", 24 * 3600))
+retrieval_cache = SemanticCache(QNA_CACHE_TABLE, "retrieval", RETRIEVAL_CACHE_TTL_SECONDS,
+                                embedding_model_id=os.getenv("ANSWER_CACHE_EMBEDDING_MODEL_ID") or None,
+                                similarity_threshold=float(os.getenv("RETRIEVAL_CACHE_SIMILARITY_THRESHOLD", 0.97)),
+                                max_candidates=CACHE_SIMILARITY_MAX_CANDIDATES,
+                                window_seconds=CACHE_SIMILARITY_WINDOW_SECONDS
+                                ) if QNA_CACHE_TABLE else None
+
+
+def guardrail_intervenes(user_question, guardrail_id, guardrail_version):
+    """Check the question alone against the guardrail"""
+    response = bedrock_runtime_client.apply_guardrail(guardrailIdentifier=guardrail_id,
+                                                      guardrailVersion=guardrail_version,
+                                                      source='INPUT',
+                                                      content=[{'text': {'text': user_question}}])
+    return response['action'] == 'GUARDRAIL_INTERVENED'
+
+
+def get_cached_answer(cache_scope, user_question, guardrail_id, guardrail_version):
+    """Cached answer for the question. A similarity hit was stored for another question, so it is only
+    served when the guardrail accepts this one; otherwise the question goes through the normal pipeline."""
+    if answer_cache is None:
+        return None
+    try:
+        cached_response, exact = answer_cache.lookup(cache_scope, user_question)
+        if cached_response is not None and not exact and guardrail_intervenes(user_question, guardrail_id, guardrail_version):
+            print("Guardrail intervened on a question with a similar cached answer, not serving it")
+            return None
+        return cached_response
+    except Exception as e:
+        print(f"Answer cache lookup failed: {e}")
+        return None
+
+
+def cache_answer(cache_scope, user_question, response):
+    """Cache the answer unless the guardrail intervened, blocked answers depend on the exact wording"""
+    if answer_cache is None or response.get('guardrailAction') == 'INTERVENED':
+        return
+    try:
+        answer_cache.put(cache_scope, user_question,
+                         {'output': response['output'], 'citations': response.get('citations', [])})
+    except Exception as e:
+        print(f"Unable to cache answer: {e}")
+
+
+def compact_text(text, max_chars):
+    """Shorten text to at most max_chars, cutting at a word boundary"""
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + " ..."
+
+
+def new_two_stage_session_id():
+    return f"{TWO_STAGE_SESSION_PREFIX}{uuid.uuid4()}"
+
+
+def is_two_stage_session(session_id):
+    return bool(session_id) and session_id.startswith(TWO_STAGE_SESSION_PREFIX)
+
+
+def load_session_turns(session_id):
+    """Earlier turns of a two stage session, oldest first"""
+    if not QNA_SESSIONS_TABLE:
+        return []
+    try:
+        response = dynamodb.get_item(TableName=QNA_SESSIONS_TABLE, Key={'sessionId': {'S': session_id}})
+    except Exception as e:
+        print(f"Unable to load session {session_id}: {e}")
+        return []
+    item = response.get('Item')
+    return json.loads(item['turns']['S']) if item else []
+
+
+def save_session_turn(session_id, turns, user_question, answer):
+    # converse rejects empty messages, an unanswered question is not part of the history
+    if not QNA_SESSIONS_TABLE or not answer.strip():
+        return
+    turns = (list(turns) + [{'question': user_question,
+                             'answer': compact_text(answer, SESSION_ANSWER_MAX_CHARS)}])[-SESSION_MAX_TURNS:]
+    try:
+        dynamodb.put_item(TableName=QNA_SESSIONS_TABLE,
+                          Item={'sessionId': {'S': session_id},
+                                'turns': {'S': json.dumps(turns)},
+                                'ttl': {'N': str(int(time.time()) + SESSION_TTL_SECONDS)}})
+    except Exception as e:
+        print(f"Unable to save session {session_id}: {e}")
+
 
 def get_filter_condition(course_name, course_id, week_number):
     and_all_condition = []
@@ -25,10 +147,8 @@ def get_filter_condition(course_name, course_id, week_number):
     return and_all_condition
 
 
-def retrive_from_kb(user_question, kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results):
-    response = bedrock_agent_runtime_client.retrieve_and_generate(
-        input={'text': user_question},
-        retrieveAndGenerateConfiguration={
+def get_retrieve_and_generate_configuration(kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results):
+    return {
             'type': 'KNOWLEDGE_BASE',
             'knowledgeBaseConfiguration': {
                     'knowledgeBaseId': kb_id,
@@ -57,6 +177,188 @@ def retrive_from_kb(user_question, kb_id, model_arn, guardrail_id, guardrail_ver
                         }
                     }
                 },
+        }
+
+
+def call_with_session(operation, session_id, **kwargs):
+    """Call a retrieve_and_generate operation, in the Bedrock session when one is given.
+    A session Bedrock rejects (expired or unknown) is replaced by a new one, whose id is in the response."""
+    if not session_id:
+        return operation(**kwargs)
+    try:
+        # Bedrock keeps the conversation of a session, follow-up questions reuse it
+        return operation(sessionId=session_id, **kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in INVALID_SESSION_ERROR_CODES:
+            raise
+        print(f"Session {session_id} is not usable, starting a new session: {e}")
+        return operation(**kwargs)
+
+
+def retrive_from_kb(user_question, kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results, session_id=None):
+    response = call_with_session(
+        bedrock_agent_runtime_client.retrieve_and_generate, session_id,
+        input={'text': user_question},
+        retrieveAndGenerateConfiguration=get_retrieve_and_generate_configuration(
+            kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results),
+    )
+    return response
+
+
+def retrive_from_kb_stream(user_question, kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results, session_id=None):
+    response = call_with_session(
+        bedrock_agent_runtime_client.retrieve_and_generate_stream, session_id,
+        input={'text': user_question},
+        retrieveAndGenerateConfiguration=get_retrieve_and_generate_configuration(
+            kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results),
+    )
+    return response
+
+
+def get_filter_digest(and_all_condition, num_of_candidates):
+    """Short digest identifying a retrieval filter, shared by every student of a course and week"""
+    filter_json = json.dumps({'andAll': and_all_condition, 'numberOfResults': num_of_candidates}, sort_keys=True)
+    return hashlib.sha256(filter_json.encode('utf-8')).hexdigest()[:32]
+
+
+def retrieve_candidates(user_question, kb_id, and_all_condition, num_of_candidates):
+    cache_scope = (get_filter_digest(and_all_condition, num_of_candidates),)
+    if retrieval_cache is not None:
+        try:
+            retrieval_results = retrieval_cache.get(cache_scope, user_question)
+            if retrieval_results is not None:
+                print("Retrieval results served from cache")
+                return retrieval_results
+        except Exception as e:
+            print(f"Retrieval cache lookup failed: {e}")
+
+    retrieval_results = search_kb(user_question, kb_id, and_all_condition, num_of_candidates)
+
+    if retrieval_cache is not None:
+        try:
+            retrieval_cache.put(cache_scope, user_question, retrieval_results)
+        except Exception as e:
+            print(f"Unable to cache retrieval results: {e}")
+    return retrieval_results
+
+
+def search_kb(user_question, kb_id, and_all_condition, num_of_candidates):
+    response = bedrock_agent_runtime_client.retrieve(
+        knowledgeBaseId=kb_id,
+        retrievalQuery={'text': user_question},
+        retrievalConfiguration={
+            'vectorSearchConfiguration': {
+                'filter': {
+                    'andAll': and_all_condition,
+                },
+                'numberOfResults': num_of_candidates,
+                'overrideSearchType': 'HYBRID'
+            }
         },
     )
-    return response 
\ No newline at end of file
+    return response['retrievalResults']
+
+
+def format_search_results(retrieval_results):
+    return "\n".join(f"<search_result>\n{result['content']['text']}\n</search_result>"
+                     for result in retrieval_results)
+
+
+def get_converse_request(user_question, model_id, guardrail_id, guardrail_version, prompt_template, retrieval_results, history=()):
+    """Converse request answering the question from the selected chunks with the knowledge base prompt template,
+    preceded by the earlier turns of the session"""
+    system_prompt = prompt_template.replace("$search_results$", format_search_results(retrieval_results))
+    messages = []
+    for turn in history:
+        messages.append({"role": "user", "content": [{"text": turn['question']}]})
+        messages.append({"role": "assistant", "content": [{"text": turn['answer']}]})
+    messages.append({"role": "user", "content": [{"text": user_question}]})
+    return {
+        "modelId": model_id,
+        "system": [{"text": system_prompt}],
+        "messages": messages,
+        "inferenceConfig": {"temperature": 0},        # not to hallucinate
+        "guardrailConfig": {"guardrailIdentifier": guardrail_id, "guardrailVersion": guardrail_version},
+    }
+
+
+def get_citations(retrieval_results):
+    return [{'retrievedReferences': [{'content': result['content'],
+                                      'location': result.get('location', {}),
+                                      'metadata': result.get('metadata', {})}
+                                     for result in retrieval_results]}]
+
+
+def retrieve_rerank_and_generate(user_question, kb_id, model_id, guardrail_id, guardrail_version, prompt_template,
+                                 and_all_condition, num_of_candidates, top_k, token_budget,
+                                 apigatewaymanagementapi_client=None, connection_id=None, history=()):
+    """Two stage alternative to retrieve_and_generate: retrieve a larger candidate set, rerank it
+    locally and answer with converse, streaming the answer when a WebSocket client is given.
+    Returns the retrieve_and_generate response shape."""
+    # a follow-up question ("and its disadvantages?") is searched together with the previous one
+    retrieval_query = f"{history[-1]['question']} {user_question}" if history else user_question
+    candidates = retrieve_candidates(retrieval_query, kb_id, and_all_condition, num_of_candidates)
+    retrieval_results = rerank_results(retrieval_query, candidates, top_k=top_k, token_budget=token_budget)
+    print(f"Selected {len(retrieval_results)} of {len(candidates)} retrieved chunks")
+    request = get_converse_request(user_question, model_id, guardrail_id, guardrail_version, prompt_template,
+                                   retrieval_results, history)
+
+    if apigatewaymanagementapi_client is None:
+        response = bedrock_runtime_client.converse(**request)
+        output_text = "".join(block.get('text', '') for block in response['output']['message']['content'])
+        stop_reason = response['stopReason']
+    else:
+        response = bedrock_runtime_client.converse_stream(**request)
+        output_text, stop_reason = process_converse_stream(response, apigatewaymanagementapi_client, connection_id)
+
+    return {'output': {'text': output_text},
+            'citations': get_citations(retrieval_results),
+            'guardrailAction': 'INTERVENED' if stop_reason == 'guardrail_intervened' else 'NONE'}
+
+
+def process_answer_stream(response, apigatewaymanagementapi_client, connection_id):
+    """Push answer tokens and citations of a retrieve_and_generate_stream response to the
+    WebSocket client as they arrive, and rebuild the retrieve_and_generate response shape."""
+    text_chunks = []
+    citations = []
+    guardrail_action = "NONE"
+    ws_sender = BufferedWSSender(apigatewaymanagementapi_client, connection_id)
+    try:
+        for event in response['stream']:
+            if 'output' in event:
+                text_chunks.append(event['output']['text'])
+                ws_sender.send(event['output']['text'])
+            elif 'citation' in event:
+                citation = event['citation'].get('citation', event['citation'])
+                citations.append(citation)
+                ws_sender.send_event({"event": "citation", "data": citation})
+            elif 'guardrail' in event:
+                guardrail_action = event['guardrail']['action']
+    finally:
+        ws_sender.close()
+        print(f"Sent {ws_sender.frames_sent} frames to client")
+
+    return {'output': {'text': "".join(text_chunks)},
+            'citations': citations,
+            'guardrailAction': guardrail_action,
+            'sessionId': response.get('sessionId')}
+
+
+def process_converse_stream(response, apigatewaymanagementapi_client, connection_id):
+    """Push the text of a converse_stream response to the WebSocket client as it arrives"""
+    text_chunks = []
+    stop_reason = ""
+    ws_sender = BufferedWSSender(apigatewaymanagementapi_client, connection_id)
+    try:
+        for event in response['stream']:
+            if 'contentBlockDelta' in event:
+                text = event['contentBlockDelta']['delta'].get('text', '')
+                text_chunks.append(text)
+                ws_sender.send(text)
+            elif 'messageStop' in event:
+                stop_reason = event['messageStop']['stopReason']
+    finally:
+        ws_sender.close()
+        print(f"Sent {ws_sender.frames_sent} frames to client")
+
+    return "".join(text_chunks), stop_reason
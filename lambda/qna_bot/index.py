@@ -17,6 +17,8 @@ def lambda_handler(event, context):
         course_id = body.get("course_id", None)
         week_number = body.get("week_number", None)
         session_id = body.get("session_id", None)
+        is_streaming = body.get("is_streaming", "no")
+        pipeline = body.get("pipeline", os.getenv("QNA_PIPELINE", "retrieve_and_generate"))
         
         kb_id = os.getenv("KB_ID", "")
         model_id = os.getenv("QnA_MODEL_ID", "")
@@ -31,6 +33,8 @@ def lambda_handler(event, context):
         course_id = "Dummy-c002"
         week_number = 2
         session_id = ""
+        is_streaming = "no"
+        pipeline = "retrieve_and_generate"
         
         kb_id = ""
         model_id = ""
@@ -38,6 +42,12 @@ def lambda_handler(event, context):
         guardrail_version = ""
 
     num_of_results = 3
+    # two stage pipeline: chunks retrieved, chunks kept after reranking, and their token budget
+    num_of_candidates = int(os.getenv("QNA_NUM_OF_CANDIDATES", 20))
+    rerank_top_k = int(os.getenv("QNA_RERANK_TOP_K", 5))
+    context_token_budget = int(os.getenv("QNA_CONTEXT_TOKEN_BUDGET", 3000))
+    # the session history already holds context, follow-up questions keep fewer chunks
+    follow_up_top_k = int(os.getenv("QNA_FOLLOW_UP_TOP_K", 3))
     region = boto3.Session().region_name
     model_arn = f'arn:aws:bedrock:{region}::foundation-model/{model_id}'
     
@@ -49,14 +59,58 @@ $search_results$
 
     and_all_condition = get_filter_condition(course_name, course_id, week_number)
 
-    response = retrive_from_kb(user_question, kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results)
+    # the scope covers every condition of the filter, course_name included, and the pipeline producing the answer
+    cache_scope = (get_filter_digest(and_all_condition, num_of_results), pipeline)
+    # answers within a session depend on the conversation so far, they are neither served from nor added to the cache
+    use_answer_cache = not session_id
+    cached_response = get_cached_answer(cache_scope, user_question, guardrail_id, guardrail_version) if use_answer_cache else None
+    if cached_response is not None:
+        print("Answer served from cache")
+        return {'statusCode': 200,
+                'body': json.dumps({
+                            'bot_response': cached_response['output']['text'],
+                            'response': cached_response,
+                            'cached': True
+                        })
+            }
+
+    apigatewaymanagementapi_client, connection_id = None, None
+    if is_streaming == "yes":
+        # answer tokens are pushed to the connection as they are generated
+        request_context = event['requestContext']
+        websocket_endpoint_url = f"https://{request_context['domainName']}/{request_context['stage']}"
+        apigatewaymanagementapi_client = get_client('apigatewaymanagementapi', endpoint_url=websocket_endpoint_url)
+        connection_id = request_context['connectionId']
+
+    if pipeline == "two_stage":
+        # sessions of the default pipeline are kept by Bedrock, a two stage conversation starts its own
+        if not is_two_stage_session(session_id):
+            session_id = new_two_stage_session_id()
+        history = load_session_turns(session_id)
+        top_k = min(rerank_top_k, follow_up_top_k) if history else rerank_top_k
+        response = retrieve_rerank_and_generate(user_question, kb_id, model_id, guardrail_id, guardrail_version, prompt_template,
+                                                and_all_condition, num_of_candidates, top_k, context_token_budget,
+                                                apigatewaymanagementapi_client, connection_id, history)
+        save_session_turn(session_id, history, user_question, response['output']['text'])
+        response['sessionId'] = session_id
+    else:
+        # Bedrock does not know two stage sessions, the question starts a new knowledge base session
+        kb_session_id = None if is_two_stage_session(session_id) else session_id
+        if is_streaming == "yes":
+            stream_response = retrive_from_kb_stream(user_question, kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results, kb_session_id)
+            response = process_answer_stream(stream_response, apigatewaymanagementapi_client, connection_id)
+        else:
+            response = retrive_from_kb(user_question, kb_id, model_arn, guardrail_id, guardrail_version, prompt_template, and_all_condition, num_of_results, kb_session_id)
 
     output_text = response['output']['text']
     print(output_text)
+    if use_answer_cache:
+        cache_answer(cache_scope, user_question, response)
 
     return {'statusCode': 200,
             'body': json.dumps({
                         'bot_response': output_text,
+                        'session_id': response.get('sessionId'),
                         'response': response
                     })
         }
@@ -0,0 +1,93 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""Local reranking of knowledge base retrieval results.
+
+Candidates returned by the retrieve API are ordered by reciprocal rank fusion of the
+knowledge base relevance score and the lexical overlap with the question, near-duplicate
+chunks are dropped, and the remaining chunks are trimmed to a token budget. NumPy is only
+imported once results are reranked, so pipelines that never rerank do not load it.
+"""
+from token_budget import estimate_tokens
+from text_terms import tokenize
+
+# constant of reciprocal rank fusion, dampens the weight of the top ranks
+RRF_K = 60
+
+
+def term_set(text):
+    return set(tokenize(text))
+
+
+def term_matrix(token_sets, vocabulary):
+    """Binary (document x term) matrix of the given token sets"""
+    import numpy as np
+    index = {term: i for i, term in enumerate(vocabulary)}
+    matrix = np.zeros((len(token_sets), len(vocabulary)), dtype=np.float32)
+    for row, tokens in enumerate(token_sets):
+        columns = [index[token] for token in tokens if token in index]
+        matrix[row, columns] = 1.0
+    return matrix
+
+
+def ranks(values):
+    """0 based rank of every value, highest value first"""
+    import numpy as np
+    order = np.argsort(-values, kind="stable")
+    result = np.empty(len(values), dtype=np.float32)
+    result[order] = np.arange(len(values))
+    return result
+
+
+def fused_scores(question, texts, scores):
+    """Reciprocal rank fusion of the retrieval scores and the lexical overlap with the question"""
+    import numpy as np
+    question_terms = sorted(term_set(question))
+    overlap = np.zeros(len(texts), dtype=np.float32)
+    if question_terms:
+        overlap = term_matrix([term_set(text) for text in texts], question_terms).sum(axis=1) / len(question_terms)
+    return 1.0 / (RRF_K + ranks(np.asarray(scores, dtype=np.float32))) + 1.0 / (RRF_K + ranks(overlap))
+
+
+def jaccard_matrix(token_sets):
+    import numpy as np
+    vocabulary = sorted(set().union(*token_sets))
+    matrix = term_matrix(token_sets, vocabulary)
+    intersection = matrix @ matrix.T
+    sizes = matrix.sum(axis=1)
+    union = sizes[:, None] + sizes[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def rerank_results(question, retrieval_results, top_k=5, token_budget=3000, duplicate_threshold=0.8):
+    """Select the retrieval results to use as context for the question.
+
+    :param question: String
+    :param retrieval_results: List of retrievalResults items of the retrieve API
+    :param top_k: maximum number of results returned
+    :param token_budget: maximum estimated number of tokens of the returned texts
+    :param duplicate_threshold: results whose Jaccard similarity with a better one reaches this are dropped
+
+    :rtype: List of retrievalResults items, best first
+    """
+    if not retrieval_results:
+        return []
+
+    import numpy as np
+    texts = [result["content"]["text"] for result in retrieval_results]
+    order = np.argsort(-fused_scores(question, texts, [result.get("score", 0.0) for result in retrieval_results]),
+                       kind="stable")
+    similarity = jaccard_matrix([term_set(text) for text in texts])
+
+    selected, used_tokens = [], 0
+    for candidate in order:
+        if len(selected) == top_k:
+            break
+        if selected and similarity[candidate, selected].max() >= duplicate_threshold:
+            continue
+        tokens = estimate_tokens(texts[candidate])
+        if selected and used_tokens + tokens > token_budget:
+            continue
+        selected.append(candidate)
+        used_tokens += tokens
+    return [retrieval_results[i] for i in selected]
@@ -0,0 +1,231 @@
+## Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+## SPDX-License-Identifier: LicenseRef-.amazon.com.-AmznSL-1.0
+## Licensed under the Amazon Software License  https://aws.amazon.com/asl/
+"""DynamoDB backed cache for values derived from a free-text question.
+
+Entries live under a partition ("scope") made of a namespace, the current knowledge
+base generation and caller supplied parts such as course id and week, and are keyed by
+the hash of the normalized text. When an embedding model is configured, a miss on the
+exact key falls back to the most similar of the recently cached texts of the same scope.
+
+The knowledge base generation is written by the kb_sync lambda every time it starts an
+ingestion job, so all entries cached before a sync are left behind (and expire by TTL).
+While that job runs the generation carries a "pending" suffix, and the job status is
+polled lazily, so entries cached against a partially synced index are dropped as well
+once the job finishes.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from functools import lru_cache
+from aws_clients import get_client
+
+dynamodb = get_client("dynamodb")
+bedrock_runtime_client = get_client("bedrock-runtime")
+bedrock_agent_client = get_client("bedrock-agent")
+
+# partition and sort key of the item holding the current knowledge base generation
+GENERATION_SCOPE = "kb_generation"
+GENERATION_KEY = "current"
+# ingestion job statuses after which the knowledge base may still change
+INGESTION_RUNNING_STATUSES = ("STARTING", "IN_PROGRESS", "STOPPING")
+# how long a lambda environment trusts the generation it has read
+GENERATION_REFRESH_SECONDS = int(os.getenv("CACHE_GENERATION_REFRESH_SECONDS", 30))
+# DynamoDB items are limited to 400 KB
+MAX_VALUE_BYTES = 350 * 1024
+# embeddings are stored in a partition of their own next to the entries of a scope,
+# sorted by write time so a similarity lookup reads only the most recent ones
+EMBEDDING_SCOPE_SUFFIX = "#embeddings"
+
+_generation = {"value": None, "read_at": 0.0}
+
+
+def normalize_text(text):
+    """Lowercase, drop punctuation and collapse whitespace so trivially different questions share a key"""
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_ingestion_job_status(item):
+    """Current status of the ingestion job recorded in the generation item"""
+    try:
+        response = bedrock_agent_client.get_ingestion_job(knowledgeBaseId=item["knowledge_base_id"]["S"],
+                                                          dataSourceId=item["data_source_id"]["S"],
+                                                          ingestionJobId=item["generation"]["S"])
+        return response["ingestionJob"]["status"]
+    except Exception as e:
+        print(f"Unable to get ingestion job status: {e}")
+        return item["status"]["S"]
+
+
+def read_kb_generation(table_name):
+    response = dynamodb.get_item(TableName=table_name,
+                                 Key={"scope": {"S": GENERATION_SCOPE}, "key_hash": {"S": GENERATION_KEY}},
+                                 ConsistentRead=True)
+    item = response.get("Item")
+    if not item:
+        return "initial"
+
+    generation = item["generation"]["S"]
+    status = item.get("status", {}).get("S", "COMPLETE")
+    if status in INGESTION_RUNNING_STATUSES:
+        status = get_ingestion_job_status(item)
+        if status not in INGESTION_RUNNING_STATUSES:
+            # record the outcome unless kb_sync has started another job meanwhile
+            try:
+                dynamodb.update_item(TableName=table_name,
+                                     Key={"scope": {"S": GENERATION_SCOPE}, "key_hash": {"S": GENERATION_KEY}},
+                                     UpdateExpression="SET #status = :status",
+                                     ConditionExpression="#generation = :generation",
+                                     ExpressionAttributeNames={"#status": "status", "#generation": "generation"},
+                                     ExpressionAttributeValues={":status": {"S": status},
+                                                                ":generation": {"S": generation}})
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                pass
+    return f"{generation}-pending" if status in INGESTION_RUNNING_STATUSES else generation
+
+
+def get_kb_generation(table_name):
+    """Return the generation used in cache keys, re-read at most every GENERATION_REFRESH_SECONDS"""
+    now = time.monotonic()
+    if _generation["value"] is None or now - _generation["read_at"] > GENERATION_REFRESH_SECONDS:
+        _generation["value"] = read_kb_generation(table_name)
+        _generation["read_at"] = now
+    return _generation["value"]
+
+
+@lru_cache(maxsize=256)
+def embed_text(model_id, text):
+    """Titan text embedding of text, packed as float32 bytes"""
+    # NumPy is only needed by the similarity tier, keep it off the cold start of the other paths
+    import numpy as np
+    response = bedrock_runtime_client.invoke_model(modelId=model_id,
+                                                   body=json.dumps({"inputText": text, "normalize": True}))
+    embedding = json.loads(response["body"].read())["embedding"]
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def cosine_similarities(embedding, candidates):
+    """Cosine similarity of the embedding with each candidate embedding, all packed as float32 bytes.
+    Candidates of another dimension score 0."""
+    import numpy as np
+    vector = np.frombuffer(embedding, dtype=np.float32)
+    similarities = np.zeros(len(candidates), dtype=np.float32)
+    rows = [i for i, candidate in enumerate(candidates) if len(candidate) == len(embedding)]
+    if not rows:
+        return similarities
+    matrix = np.frombuffer(b"".join(candidates[i] for i in rows), dtype=np.float32).reshape(len(rows), -1)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    similarities[rows] = np.divide(matrix @ vector, norms, out=np.zeros(len(rows), dtype=np.float32), where=norms > 0)
+    return similarities
+
+
+class SemanticCache:
+    """Cache of JSON values keyed by (namespace, kb generation, scope parts, normalized text)
+
+    A similarity lookup reads a single bounded query: the embeddings of at most max_candidates
+    entries written within the last window_seconds, most recent first, compared with one
+    matrix product. Its latency does not grow with the number of cached entries.
+
+    :param table_name: DynamoDB table with partition key "scope", sort key "key_hash" and TTL attribute "ttl"
+    :param namespace: String separating independent caches sharing the table, e.g. "answer"
+    :param ttl_seconds: lifetime of an entry
+    :param embedding_model_id: optional Bedrock embedding model enabling the similarity tier
+    :param similarity_threshold: minimum cosine similarity for a similarity hit
+    :param max_candidates: maximum number of cached embeddings compared on an exact miss
+    :param window_seconds: only entries written this recently are compared, ttl_seconds when not given
+    """
+
+    def __init__(self, table_name, namespace, ttl_seconds, embedding_model_id=None,
+                 similarity_threshold=0.95, max_candidates=200, window_seconds=None):
+        self.table_name = table_name
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.embedding_model_id = embedding_model_id
+        self.similarity_threshold = similarity_threshold
+        self.max_candidates = max_candidates
+        self.window_seconds = min(window_seconds or ttl_seconds, ttl_seconds)
+
+    def _scope(self, scope_parts):
+        return "#".join([self.namespace, get_kb_generation(self.table_name)] + [str(part) for part in scope_parts])
+
+    def _get_value(self, scope, key_hash):
+        response = dynamodb.get_item(TableName=self.table_name,
+                                     Key={"scope": {"S": scope}, "key_hash": {"S": key_hash}})
+        item = response.get("Item")
+        # DynamoDB deletes expired items lazily, ignore the ones it has not removed yet
+        if not item or int(item["ttl"]["N"]) < time.time():
+            return None
+        return json.loads(item["value"]["S"])
+
+    def _most_similar(self, scope, embedding):
+        since = int(time.time()) - self.window_seconds
+        query = {"TableName": self.table_name,
+                 "KeyConditionExpression": "#scope = :scope AND #key > :since",
+                 "ProjectionExpression": "key_hash, embedding",
+                 "ExpressionAttributeNames": {"#scope": "scope", "#key": "key_hash"},
+                 "ExpressionAttributeValues": {":scope": {"S": scope + EMBEDDING_SCOPE_SUFFIX},
+                                               ":since": {"S": f"{since:012d}"}},
+                 "ScanIndexForward": False}
+        items = []
+        while len(items) < self.max_candidates:
+            response = dynamodb.query(Limit=self.max_candidates - len(items), **query)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response:
+                break
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        if not items:
+            return None
+
+        similarities = cosine_similarities(embedding, [item["embedding"]["B"] for item in items])
+        best = int(similarities.argmax())
+        if similarities[best] < self.similarity_threshold:
+            return None
+        print(f"Similar {self.namespace} cache entry found with similarity {similarities[best]:.3f} among {len(items)} entries")
+        # the sort key of an embedding is "{written at}#{key hash}"
+        return items[best]["key_hash"]["S"].split("#", 1)[1]
+
+    def lookup(self, scope_parts, text):
+        """Return (value, exact) for text, exact being False for a similarity hit, or (None, False) on a miss"""
+        scope = self._scope(scope_parts)
+        normalized = normalize_text(text)
+        value = self._get_value(scope, hash_text(normalized))
+        if value is not None:
+            return value, True
+        if not self.embedding_model_id:
+            return None, False
+
+        similar_hash = self._most_similar(scope, embed_text(self.embedding_model_id, normalized))
+        return (self._get_value(scope, similar_hash) if similar_hash else None), False
+
+    def get(self, scope_parts, text):
+        """Return the cached value for text, or None on a miss"""
+        return self.lookup(scope_parts, text)[0]
+
+    def put(self, scope_parts, text, value):
+        serialized = json.dumps(value)
+        if len(serialized.encode("utf-8")) > MAX_VALUE_BYTES:
+            print(f"Value too large for the {self.namespace} cache, skipping")
+            return
+
+        normalized = normalize_text(text)
+        scope, key_hash, now = self._scope(scope_parts), hash_text(normalized), int(time.time())
+        ttl = {"N": str(now + self.ttl_seconds)}
+        dynamodb.put_item(TableName=self.table_name,
+                          Item={"scope": {"S": scope},
+                                "key_hash": {"S": key_hash},
+                                "text": {"S": normalized},
+                                "value": {"S": serialized},
+                                "ttl": ttl})
+        if self.embedding_model_id:
+            dynamodb.put_item(TableName=self.table_name,
+                              Item={"scope": {"S": scope + EMBEDDING_SCOPE_SUFFIX},
+                                    "key_hash": {"S": f"{now:012d}#{key_hash}"},
+                                    "embedding": {"B": embed_text(self.embedding_model_id, normalized)},
+                                    "ttl": ttl})
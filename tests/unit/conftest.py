@@ -0,0 +1,43 @@
+import importlib.util
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LAMBDA_DIR = os.path.join(ROOT, "lambda")
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# placeholder values for environment variables read at import time
+for name, value in {"AWS_DEFAULT_REGION": "us-east-1",
+                    "API_REGION": "us-east-1",
+                    "ACCOUNT_ID": "123456789012",
+                    "COGNITO_USER_POOL_ID": "us-east-1_example",
+                    "WEBSOCKET_API_ID": "example"}.items():
+    os.environ.setdefault(name, value)
+
+# shared modules of the lambda layers, mounted under /opt/python in Lambda
+for layer in ("aws_clients_layer", "common_layer"):
+    sys.path.append(os.path.join(LAMBDA_DIR, "lambda_layer", layer))
+
+
+def load_lambda_module(lambda_dir, module):
+    """Import a module of a lambda directory under a unique name. The directory is on sys.path
+    while the module runs, so its sibling imports (e.g. "from helper import *") resolve."""
+    path = os.path.join(LAMBDA_DIR, lambda_dir)
+    spec = importlib.util.spec_from_file_location(f"{lambda_dir}_{module}", os.path.join(path, f"{module}.py"))
+    loaded = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, path)
+    try:
+        spec.loader.exec_module(loaded)
+    finally:
+        sys.path.remove(path)
+    return loaded
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as file:
+        return file.read()
+
+
+def load_json_fixture(name):
+    return json.loads(read_fixture(name))
@@ -0,0 +1,23 @@
+from conftest import load_lambda_module
+
+build_helper = load_lambda_module("course_build_ws", "helper")
+
+COURSE_OUTLINE = {"weekly_outline": [
+    {"week": 1, "main_outcomes": [{"outcome": "Outcome 1", "sub_outcomes": ["Sub 1", "Sub 2"]},
+                                  {"outcome": "Outcome 2", "sub_outcomes": ["Sub 3"]}]},
+    {"week": 2, "main_outcomes": [{"outcome": "Outcome 3", "sub_outcomes": ["Sub 4"]}]},
+]}
+
+
+def test_one_job_per_week_and_main_outcome():
+    jobs = build_helper.get_course_content_jobs("ML", COURSE_OUTLINE, {"user_prompt": "prompt"})
+
+    assert [(job["week_number"], job["main_learning_outcome"]) for job in jobs] == [
+        (1, "Outcome 1"), (1, "Outcome 2"), (2, "Outcome 3")]
+    assert jobs[0]["sub_learning_outcome_list"] == ["Sub 1", "Sub 2"]
+
+
+def test_build_jobs_never_stream():
+    jobs = build_helper.get_course_content_jobs("ML", COURSE_OUTLINE, {"user_prompt": "prompt", "is_streaming": "yes"})
+
+    assert {job["is_streaming"] for job in jobs} == {"no"}
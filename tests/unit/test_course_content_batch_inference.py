@@ -0,0 +1,66 @@
+import json
+
+from conftest import load_lambda_module, read_fixture
+
+import token_budget
+
+batch_inference = load_lambda_module("course_content_llm", "batch_inference")
+
+MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+USER_PROMPT = """For the course {course_title}, generate Week {week_number} content for:
+{main_learning_outcome}
+{sub_learning_outcome_list}
+<additional_context>
+{additional_context}
+</additional_context>"""
+
+
+def test_build_batch_record_renders_messages_request():
+    record = batch_inference.build_batch_record("00000000000", MODEL_ID, "Fundamentals of Machine Learning", 1,
+                                                "Understand the basics of machine learning",
+                                                ["Define machine learning"], "Reference text",
+                                                USER_PROMPT, [batch_inference.CourseContent])
+
+    assert record["recordId"] == "00000000000"
+    model_input = record["modelInput"]
+    assert model_input["anthropic_version"] == batch_inference.ANTHROPIC_VERSION
+    assert model_input["system"] == batch_inference.SYSTEM_PROMPT
+    text = model_input["messages"][0]["content"][0]["text"]
+    assert "Fundamentals of Machine Learning" in text
+    assert "Reference text" in text
+    assert [tool["name"] for tool in model_input["tools"]] == ["CourseContent"]
+    assert "properties" in model_input["tools"][0]["input_schema"]
+    assert model_input["max_tokens"] == batch_inference.get_content_max_tokens(MODEL_ID, [batch_inference.CourseContent],
+                                                                                ["Define machine learning"])
+    # records are written as JSONL
+    json.dumps(record)
+
+
+def test_parse_batch_output_lines():
+    lines = read_fixture("batch_output.jsonl.out").splitlines()
+
+    record_id, course_content = batch_inference.parse_batch_output_line(lines[0])
+    assert record_id == "00000000000"
+    content = course_content["CourseContent"]
+    assert content["week_number"] == 1
+    assert content["sub_learning_outcomes_content"][0]["multiple_choice_question"]["correct_answer"] == "Learning from data"
+    batch_inference.CourseContent.model_validate(content)
+
+
+def test_parse_batch_output_error_record():
+    lines = read_fixture("batch_output.jsonl.out").splitlines()
+
+    # collect_batch_job reads the output with iter_lines, which yields bytes
+    assert batch_inference.parse_batch_output_line(lines[1].encode("utf-8")) == ("00000000001", {})
+
+
+def test_batch_record_max_tokens_fits_the_model():
+    sub_learning_outcome_list = [f"Sub-outcome {index}" for index in range(10)]
+    record = batch_inference.build_batch_record("00000000000", MODEL_ID, "Fundamentals of Machine Learning", 1,
+                                                "Understand the basics of machine learning",
+                                                sub_learning_outcome_list, "", USER_PROMPT,
+                                                [batch_inference.CourseContent])
+
+    # claude-3-5-sonnet-20240620 rejects requests for more than 4096 output tokens
+    assert record["modelInput"]["max_tokens"] == token_budget.get_token_limits(MODEL_ID)[1] == 4096
@@ -0,0 +1,70 @@
+import pytest
+
+from conftest import load_lambda_module
+
+from token_budget import estimate_tokens
+
+context_selection = load_lambda_module("course_content_llm", "context_selection")
+
+FILLER = "An unrelated paragraph about campus parking permits and library opening hours."
+
+
+@pytest.fixture(autouse=True)
+def paragraph_passages(monkeypatch):
+    # one passage per paragraph of the test documents
+    monkeypatch.setattr(context_selection, "CONTEXT_PASSAGE_TOKENS", 25)
+    monkeypatch.setattr(context_selection, "_indexes", context_selection.OrderedDict())
+
+
+def make_document(*topics, filler_paragraphs=40):
+    paragraphs = [FILLER] * filler_paragraphs
+    step = filler_paragraphs // (len(topics) + 1)
+    for i, topic in enumerate(topics, start=1):
+        paragraphs[i * step] = topic
+    return "\n\n".join(paragraphs)
+
+
+def passage_tokens(selected):
+    return sum(estimate_tokens(passage) for passage in selected.split("\n...\n"))
+
+
+def test_small_context_is_returned_unchanged():
+    text = "Binary search halves the interval."
+
+    assert context_selection.select_relevant_context(text, "binary search", [], token_budget=100) == text
+
+
+def test_passages_matching_the_outcomes_are_selected_in_document_order():
+    sorting = "Merge sort splits the list, sorts both halves and merges them."
+    graphs = "Dijkstra's algorithm finds shortest paths in weighted graphs."
+    text = make_document(graphs, sorting)
+
+    selected = context_selection.select_relevant_context(text, "Sorting algorithms", ["merge sort halves"],
+                                                         token_budget=60)
+
+    assert sorting in selected
+    assert FILLER not in selected
+    assert passage_tokens(selected) <= 60
+
+    selected = context_selection.select_relevant_context(text, "shortest paths", ["merge sort"], token_budget=60)
+    assert selected.index(graphs) < selected.index(sorting)
+
+
+def test_passages_are_kept_within_the_token_budget():
+    topics = [f"Merge sort example {i} merges sorted halves of the list." for i in range(6)]
+    text = make_document(*topics)
+
+    selected = context_selection.select_relevant_context(text, "merge sort", [], token_budget=40)
+
+    assert 0 < sum(topic in selected for topic in topics) < len(topics)
+    assert passage_tokens(selected) <= 40
+
+
+def test_leading_passages_are_kept_when_nothing_matches():
+    text = make_document("Merge sort splits the list.")
+
+    selected = context_selection.select_relevant_context(text, "quantum chromodynamics", [], token_budget=60)
+
+    assert selected.startswith(FILLER)
+    assert "Merge sort" not in selected
+    assert passage_tokens(selected) <= 60
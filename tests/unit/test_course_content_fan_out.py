@@ -0,0 +1,69 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from conftest import load_lambda_module
+
+content_helper = load_lambda_module("course_content_llm", "helper")
+
+MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+
+def throttling_error():
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}}, "Converse")
+
+
+def tool_response(name, tool_input):
+    return {"stopReason": "tool_use",
+            "output": {"message": {"content": [{"toolUse": {"toolUseId": "1", "name": name, "input": tool_input}}]}}}
+
+
+class FlakyBedrock:
+    """Throttles the first request of every sub-learning outcome"""
+
+    def __init__(self):
+        self.throttled = set()
+        self.calls = 0
+
+    def __call__(self, model_id, course_title, week_number, main_learning_outcome, sub_learning_outcome_list,
+                 additional_context, user_prompt, pydantic_classes, is_streaming, max_tokens=None):
+        self.calls += 1
+        name = pydantic_classes[0].__name__
+        if name == "ReadingMaterial":
+            return tool_response(name, {"title": "Intro", "content": "Machine learning is..."})
+        if sub_learning_outcome_list not in self.throttled:
+            self.throttled.add(sub_learning_outcome_list)
+            raise throttling_error()
+        return tool_response(name, {"sub_learning_outcome": sub_learning_outcome_list,
+                                    "video_script": {"script": "Welcome..."},
+                                    "multiple_choice_question": {"question": "?", "options": ["a", "b"],
+                                                                 "correct_answer": "a"}})
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(content_helper, "FAN_OUT_RETRY_BASE_DELAY", 0)
+
+
+def test_throttled_part_is_retried_on_its_own(monkeypatch):
+    bedrock = FlakyBedrock()
+    monkeypatch.setattr(content_helper, "invoke_bedrock_converse_api", bedrock)
+
+    course_content = content_helper.generate_course_content_fan_out(MODEL_ID, "ML", 1, "Understand ML",
+                                                                    ["Define ML", "List types of ML"], "", 2)
+
+    outcomes = [part["sub_learning_outcome"] for part in course_content["CourseContent"]["sub_learning_outcomes_content"]]
+    assert outcomes == ["Define ML", "List types of ML"]
+    # one request for the reading material, two for each throttled sub-learning outcome
+    assert bedrock.calls == 5
+
+
+def test_part_fails_after_max_retries(monkeypatch):
+    def always_throttled(*args, **kwargs):
+        raise throttling_error()
+
+    monkeypatch.setattr(content_helper, "invoke_bedrock_converse_api", always_throttled)
+
+    with pytest.raises(ValueError):
+        content_helper.generate_course_content_part(MODEL_ID, content_helper.ReadingMaterial,
+                                                    content_helper.READING_MATERIAL_PROMPT, "ML", 1,
+                                                    "Understand ML", ["Define ML"], "", 2)
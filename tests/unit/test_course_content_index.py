@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from conftest import load_lambda_module
+
+content_index = load_lambda_module("course_content_llm", "index")
+
+COURSE_CONTENT = {"week_number": 1, "main_learning_outcome": "Understand machine learning",
+                  "reading_material": {"title": "Intro", "content": "..."}, "sub_learning_outcomes_content": []}
+
+
+class GoneClient:
+    def post_to_connection(self, ConnectionId, Data):
+        raise Exception("GoneException")
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    saved = {}
+    monkeypatch.setenv("WEBSOCKET_ENDPOINT_URL", "https://example.com")
+    monkeypatch.setenv("OUTPUT_BUCKET", "bucket")
+    monkeypatch.setattr(content_index, "get_client", lambda *args, **kwargs: GoneClient())
+    monkeypatch.setattr(content_index, "extract_text_from_pdfs", lambda *args, **kwargs: "")
+    monkeypatch.setattr(content_index, "invoke_bedrock_converse_api", lambda *args, **kwargs: {"stopReason": "tool_use"})
+    monkeypatch.setattr(content_index, "parse_bedrock_tool_response", lambda response: COURSE_CONTENT)
+    monkeypatch.setattr(content_index, "save_json_to_s3", lambda bucket, key, data: saved.update({key: data}))
+    return saved
+
+
+def make_record(**body):
+    body = {"s3_input_uri_list": [], "user_prompt": "{course_title} {week_number} {additional_context}",
+            "week_number": 1, "course_title": "ML", "main_learning_outcome": "Understand machine learning",
+            "sub_learning_outcome_list": ["Define machine learning"], "is_streaming": "no", **body}
+    return {"messageId": "1", "body": json.dumps({"requestContext": {"connectionId": "gone"}, "body": json.dumps(body)})}
+
+
+def test_content_is_saved_when_the_client_has_disconnected(saved):
+    response = content_index.generate_course_content(make_record())
+
+    assert response["statusCode"] == 200
+    assert saved == {"course_content/ML/1/Understand machine learning/course_content.json": COURSE_CONTENT}
+
+
+class RecordingClient:
+    def __init__(self):
+        self.messages = []
+
+    def post_to_connection(self, ConnectionId, Data):
+        self.messages.append(json.loads(Data))
+
+
+class Stream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        pass
+
+
+def test_stream_over_the_byte_limit_reports_an_error_and_is_not_saved(saved, monkeypatch):
+    client = RecordingClient()
+    stream = Stream([{"messageStart": {"role": "assistant"}},
+                     {"contentBlockStart": {"start": {"toolUse": {"toolUseId": "1", "name": "CourseContent"}}}}]
+                    + [{"contentBlockDelta": {"delta": {"toolUse": {"input": " " * 1024}}}}] * 100)
+    monkeypatch.setattr(content_index, "get_client", lambda *args, **kwargs: client)
+    monkeypatch.setattr(content_index, "invoke_bedrock_converse_api", lambda *args, **kwargs: {"stream": stream})
+    monkeypatch.setattr(content_index, "get_max_output_bytes", lambda max_tokens: 10 * 1024)
+
+    content_index.generate_course_content(make_record(is_streaming="yes"))
+
+    assert saved == {}
+    assert "exceeded the limit" in client.messages[-1]
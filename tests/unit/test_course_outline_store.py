@@ -0,0 +1,29 @@
+import io
+import json
+
+import course_outline_store
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(json.dumps(self.objects[Key]).encode("utf-8"))}
+
+
+def test_outline_saved_under_the_tool_name_is_unwrapped(monkeypatch):
+    outline = {"course_title": "ML", "weekly_outline": [{"week": 1, "main_outcomes": []}]}
+    key = course_outline_store.get_course_outline_key("ML")
+    monkeypatch.setattr(course_outline_store, "get_client",
+                        lambda service_name: FakeS3({key: {"CourseOutline": outline}}))
+
+    assert course_outline_store.load_course_outline("bucket", "ML") == outline
+
+
+def test_streamed_outline_is_returned_as_saved(monkeypatch):
+    outline = {"course_title": "ML", "weekly_outline": []}
+    key = course_outline_store.get_course_outline_key("ML")
+    monkeypatch.setattr(course_outline_store, "get_client", lambda service_name: FakeS3({key: outline}))
+
+    assert course_outline_store.load_course_outline("bucket", "ML") == outline
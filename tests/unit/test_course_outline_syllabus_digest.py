@@ -0,0 +1,42 @@
+import io
+
+from botocore.exceptions import ClientError
+from conftest import load_lambda_module
+
+outline_helper = load_lambda_module("course_outline_llm", "helper")
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_syllabus_digest_is_cached_under_its_own_prefix(monkeypatch):
+    s3 = FakeS3()
+    condensed = []
+    monkeypatch.setattr(outline_helper, "s3_client", s3)
+    monkeypatch.setattr(outline_helper, "condense_text",
+                        lambda text, model_id, max_tokens: condensed.append(text) or "digest")
+    syllabus = "week one covers sorting algorithms " * 200
+
+    assert outline_helper.get_syllabus_digest(syllabus, cache_bucket="bucket", max_tokens=10) == "digest"
+    assert outline_helper.get_syllabus_digest(syllabus, cache_bucket="bucket", max_tokens=10) == "digest"
+
+    assert len(condensed) == 1
+    [(bucket, key)] = s3.objects
+    assert key.startswith(f"{outline_helper.SYLLABUS_DIGEST_PREFIX}/")
+    assert not key.startswith(f"{outline_helper.PDF_TEXT_CACHE_PREFIX}/")
+
+
+def test_short_syllabus_is_not_condensed(monkeypatch):
+    monkeypatch.setattr(outline_helper, "s3_client", FakeS3())
+
+    assert outline_helper.get_syllabus_digest("short syllabus", cache_bucket="bucket", max_tokens=100) == "short syllabus"
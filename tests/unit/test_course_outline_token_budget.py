@@ -0,0 +1,30 @@
+from conftest import load_lambda_module
+
+import token_budget
+
+outline_helper = load_lambda_module("course_outline_llm", "helper")
+CourseOutline = load_lambda_module("course_outline_llm", "CourseOutlinePydantic").CourseOutline
+
+MODEL_ID = "anthropic.claude-3-5-sonnet-20241022-v2:0"
+
+
+def test_outline_max_tokens_parses_leading_week_count():
+    tools = [CourseOutline]
+    weeks = outline_helper.get_outline_max_tokens(MODEL_ID, tools, 12)
+
+    assert outline_helper.get_outline_max_tokens(MODEL_ID, tools, "12 weeks") == weeks
+    assert outline_helper.get_outline_max_tokens(MODEL_ID, tools, "12") == weeks
+    assert outline_helper.get_outline_max_tokens(MODEL_ID, tools, 3) < weeks
+
+
+def test_outline_max_tokens_falls_back_to_model_maximum():
+    max_output_tokens = token_budget.get_token_limits(MODEL_ID)[1]
+
+    assert outline_helper.get_outline_max_tokens(MODEL_ID, [CourseOutline], "twelve") == max_output_tokens
+
+
+def test_retry_max_tokens_only_raises_the_cap():
+    max_output_tokens = token_budget.get_token_limits(MODEL_ID)[1]
+
+    assert token_budget.get_retry_max_tokens(MODEL_ID, 1000) == max_output_tokens
+    assert token_budget.get_retry_max_tokens(MODEL_ID, max_output_tokens) is None
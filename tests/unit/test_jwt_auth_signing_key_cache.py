@@ -0,0 +1,85 @@
+import jwt
+import pytest
+
+from conftest import load_json_fixture, load_lambda_module
+
+jwt_auth_helper = load_lambda_module("jwt_auth", "helper")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+class RecordingFetcher:
+    """Serves the JWKS fixtures in order, repeating the last one"""
+
+    def __init__(self, *fixture_names):
+        self.key_sets = [load_json_fixture(name) for name in fixture_names]
+        self.calls = 0
+
+    def __call__(self, jwks_url):
+        key_set = self.key_sets[min(self.calls, len(self.key_sets) - 1)]
+        self.calls += 1
+        return key_set
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(jwt_auth_helper, "time", clock)
+    return clock
+
+
+def make_cache(fetcher):
+    return jwt_auth_helper.SigningKeyCache("https://example.com/.well-known/jwks.json",
+                                           ttl_seconds=3600, min_refresh_seconds=30, fetcher=fetcher)
+
+
+def test_keys_are_reused_until_ttl_expires(clock):
+    fetcher = RecordingFetcher("jwks.json")
+    cache = make_cache(fetcher)
+
+    assert cache.get_signing_key("key-1").key_id == "key-1"
+    clock.now += 3599
+    cache.get_signing_key("key-1")
+    assert fetcher.calls == 1
+
+    clock.now += 2
+    cache.get_signing_key("key-1")
+    assert fetcher.calls == 2
+
+
+def test_unknown_kid_refreshes_key_set(clock):
+    fetcher = RecordingFetcher("jwks.json", "jwks_rotated.json")
+    cache = make_cache(fetcher)
+    cache.get_signing_key("key-1")
+
+    clock.now += 31
+    assert cache.get_signing_key("key-2").key_id == "key-2"
+    assert fetcher.calls == 2
+
+
+def test_unknown_kid_refresh_is_rate_limited(clock):
+    fetcher = RecordingFetcher("jwks.json")
+    cache = make_cache(fetcher)
+    cache.get_signing_key("key-1")
+
+    # within min_refresh_seconds of the last fetch an unknown kid does not refetch
+    clock.now += 10
+    with pytest.raises(jwt.exceptions.PyJWKClientError):
+        cache.get_signing_key("unknown")
+    with pytest.raises(jwt.exceptions.PyJWKClientError):
+        cache.get_signing_key("unknown")
+    assert fetcher.calls == 1
+
+    clock.now += 21
+    with pytest.raises(jwt.exceptions.PyJWKClientError):
+        cache.get_signing_key("unknown")
+    assert fetcher.calls == 2
@@ -0,0 +1,56 @@
+import pytest
+
+from conftest import load_lambda_module
+
+jwt_auth_helper = load_lambda_module("jwt_auth", "helper")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(jwt_auth_helper, "time", clock)
+    return clock
+
+
+def test_token_is_verified_until_it_expires(clock):
+    cache = jwt_auth_helper.VerifiedTokenCache()
+    cache.add("token", expiry_time=1060)
+
+    assert cache.is_verified("token")
+    clock.now = 1060
+    assert cache.is_verified("token")
+
+    clock.now = 1061
+    assert not cache.is_verified("token")
+    # the expired entry is dropped, not only skipped
+    clock.now = 1000
+    assert not cache.is_verified("token")
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_unknown_token_is_not_verified(clock):
+    cache = jwt_auth_helper.VerifiedTokenCache()
+    cache.add("token", expiry_time=1060)
+
+    assert not cache.is_verified("other token")
+
+
+def test_least_recently_used_token_is_evicted(clock):
+    cache = jwt_auth_helper.VerifiedTokenCache(max_size=2)
+    cache.add("first", expiry_time=2000)
+    cache.add("second", expiry_time=2000)
+    assert cache.is_verified("first")
+
+    cache.add("third", expiry_time=2000)
+
+    assert cache.is_verified("first")
+    assert cache.is_verified("third")
+    assert not cache.is_verified("second")
@@ -0,0 +1,51 @@
+import json
+
+from partial_json import IncrementalObjectParser
+
+COURSE_CONTENT = {
+    "week_number": 1,
+    "sub_learning_outcomes_content": [
+        {"sub_learning_outcome": "Define {machine} learning",
+         "video_script": "Say \"hello\" \\ then [pause], then a é and a \\\"quote\\\"."},
+        {"sub_learning_outcome": "List types of learning", "video_script": "}]{["},
+    ],
+    "reading_material": {"title": "Intro", "content": "Chapter \"1\"}"},
+}
+
+
+def feed_in_fragments(parser, text, size):
+    completed = []
+    for start in range(0, len(text), size):
+        completed.extend(parser.feed(text[start:start + size]))
+    return completed
+
+
+def test_objects_are_returned_as_they_close():
+    text = json.dumps(COURSE_CONTENT)
+    parser = IncrementalObjectParser(["sub_learning_outcomes_content", "reading_material"])
+
+    first_end = text.index('"List types') - 2
+    completed = parser.feed(text[:first_end])
+    assert completed == [("sub_learning_outcomes_content", 0, COURSE_CONTENT["sub_learning_outcomes_content"][0])]
+
+    completed = parser.feed(text[first_end:])
+    assert completed == [("sub_learning_outcomes_content", 1, COURSE_CONTENT["sub_learning_outcomes_content"][1]),
+                         ("reading_material", None, COURSE_CONTENT["reading_material"])]
+
+
+def test_escapes_and_brackets_in_strings_survive_any_fragmentation():
+    text = json.dumps(COURSE_CONTENT)
+    expected = [("sub_learning_outcomes_content", 0, COURSE_CONTENT["sub_learning_outcomes_content"][0]),
+                ("sub_learning_outcomes_content", 1, COURSE_CONTENT["sub_learning_outcomes_content"][1]),
+                ("reading_material", None, COURSE_CONTENT["reading_material"])]
+
+    for size in (1, 2, 3, 7, len(text)):
+        parser = IncrementalObjectParser(["sub_learning_outcomes_content", "reading_material"])
+        assert feed_in_fragments(parser, text, size) == expected
+
+
+def test_other_keys_and_incomplete_objects_are_not_returned():
+    text = json.dumps(COURSE_CONTENT)
+    parser = IncrementalObjectParser(["reading_material"])
+
+    assert parser.feed(text[:-3]) == []
@@ -0,0 +1,54 @@
+import subprocess
+import sys
+
+from conftest import LAMBDA_DIR, load_lambda_module
+
+rerank = load_lambda_module("qna_bot", "rerank")
+
+
+def result(text, score):
+    return {"content": {"text": text}, "score": score}
+
+
+def test_near_duplicates_are_dropped():
+    results = [result("Supervised learning trains a model on labelled examples.", 0.9),
+               result("Supervised learning trains a model on labelled examples!", 0.8),
+               result("Unsupervised learning finds structure in unlabelled data.", 0.7)]
+
+    selected = rerank.rerank_results("what is supervised learning", results, top_k=3)
+
+    assert [item["score"] for item in selected] == [0.9, 0.7]
+
+
+def test_lexical_overlap_reorders_retrieval_scores():
+    results = [result("Gradient descent minimises a loss function step by step.", 0.52),
+               result("Decision trees split the data on feature thresholds.", 0.50),
+               result("Random forests average many decision trees.", 0.30)]
+
+    selected = rerank.rerank_results("how do decision trees split data", results, top_k=1)
+
+    assert selected[0]["score"] == 0.50
+
+
+def test_results_are_trimmed_to_the_token_budget():
+    results = [result("alpha " * 100, 0.9), result("beta " * 100, 0.8), result("gamma", 0.7)]
+
+    selected = rerank.rerank_results("alpha beta gamma", results, top_k=3, token_budget=200)
+
+    # the best result is always kept, later ones only while they fit the budget
+    assert [item["score"] for item in selected] == [0.9, 0.7]
+
+
+def test_jaccard_matrix():
+    similarity = rerank.jaccard_matrix([{"a", "b"}, {"b", "c"}, set()])
+
+    assert similarity[0, 1] == similarity[1, 0] == 1 / 3
+    assert similarity[0, 0] == 1
+    assert similarity[2, 2] == 0
+
+
+def test_numpy_is_not_imported_with_the_module():
+    code = ("import sys; sys.path[:0] = sys.argv[1:]; import rerank; "
+            "assert 'numpy' not in sys.modules, 'numpy imported'")
+    subprocess.run([sys.executable, "-c", code, f"{LAMBDA_DIR}/qna_bot",
+                    f"{LAMBDA_DIR}/lambda_layer/common_layer"], check=True)
@@ -0,0 +1,127 @@
+import json
+
+import numpy as np
+import pytest
+
+from conftest import load_lambda_module
+
+semantic_cache = load_lambda_module("qna_bot", "semantic_cache")
+
+MODEL_ID = "amazon.titan-embed-text-v2:0"
+
+
+class FakeDynamoDB:
+    """In-memory table supporting the calls made by SemanticCache"""
+
+    def __init__(self):
+        self.items = {}
+        self.queries = []
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        item = self.items.get((Key["scope"]["S"], Key["key_hash"]["S"]))
+        return {"Item": item} if item else {}
+
+    def put_item(self, TableName, Item):
+        self.items[(Item["scope"]["S"], Item["key_hash"]["S"])] = Item
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, Limit,
+              ScanIndexForward=True, **kwargs):
+        self.queries.append(Limit)
+        scope, since = ExpressionAttributeValues[":scope"]["S"], ExpressionAttributeValues[":since"]["S"]
+        keys = sorted((key for item_scope, key in self.items if item_scope == scope and key > since),
+                      reverse=not ScanIndexForward)
+        return {"Items": [self.items[(scope, key)] for key in keys[:Limit]]}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+def vector(*values):
+    return np.asarray(values, dtype=np.float32).tobytes()
+
+
+EMBEDDINGS = {
+    "what is machine learning": vector(1.0, 0.0, 0.0),
+    "what s machine learning": vector(0.99, 0.14, 0.0),
+    "define machine learning": vector(0.8, 0.6, 0.0),
+    "what is a decision tree": vector(0.0, 1.0, 0.0),
+}
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeDynamoDB()
+    clock = Clock()
+    monkeypatch.setattr(semantic_cache, "dynamodb", table)
+    monkeypatch.setattr(semantic_cache, "time", clock)
+    monkeypatch.setattr(semantic_cache, "embed_text", lambda model_id, text: EMBEDDINGS[text])
+    monkeypatch.setattr(semantic_cache, "get_kb_generation", lambda table_name: "initial")
+    table.clock = clock
+    return table
+
+
+def make_cache(**kwargs):
+    return semantic_cache.SemanticCache("table", "answer", 3600, embedding_model_id=MODEL_ID,
+                                        similarity_threshold=0.95, **kwargs)
+
+
+def test_exact_hit_ignores_case_and_punctuation(table):
+    cache = make_cache()
+    cache.put(["course"], "What is Machine Learning?", {"answer": 1})
+
+    assert cache.lookup(["course"], "what is machine learning") == ({"answer": 1}, True)
+    assert table.queries == []
+
+
+def test_similarity_hit_above_the_threshold_only(table):
+    cache = make_cache()
+    cache.put(["course"], "what is machine learning", {"answer": 1})
+
+    # cosine similarity 0.99
+    assert cache.lookup(["course"], "what's machine learning") == ({"answer": 1}, False)
+    # cosine similarity 0.8
+    assert cache.lookup(["course"], "define machine learning") == (None, False)
+    assert cache.lookup(["course"], "what is a decision tree") == (None, False)
+
+
+def test_scopes_are_separate(table):
+    cache = make_cache()
+    cache.put(["course", 1], "what is machine learning", {"answer": 1})
+
+    assert cache.lookup(["course", 2], "what's machine learning") == (None, False)
+
+
+def test_similarity_lookup_reads_a_bounded_recent_window(table):
+    cache = make_cache(max_candidates=2, window_seconds=600)
+    cache.put(["course"], "what is machine learning", {"answer": 1})
+    table.clock.now += 700
+    for text in ("define machine learning", "what is a decision tree"):
+        cache.put(["course"], text, {"answer": text})
+
+    # the matching entry was written before the window
+    assert cache.lookup(["course"], "what's machine learning") == (None, False)
+    assert table.queries == [2]
+
+
+def test_expired_entries_are_not_served(table):
+    cache = make_cache()
+    cache.put(["course"], "what is machine learning", {"answer": 1})
+    table.clock.now += 3601
+
+    assert cache.lookup(["course"], "what is machine learning") == (None, False)
+    assert cache.lookup(["course"], "what's machine learning") == (None, False)
+
+
+def test_cosine_similarities_skips_other_dimensions():
+    similarities = semantic_cache.cosine_similarities(vector(1.0, 0.0), [vector(2.0, 0.0), vector(1.0, 0.0, 0.0),
+                                                                          vector(0.0, 0.0)])
+
+    assert similarities.tolist() == [1.0, 0.0, 0.0]
@@ -0,0 +1,58 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from conftest import load_lambda_module
+
+qna_helper = load_lambda_module("qna_bot", "helper")
+
+
+class FakeAgentRuntime:
+    """retrieve_and_generate that only knows the sessions it created"""
+
+    def __init__(self):
+        self.calls = []
+
+    def retrieve_and_generate(self, **kwargs):
+        self.calls.append(kwargs.get("sessionId"))
+        if kwargs.get("sessionId") not in (None, "known-session"):
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "Session not found"}},
+                              "RetrieveAndGenerate")
+        return {"output": {"text": "answer"}, "sessionId": kwargs.get("sessionId") or "new-session"}
+
+
+@pytest.fixture
+def agent_runtime(monkeypatch):
+    agent_runtime = FakeAgentRuntime()
+    monkeypatch.setattr(qna_helper, "bedrock_agent_runtime_client", agent_runtime)
+    return agent_runtime
+
+
+def ask(session_id):
+    return qna_helper.retrive_from_kb("what is ML?", "kb", "arn", "", "", "$search_results$",
+                                      {"equals": {"key": "week", "value": 1}}, 3, session_id)
+
+
+def test_known_session_is_continued(agent_runtime):
+    assert ask("known-session")["sessionId"] == "known-session"
+    assert agent_runtime.calls == ["known-session"]
+
+
+def test_rejected_session_is_retried_once_without_it(agent_runtime):
+    assert ask("expired-session")["sessionId"] == "new-session"
+    assert agent_runtime.calls == ["expired-session", None]
+
+
+def test_other_errors_are_not_retried(monkeypatch):
+    def throttled(**kwargs):
+        raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Slow down"}}, "RetrieveAndGenerate")
+
+    with pytest.raises(ClientError):
+        qna_helper.call_with_session(throttled, "known-session")
+
+
+def test_two_stage_session_ids_are_told_apart():
+    session_id = qna_helper.new_two_stage_session_id()
+
+    assert qna_helper.is_two_stage_session(session_id)
+    assert not qna_helper.is_two_stage_session("known-session")
+    assert not qna_helper.is_two_stage_session(None)
@@ -0,0 +1,38 @@
+import json
+import threading
+
+from ws_sender import BufferedWSSender
+
+
+class RecordingClient:
+    def __init__(self):
+        self.frames = []
+        self.posted = threading.Event()
+
+    def post_to_connection(self, ConnectionId, Data):
+        self.frames.append(json.loads(Data))
+        self.posted.set()
+
+
+def test_small_sends_are_coalesced():
+    client = RecordingClient()
+    sender = BufferedWSSender(client, "connection", max_bytes=1024, max_delay=60)
+    for text in ('{"a"', ': 1', '}'):
+        sender.send(text)
+    sender.send_event({"event": "done"})
+    sender.close()
+
+    assert client.frames == ['{"a": 1}', {"event": "done"}]
+
+
+def test_buffered_text_is_flushed_while_the_stream_stalls():
+    client = RecordingClient()
+    sender = BufferedWSSender(client, "connection", max_bytes=1024, max_delay=0.05)
+    sender.send("x")
+    sender.send("y")
+
+    # no further send() call, the background thread flushes once max_delay has passed
+    assert client.posted.wait(timeout=2)
+    assert client.frames == ["xy"]
+    sender.close()
+    assert sender.frames_sent == 1